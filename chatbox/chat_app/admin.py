@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import OnlineUser, MessageDeliveryStatus, ChatRoom, TypingIndicator
+from .models import OnlineUser, MessageDeliveryStatus, ChatRoom, TypingIndicator, ConversationReadState
 
 # Register your models here.
 @admin.register(ChatRoom)
@@ -77,4 +77,12 @@ class CustomAdminOnlineUser(admin.ModelAdmin):
         ('Activity', {
             'fields': ['last_activity']
         }),
-    ]
\ No newline at end of file
+    ]
+
+@admin.register(ConversationReadState)
+class CustomAdminConversationReadState(admin.ModelAdmin):
+    """the admin structure for the read/delivered watermarks"""
+    list_display = ['user', 'conversation', 'last_delivered_message_id', 'last_read_message_id', 'updated_at']
+    search_fields = ['user__username']
+    raw_id_fields = ['user', 'conversation']
+    readonly_fields = ['updated_at']
@@ -1,20 +1,31 @@
-import json
+import time
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth import get_user_model
-from .models import TypingIndicator, ChatRoom, MessageDeliveryStatus, OnlineUser
+from .fanout import CoalescingFanoutMixin
+from .frame_codecs import frame_for
+from .jwt_auth import full_user
+from .models import ChatRoom, MessageDeliveryStatus
+from .presence import get_presence, snapshot_presence_if_due
+from .typing_state import get_typing_state, schedule_typing_broadcast
+from .write_buffer import BufferClosed, get_message_buffer
+from asgiref.sync import sync_to_async
 from users_app.models import Message, Conversation
+from users_app.membership import conversation_member_ids, is_participant
+from users_app.blocking import block_reason
 from django.utils import timezone
+from django.db import DatabaseError
+from chatbox_project.instrumentation import InstrumentedConsumerMixin, label_sample
 
 User = get_user_model()
 
-class ChatConsumer(AsyncWebsocketConsumer):
+class ChatConsumer(InstrumentedConsumerMixin, CoalescingFanoutMixin, AsyncWebsocketConsumer):
     """it manages the funtionality for the websocket, serves
     as the view funtion for the websocket"""
     async def connect(self):
         """this function is called when a client or browser tries to establish 
         a web socket connection with the server"""
-        self.conversation_id = self.scope['url_route'], ['kwargs'], ['conversation_id']
+        self.conversation_id = int(self.scope['url_route']['kwargs']['conversation_id'])
         #extracts the conversation_id from the url route in routing.py
         self.room_group_name = f'chat_{self.conversation_id}'
         self.user = self.scope['user']
@@ -39,18 +50,15 @@ class ChatConsumer(AsyncWebsocketConsumer):
         #mark user to be online
         await self.set_user_online()
         
-        #accept web socket connection
-        await self.accept()
+        #accept web socket connection, clients that asked for the batch subprotocol get it back
+        await self.accept(subprotocol=self.select_fanout())
         
         #notify other clients that the user joined
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type' : 'user_joined',
-                'user_id' : self.user.id,
-                'username' : self.user.username,    
-            }
-        )
+        await self.broadcast(self.room_group_name, {
+            'type' : 'user_joined',
+            'user_id' : self.user.id,
+            'username' : self.user.username,
+        })
     
     async def disconnect(self, close_code):
         """disconnect the connection"""
@@ -63,13 +71,11 @@ class ChatConsumer(AsyncWebsocketConsumer):
         await self.stop_typing_indicator()
         
         #notify the client that the user has left
-        await self.channel_layer.group_send(
-            self.room_group_name, {
-                'type' : 'user_left',
-                'user_id' : self.user.id,
-                'username' : self.user.username,
-            }
-        )
+        await self.broadcast(self.room_group_name, {
+            'type' : 'user_left',
+            'user_id' : self.user.id,
+            'username' : self.user.username,
+        })
         
         #leave group
         await self.channel_layer.group_discard(
@@ -77,14 +83,20 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
         
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """asynchronous operation that handles the receive function - handles all kind of messages"""
         #the text_data is actually the raw data usually in json format parsed by the client to the server
         #so we need to be able to convert the raw data into a python objects so we can be able to access the type. The type will be defined in the front end
-        #that's why we would be using json.loads(text_data)
+        #that's why we would be using decode_frame, json text or the msgpack bytes_data of the socket's codec (chat_app.frame_codecs)
         try:
-            cleaned_data = json.loads(text_data)
+            cleaned_data = self.decode_frame(text_data, bytes_data)
+            if not isinstance(cleaned_data, dict):
+                raise ValueError('frames must be objects')
             message_data_type = cleaned_data.get('type')
+            label_sample(message_data_type) #instrumentation reports receive:<type> per frame type
+            
+            #any frame from the client proves the connection is alive
+            await self.touch_presence()
             
             if message_data_type == 'chat_message': #telling django to check the data type from the frontend side
                 await self.handle_chat_message(cleaned_data)
@@ -94,11 +106,12 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 await self.handle_stop_typing()
             elif message_data_type == 'message_read':
                 await self.handle_message_read(cleaned_data)
-        except json.JSONDecodeError:
-            await self.send(text_data=json.dumps({
+            #'heartbeat' frames need no handler, touch_presence above already refreshed the connection
+        except ValueError:
+            await self.send_event({
                 'type' : 'error',
                 'message' : 'Invalid Json' 
-            }))
+            })
             
     async def handle_chat_message(self, data):
         """handle new chat message"""
@@ -112,67 +125,70 @@ class ChatConsumer(AsyncWebsocketConsumer):
         
         if not message_content.strip(): #strip removes all trailing white spaces, so if after removing all white spaces you have a message content => "". Then it would fail silently, cuz you don't want to send an empty message of white spaces
             return
+        
+        #blocks are checked on every message, not on connect, so a block takes effect on open sockets
+        reason = await self.check_blocked()
+        if reason is not None:
+            await self.send_event({
+                'type' : 'error',
+                'client_id' : data.get('client_id'),
+                'message' : reason,
+            })
+            return
             
         #we have to save  the new message after confirming the message_type
         #message is an instance of Message model cuz save_message returns a created row of message in the database
         message = await self.save_message(message_content, message_types)
+        if message is None:
+            #nothing was saved (database error, server shutting down), the client can send it again
+            await self.send_event({
+                'type' : 'error',
+                'client_id' : data.get('client_id'),
+                'message' : 'the message could not be saved, send it again',
+            })
+            return
         
         #after message has been saved we want to then broadcast the message
         if message: 
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type' : 'chat_message',
-                    'message_id' : message.id,
-                    'message_types' : message_types,
-                    'message' : message_content,
-                    'user_id' : self.user.id,
-                    'username' : self.user.username,
-                    'avatar' : self.user.avatar.url if self.user.avatar else None,
-                    'time_stamp' : message.time_stamp.isoformat(), #this refers to the timestamp designed in your model, isformat changes datetime field to a stringify field, cuz datetime field can not be passed in the websocket
-                }
-            )
+            #the sender gets an ack with the real id, client_id lets the client match it to its pending message
+            await self.send_event({
+                'type' : 'message_ack',
+                'client_id' : data.get('client_id'),
+                'message_id' : message.id,
+                'time_stamp' : message.time_stamp.isoformat(),
+            })
+            #the frame is rendered once here, every socket of the group just forwards it
+            await self.broadcast(self.room_group_name, {
+                'type' : 'chat_message',
+                'message_id' : message.id,
+                'message' : message_content,
+                'message_type' : message_types,
+                'user_id' : self.user.id,
+                'username' : self.user.username,
+                'avartar' : await self.avatar_url(),
+                'timestamp' : message.time_stamp.isoformat(), #this refers to the timestamp designed in your model, isformat changes datetime field to a stringify field, cuz datetime field can not be passed in the websocket
+            })
             
     async def handle_start_typing(self):
         """Handle start typing"""
         #-TRAIN OF THOUGHTS
         #1. We have to show the user who is about sending a message after a ws connection has been initialized
-        #2. set is_typing to be True
-        #3. how can we get is_typing - There should be a typing indicator instance that can access is typing and set it to be True
-        #4. after setting the typing indicator to be true we have to broadcast it to users on the same broadcast channel - channel_name/room_group_name
+        #2. typing state is memory only (chat_app.typing_state), repeated start_typing frames are debounced there
+        #3. we don't group_send per frame, the broadcaster sends one coalesced "who is typing" frame per window
         
-        await self.set_typing_indicator(True) #where set_typing_indicator will be an instance of typing_indicator which will either be created or updated
-        
-        #broadcast to others in the room
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type' : 'typing_indicator',
-                'user_id' : self.user.id,
-                'username' : self.user.username,
-                'is_typing' : True, 
-            }
-        )
+        changed = await self.set_typing_indicator(True)
+        if changed:
+            schedule_typing_broadcast(self.channel_layer, self.conversation_id, self.room_group_name)
         
     async def handle_stop_typing(self):
         """handles when the client stop typing"""
         #-TRAIN OF THOUGHTS
-        #1. We have to set typing indicator to be false
-        #2. access is_typing to be false
-        #3. broadcast to others that you stopped typing
-        
-        await self.set_typing_indicator(False)
+        #1. We have to remove the user from the typing state
+        #2. the coalesced broadcast tells others that you stopped typing
         
-        #notify others that you stopped typing
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type' : 'typing_indicator',
-                'user_id' : self.user.id,
-                'username' : self.user.username,
-                'is_typing' : False,
-            }
-        )
+        changed = await self.set_typing_indicator(False)
+        if changed:
+            schedule_typing_broadcast(self.channel_layer, self.conversation_id, self.room_group_name)
         
     async def handle_message_read(self, data):
         """handles all read messages status"""
@@ -181,82 +197,33 @@ class ChatConsumer(AsyncWebsocketConsumer):
         #2. you have to get the message_id
         #3. broadcast or notify that it has been read
         
-        message_id = await data.get('message_id')
+        message_id = data.get('message_id')
         
         if message_id:
             await self.mark_message_read(message_id)
             
-        #notify that the message has been read
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type' : 'message_read',
-                'message_id' : message_id,
-                'read_by_user_id' : self.user.id,
-                'read_by_username' : self.user.username,
-            }
-        )
+        #notify that the message has been read, the reader's other tabs get it too
+        await self.broadcast(self.room_group_name, {
+            'type' : 'message_read',
+            'message_id' : message_id,
+            'read_by_user_id' : self.user.id,
+            'read_by_username' : self.user.username,
+        }, skip_self=False)
         
     #EVENT HANDLERS FOR THE TYPE, IT TELLS DJANGO WHAT TO DO WHEN IT COMES ACROSS A PARTICULAR TYPE
-    async def chat_message(self, event):
-        """send chat message to each personal websocket connection"""
-        #1. events represents an instance of a message sent over a connection
-        #2. Purpose of this is to ensure when a user sends a message, he doesn't get the same message back
-        
-        if event['user_id'] != self.user.id:
-            #specifies that the user who sent the message is not the same as the user who is receiving it
-            #then it would broadcast it
-            await self.send(text_data=json.dumps({
-               'type' : 'chat_message',
-               'message_id' : event['message_id'],
-               'message' : event['message'],
-               'message_type' : event['message_type'],
-               'user_id' : event['user_id'],
-               'username' : event['username'],
-               'avartar' : event['avartar'],
-               'timestamp' : event['timestamp'], 
-            }))
-    async def typing_indicator(self, event):
-        """send typing indicator to websocket"""
-        #we dont want to send typing indicator back to the sender, so we have to filter that out
-        if event['user_id'] != self.user.id:
-            await self.send(text_data=json.dumps({
-                'type' : 'typing_indicator',
-                'user_id' : event['user_id'],
-                'username' : event['username'],
-                'is_typing' : event['is_typing']
-            }))
-            
-    async def message_read(self, event):
-        """send a message read status to the websocket"""
-        #1. we have to make sure that the user whose message has been read is not also receiving his own read message status
-        #2. we also have to change the status to show that it has been read, especially if its defaulted at false
-        #3. there is a delivery status in message, so we access it by creating an instance of it
-        
-        await self.send(text_data=json.dumps({
-            'type' : 'message_read',
-            'message_id' : event['message_id'],
-            'read_by_user_id' : event['read_by_user_id'],
-            'read_by_username' : event['read_by_username'],
-        }))
-            
-    async def user_joined(self, event):
-        """send user joined notification across the websocket"""
-        if event['user_id'] != self.user.id:
-            await self.send(text_data=json.dumps({
-                'type' : 'user_joined',
-                'user_id' : event['user_id'],
-                'username' : event['username'],
-            }))
-            
-    async def user_left(self, event):
-        """send the user that left over the websocket"""
-        if event['user_id'] != self.user.id:
-            await self.send(text_data=json.dumps({
-                'type' : 'user_left',
-                'user_id' : event['user_id'],
-                'username' : event['username'],
-            }))
+    #chat messages, read receipts, joins and leaves arrive as coalesced 'fanout_batch' events with the
+    #frames already rendered (chat_app.fanout), the sender's own chat messages and joins are left out there
+    async def typing_users(self, event):
+        """send the coalesced list of typing users to websocket, without the receiver in it"""
+        #only the typists themselves need their own frame, everybody else gets the shared one
+        if any(user['user_id'] == self.user.id for user in event['typing_users']):
+            await self.send_event({
+                'type' : 'typing_users',
+                'conversation_id' : event['conversation_id'],
+                'typing_users' : [user for user in event['typing_users'] if user['user_id'] != self.user.id],
+            })
+        else:
+            await self.send_frames([frame_for(event['frames'], self.codec)])
             
     #DATABASE OPERATIONS, SINCE IT'S AN ASYNCHRONOUS OPERATION WE WOULD NEED TO WRAP IT IN A DATA_SYNC_TO_ASYNC DECORATOR
     @database_sync_to_async
@@ -265,76 +232,82 @@ class ChatConsumer(AsyncWebsocketConsumer):
         #1.we have to get the conversation id
         #2. we have to also check if user is in the same room as where the conversation was made
         #3. to get the conversation, we would use the get function to query the database
-        try:
-            conversation = Conversation.objects.get(id=self.conversation_id)
-            return self.user in conversation.participants.all()
-        except Conversation.DoesNotExist:
-            return False
+        #the membership cache answers from a set of ids, or with a single EXISTS query on a miss
+        return is_participant(self.conversation_id, self.user.id)
         
     @database_sync_to_async
-    def save_message(self, content, message_types='text'):
+    def check_blocked(self):
+        """in a conversation of two, why the user can't message the other participant (None if they can).
+        two cache gets (users_app.membership and users_app.blocking) when both entries are cached"""
+        member_ids = conversation_member_ids(self.conversation_id)
+        peer_ids = member_ids - {self.user.id}
+        if len(member_ids) != 2 or len(peer_ids) != 1:
+            return None
+        peer_id, = peer_ids
+        return block_reason(self.user.id, peer_id)
+        
+    async def avatar_url(self):
+        """the user's avatar, a token authenticated socket loads the user row for it once"""
+        user = await full_user(self.user)
+        return user.avatar.url if user.avatar else None
+        
+    async def save_message(self, content, message_types='text'):
         """save the message on the database"""
+        #the conversation was already checked in connect, so the message goes straight to the
+        #write buffer (chat_app.write_buffer) which inserts it with the other pending messages in one bulk_create
         try:
-            conversation = Conversation.objects.get(id=self.conversation_id)
-            message = Message.objects.create(
-                sender=self.user,
-                conversation=conversation,
-                content=content,
-                message_types=message_types,    
-            )
-            return message
-        except Conversation.DoesNotExist:
+            return await get_message_buffer().submit(self.user.id, self.conversation_id, content, message_types)
+        except (DatabaseError, BufferClosed):
             return None
         
+    #PRESENCE, connects and disconnects only touch the presence registry, the online_users table
+    #is written in batches by snapshot_presence_if_due
     @database_sync_to_async
     def set_user_online(self):
         """set user as online"""
-        OnlineUser.objects.update_or_create(
-            user=self.user,
-            defaults={'last_activity' : timezone.now()}
-        )
+        self.last_heartbeat = time.monotonic()
+        became_online = get_presence().connect(self.user.id, self.channel_name)
+        snapshot_presence_if_due()
+        return became_online
     
     @database_sync_to_async    
     def set_user_offline(self):
         """set the user to be offline"""
-        OnlineUser.objects.filter(user=self.user).delete()
+        went_offline = get_presence().disconnect(self.user.id, self.channel_name)
+        snapshot_presence_if_due()
+        return went_offline
+    
+    async def touch_presence(self):
+        """refreshes the connection's heartbeat, at most a few times per presence ttl"""
+        presence = get_presence()
+        if time.monotonic() - getattr(self, 'last_heartbeat', 0) > presence.ttl / 3:
+            self.last_heartbeat = time.monotonic()
+            await database_sync_to_async(presence.heartbeat)(self.user.id, self.channel_name)
         
     
-    @database_sync_to_async
+    #TYPING STATE, kept in chat_app.typing_state instead of the typing_indicator table
+    @sync_to_async
     def set_typing_indicator(self, is_typing):
-        """set the typing indicator"""
+        """set the typing indicator, returns True when the typing users of the conversation changed"""
+        state = get_typing_state()
         if is_typing:
-            TypingIndicator.objects.update_or_create(
-                user=self.user,
-                conversation_id=self.conversation_id,
-                defaults={'is_typing' : True},
-            )
-        else:
-            TypingIndicator.objects.filter(
-                user=self.user,
-                conversation_id=self.conversation_id
-            ).delete()
+            return state.start(self.conversation_id, self.user.id, self.user.username)
+        return state.stop(self.conversation_id, self.user.id)
             
-    @database_sync_to_async
-    def stop_typing_indicator(self, is_typing):
+    async def stop_typing_indicator(self):
         """stop the typing indicator"""
-        TypingIndicator.objects.filter(
-            user=self.user,
-            conversation_id=self.conversation_id
-        ).delete()
+        changed = await self.set_typing_indicator(False)
+        if changed:
+            schedule_typing_broadcast(self.channel_layer, self.conversation_id, self.room_group_name)
         
     @database_sync_to_async
     def mark_message_read(self, message_id):
         """mark the message as read"""
-        #we have to get the message id
-        MessageDeliveryStatus.objects.update_or_create(
-            user=self.user,
-            message_id=message_id,
-            defaults={'delivery_status' : 'read'}
-        )
+        #we have to get the message id, it moves the same read watermark as the REST mark_read
+        return MessageDeliveryStatus.bulk_mark(self.user.id, [message_id], 'read')
         
         
-class NotificationConsumer(AsyncWebsocketConsumer):
+class NotificationConsumer(InstrumentedConsumerMixin, CoalescingFanoutMixin, AsyncWebsocketConsumer):
     """handles the notification logic for websocket"""
     async def connect(self):
         """this function is called each time notification consumer"""
@@ -353,7 +326,7 @@ class NotificationConsumer(AsyncWebsocketConsumer):
             self.notification_group_name,
             self.channel_name
         )
-        await self.accept()
+        await self.accept(subprotocol=self.select_fanout())
         
     async def disconnect(self, code):
         """disconnect the connection"""
@@ -369,17 +342,17 @@ class NotificationConsumer(AsyncWebsocketConsumer):
         #THOUGTH PROCESS - The information  
         #The group name and channel/connection is needed
         #the group_send for the connection
-        #we have to get the message id, and render it in json format
-        await self.send(text_data=json.dumps({
+        #we have to get the message id, and render it with the codec of the socket
+        await self.send_event({
             'type' : 'notification',
             'notification_id' : event['notification_id'],
             'title' : event['title'],
             'message' : event['message'],
             'notification_type' : event['notification_type'],
             'timestamp' : event['timestamp']
-        }))
+        })
         
-class OnlineStatusConsumer(AsyncWebsocketConsumer):
+class OnlineStatusConsumer(InstrumentedConsumerMixin, CoalescingFanoutMixin, AsyncWebsocketConsumer):
     """a websocket consumer that handles online status, it tracks the online status of 
     users"""
     #we have to call the connect funtion - 
@@ -399,37 +372,34 @@ class OnlineStatusConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
         
-        #set user online
-        await self.set_user_online()
+        #set user online, a second tab of an already online user is not announced again
+        became_online = await self.set_user_online()
         
-        await self.accept()
+        await self.accept(subprotocol=self.select_fanout())
         
         #notify others that user is online
-        await self.channel_layer.group_send(
-            self.online_group_name,
-            {
+        if became_online:
+            await self.broadcast(self.online_group_name, {
                 'type' : 'user_online',
                 'user_id' : self.user.id,
                 'username' : self.user.username,
-                
-            }
-        )
+            })
         
     async def disconnect(self, close_code):
         """disconnect the user"""
+        if self.user.is_anonymous:
+            return
         
-        #set user to be offline
-        await self.set_user_offline()
+        #set user to be offline, only announced when the last tab closes
+        went_offline = await self.set_user_offline()
         
         #notify users that has been offline
-        await self.channel_layer.group_send(
-            self.online_group_name,
-            {
+        if went_offline:
+            await self.broadcast(self.online_group_name, {
                 'type' : 'user_offline',
                 'user_id' : self.user.id,
                 'username' :self.user.username,
-            }
-        )
+            })
         
         #leave the group 
         await self.channel_layer.group_discard(
@@ -437,43 +407,25 @@ class OnlineStatusConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
         
-    async def user_online(self, event):
-        """send user online status to websocket"""
-        if event['user_id'] != self.user.id:
-            await self.send(text_data=json.dumps({
-                'type' : 'user_online',
-                'user_id' : event['user_id'],
-                'username' : event['username']
-            }))
-            
-    async def user_offline(self, event):
-        """sends to the websocket connection that the user is offline"""
-        if event['user_id'] != self.user.id:
-            await self.send(text_data=json.dump({
-                'type' : 'user_offline',
-                'user_id' : event['user_id'],
-                'username' : event['username']
-            }))
+    #user_online / user_offline frames arrive as coalesced 'fanout_batch' events (chat_app.fanout)
+    async def receive(self, text_data=None, bytes_data=None):
+        """the client only sends heartbeats on this socket, any frame refreshes the connection"""
+        await database_sync_to_async(get_presence().heartbeat)(self.user.id, self.channel_name)
         
     @database_sync_to_async
     def set_user_online(self):
         """set the user to be online"""
         #THOUGHT PROCESS -
-        #1. we have to update or create the online user to be  online using its flag
-        self.user.is_online = True
-        self.user.save()
-        OnlineUser.objects.update_or_create(
-            user=self.user,
-            defaults={'last_activity' : timezone.now()},
-        )
+        #1. the presence registry keeps a connection per tab, users.is_online and online_users
+        #are updated by the batched snapshot instead of a save() per connect
+        became_online = get_presence().connect(self.user.id, self.channel_name)
+        snapshot_presence_if_due()
+        return became_online
         
     @database_sync_to_async
     def set_user_offline(self):
-        """removes the user from the online user table"""
-        self.user.is_online = False
-        self.user.save()
-        
-        OnlineUser.objects.filter(
-            user=self.user
-        ).delete()
+        """removes the connection from the presence registry"""
+        went_offline = get_presence().disconnect(self.user.id, self.channel_name)
+        snapshot_presence_if_due()
+        return went_offline
         
@@ -0,0 +1,144 @@
+import asyncio
+from django.conf import settings
+from chatbox_project.instrumentation import measure_serialization, record_payload
+from .frame_codecs import encode_frames, frame_for, negotiate
+
+#COALESCING FAN-OUT
+#every broadcast used to be its own group_send of raw fields, so each event was delivered to and handled
+#by every socket of the group, and every socket rebuilt the client frame with its own json.dumps.
+#now the sender renders the frame once and hands it to the GroupFanout of its event loop, which collects
+#the frames of each group for TICK seconds and sends them as a single 'fanout_batch' group event.
+#a burst of messages/receipts/joins is one channel layer delivery per socket instead of one per event.
+#
+#what the client gets is opt-in: plain clients still get one frame per event, clients that connect with
+#a batch subprotocol (chatbox.batch, chatbox.msgpack.batch, see chat_app.frame_codecs) get the whole
+#batch as one array of events (one websocket write per batch). frames are rendered once per codec in use
+#(see chat_app.frame_codecs) and the array is built by joining them, nothing is serialized a second time.
+
+DEFAULTS = {
+    'TICK': 0.02,
+    'MAX_BATCH': 100,
+}
+
+
+def fanout_setting(name):
+    """reads a key from settings.FANOUT, falling back to the defaults above"""
+    return getattr(settings, 'FANOUT', {}).get(name, DEFAULTS[name])
+
+
+def fanout_batch_event(frames):
+    """the group event carrying rendered frames, frames is a list of [{codec name: frame}, skip_user_id]"""
+    return {'type': 'fanout_batch', 'frames': frames}
+
+
+class GroupFanout:
+    """collects the frames published to each group during a tick and sends them with one group_send"""
+    def __init__(self, channel_layer, tick=None, max_batch=None):
+        self.channel_layer = channel_layer
+        self.tick = fanout_setting('TICK') if tick is None else tick
+        self.max_batch = max_batch or fanout_setting('MAX_BATCH')
+        self.pending = {} #group name -> [[{codec name: frame}, skip_user_id], ...]
+        self.tasks = {} #group name -> the task that flushes it
+
+    async def publish(self, group_name, frame, skip_user_id=None):
+        """queues a rendered frame ({codec name: frame}) for the group, skip_user_id's sockets won't get it"""
+        frames = self.pending.setdefault(group_name, [])
+        frames.append([frame, skip_user_id])
+        if len(frames) >= self.max_batch:
+            await self.flush(group_name)
+        elif group_name not in self.tasks:
+            self.tasks[group_name] = asyncio.ensure_future(self.flush_later(group_name))
+
+    async def flush_later(self, group_name):
+        await asyncio.sleep(self.tick)
+        self.tasks.pop(group_name, None)
+        await self.flush(group_name)
+
+    async def flush(self, group_name):
+        """sends what is queued for the group now"""
+        task = self.tasks.pop(group_name, None)
+        if task is not None:
+            task.cancel()
+        frames = self.pending.pop(group_name, None)
+        if frames:
+            await self.channel_layer.group_send(group_name, fanout_batch_event(frames))
+
+
+def broadcast_sync(group_name, payload, skip_user_id=None):
+    """broadcasts from sync code (REST views) to the sockets of a group, in a batch of its own since
+    there is no event loop to coalesce on"""
+    from channels.layers import get_channel_layer
+    from asgiref.sync import async_to_sync
+    with measure_serialization():
+        frames = encode_frames(payload)
+    async_to_sync(get_channel_layer().group_send)(group_name, fanout_batch_event([[frames, skip_user_id]]))
+
+
+_fanouts = {} #one GroupFanout per event loop
+
+
+def get_group_fanout(channel_layer):
+    """returns the GroupFanout of the running event loop"""
+    loop = asyncio.get_running_loop()
+    fanout = _fanouts.get(loop)
+    if fanout is None or fanout.channel_layer is not channel_layer:
+        for old_loop in [old_loop for old_loop in _fanouts if old_loop.is_closed()]:
+            del _fanouts[old_loop]
+        fanout = _fanouts[loop] = GroupFanout(channel_layer)
+    return fanout
+
+
+class CoalescingFanoutMixin:
+    """frame encoding and sending for consumers, call select_fanout() before accept()"""
+    codec = None
+    batch_frames = False
+
+    def select_fanout(self):
+        """picks the codec and batching from the subprotocols the client offered, returns the subprotocol
+        to accept (None for plain clients, the auth subprotocol for clients that sent their token as one)"""
+        subprotocol, self.codec, self.batch_frames = negotiate(self.scope.get('subprotocols'))
+        return subprotocol or self.scope.get('auth_subprotocol')
+
+    def decode_frame(self, text_data=None, bytes_data=None):
+        """decodes an inbound frame, text is always json and bytes use the socket's binary codec.
+        raises ValueError for frames that can't be decoded"""
+        codec = self.codec or negotiate(None)[1]
+        if bytes_data is not None:
+            if not codec.binary:
+                raise ValueError('binary frames need a binary subprotocol')
+            return codec.decode(bytes_data)
+        if codec.binary:
+            codec = negotiate(None)[1]
+        return codec.decode(text_data)
+
+    async def broadcast(self, group_name, payload, skip_self=True):
+        """renders the payload once and publishes it to the group with the next batch"""
+        skip_user_id = self.user.id if skip_self else None
+        with measure_serialization():
+            frames = encode_frames(payload)
+        await get_group_fanout(self.channel_layer).publish(group_name, frames, skip_user_id)
+
+    async def fanout_batch(self, event):
+        """the handler of every coalesced broadcast, leaves out the user's own events"""
+        with measure_serialization():
+            frames = [frame_for(frames, self.codec) for frames, skip_user_id in event['frames'] if skip_user_id != self.user.id]
+        await self.send_frames(frames)
+
+    async def send_event(self, payload):
+        """sends a frame to this socket only (acks, errors)"""
+        with measure_serialization():
+            frame = self.codec.encode(payload)
+        await self.send_frames([frame])
+
+    async def send_frames(self, frames):
+        """one array for batching clients, a frame per event for the others"""
+        if not frames:
+            return
+        if self.batch_frames:
+            frames = [self.codec.join(frames)]
+        for frame in frames:
+            record_payload(len(frame))
+            if self.codec.binary:
+                await self.send(bytes_data=frame)
+            else:
+                await self.send(text_data=frame)
@@ -0,0 +1,146 @@
+import json
+import logging
+import struct
+from functools import lru_cache
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError: #the stdlib json below is used instead, available_codecs logs it
+    orjson = None
+
+try:
+    import msgpack
+except ImportError: #no binary framing without it, clients asking for it get json, available_codecs logs it
+    msgpack = None
+
+#WEBSOCKET CODECS
+#how frames are encoded is picked per connection from the websocket subprotocols the client offers,
+#they look like <PREFIX>.<codec>[.batch]: chatbox.json, chatbox.msgpack, chatbox.msgpack.batch, and
+#chatbox.batch for batched json (see chat_app.fanout). clients that offer nothing we know get json text
+#frames, exactly what they got before codecs existed.
+#json uses orjson and msgpack frames go out as bytes_data, both are in requirements.txt. when one of them is
+#missing the codecs degrade (stdlib json, no msgpack) and say so with a warning at startup.
+#a broadcast is only rendered to json by its sender, the frame every plain client gets. the other codecs
+#are derived from it by frame_for where a socket of that codec receives it, once per process and frame,
+#so a codec nobody is connected with costs nothing.
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'PREFIX': 'chatbox',
+    'ENABLED': ['json', 'msgpack'],
+}
+
+
+def codec_setting(name):
+    """reads a key from settings.WEBSOCKET_CODECS, falling back to the defaults above"""
+    return getattr(settings, 'WEBSOCKET_CODECS', {}).get(name, DEFAULTS[name])
+
+
+class JsonCodec:
+    """json text frames, compact separators so both implementations produce the same text"""
+    name = 'json'
+    binary = False
+
+    def encode(self, payload):
+        return json.dumps(payload, separators=(',', ':'))
+
+    def decode(self, data):
+        return json.loads(data)
+
+    def join(self, frames):
+        """a batch of encoded frames as one json array, without encoding them again"""
+        return '[' + ','.join(frames) + ']'
+
+
+class OrjsonCodec(JsonCodec):
+    """json text frames through orjson"""
+    def encode(self, payload):
+        return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def decode(self, data):
+        return orjson.loads(data)
+
+
+class MsgpackCodec:
+    """MessagePack binary frames"""
+    name = 'msgpack'
+    binary = True
+
+    def encode(self, payload):
+        return msgpack.packb(payload, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+    def join(self, frames):
+        """a msgpack array header followed by the already encoded frames"""
+        count = len(frames)
+        if count < 16:
+            header = bytes([0x90 | count])
+        elif count < 0x10000:
+            header = b'\xdc' + struct.pack('>H', count)
+        else:
+            header = b'\xdd' + struct.pack('>I', count)
+        return header + b''.join(frames)
+
+
+def available_codecs():
+    """{name: codec} of the enabled codecs whose library is installed"""
+    codecs = {'json': OrjsonCodec() if orjson is not None else JsonCodec()}
+    if orjson is None:
+        logger.warning('orjson is not installed, websocket json frames fall back to the stdlib json')
+    if msgpack is not None:
+        codecs['msgpack'] = MsgpackCodec()
+    elif 'msgpack' in codec_setting('ENABLED'):
+        logger.warning('msgpack is not installed, clients asking for msgpack frames get json')
+    return {name: codec for name, codec in codecs.items() if name == 'json' or name in codec_setting('ENABLED')}
+
+
+_codecs = None
+
+
+def get_codecs():
+    """the process wide codecs, json is always there"""
+    global _codecs
+    if _codecs is None:
+        _codecs = available_codecs()
+    return _codecs
+
+
+def encode_frames(payload):
+    """the frames of a broadcast payload, {codec name: frame}, with only the json one rendered"""
+    return {'json': get_codecs()['json'].encode(payload)}
+
+
+def frame_for(frames, codec):
+    """the frame of a broadcast in codec, derived from its json frame the first time this process needs it"""
+    frame = frames.get(codec.name)
+    if frame is None:
+        frame = _derived_frame(codec.name, frames['json'])
+    return frame
+
+
+@lru_cache(maxsize=256)
+def _derived_frame(name, json_frame):
+    #every socket of the group gets the same event, only the first one of the codec pays for the encode
+    codecs = get_codecs()
+    return codecs[name].encode(codecs['json'].decode(json_frame))
+
+
+def negotiate(subprotocols):
+    """picks the first subprotocol we understand, returns (subprotocol to accept or None, codec, batch)"""
+    codecs = get_codecs()
+    prefix = codec_setting('PREFIX') + '.'
+    for subprotocol in subprotocols or ():
+        if not subprotocol.startswith(prefix):
+            continue
+        parts = subprotocol[len(prefix):].split('.')
+        batch = parts[-1] == 'batch'
+        if batch:
+            parts = parts[:-1]
+        name = parts[0] if parts else 'json'
+        if len(parts) <= 1 and name in codecs:
+            return subprotocol, codecs[name], batch
+    return None, codecs['json'], False
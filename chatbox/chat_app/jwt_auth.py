@@ -0,0 +1,150 @@
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs
+from channels.auth import AuthMiddlewareStack
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+#JWT WEBSOCKET AUTHENTICATION
+#sockets authenticate with the same simplejwt access token as the REST API, passed as ?token=<access> or as
+#a subprotocol pair: the client offers SUBPROTOCOL followed by the token (new WebSocket(url, ['chatbox.jwt',
+#access])), both are taken out of scope['subprotocols'] and SUBPROTOCOL is accepted back when no codec
+#subprotocol is picked. verified claims are kept in an LRU of CACHE_SIZE tokens until the token expires, so
+#a reconnect with the same token skips the signature check, and scope['user'] is a ClaimsUser built from
+#the claims: connecting runs no query. the User row is only loaded when something reads an attribute that
+#isn't a claim. tokens issued before the username claim existed cost one query, once per token.
+#like any stateless token, a deactivated user keeps connecting until the access token expires.
+#JWTAuthMiddlewareStack keeps the session middleware underneath, so browser sessions still work.
+
+DEFAULTS = {
+    'QUERY_PARAM': 'token',
+    'SUBPROTOCOL': 'chatbox.jwt',
+    'CACHE_SIZE': 10000,
+}
+
+
+def ws_auth_setting(name):
+    """reads a key from settings.WEBSOCKET_AUTH, falling back to the defaults above"""
+    return getattr(settings, 'WEBSOCKET_AUTH', {}).get(name, DEFAULTS[name])
+
+
+class ClaimsUser(TokenUser):
+    """the user of a token authenticated socket. id and username come from the claims, any other attribute
+    loads the User row the first time it is read, from sync code, or through aget_user() from async code"""
+    _user = None
+
+    def get_user(self):
+        if self._user is None:
+            self._user = get_user_model().objects.get(pk=self.id)
+        return self._user
+
+    async def aget_user(self):
+        if self._user is None:
+            self._user = await get_user_model().objects.aget(pk=self.id)
+        return self._user
+
+    def __getattr__(self, attr):
+        if attr in self.token:
+            return self.token[attr]
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        return getattr(self.get_user(), attr)
+
+
+async def full_user(user):
+    """the User row behind a scope user, a ClaimsUser loads it on the first call"""
+    if isinstance(user, ClaimsUser):
+        return await user.aget_user()
+    return user
+
+
+class ClaimsCache:
+    """LRU of raw access token -> verified claims, entries are dropped once the token expires"""
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, raw_token):
+        with self.lock:
+            claims = self.entries.get(raw_token)
+            if claims is None:
+                return None
+            if claims['exp'] <= time.time():
+                del self.entries[raw_token]
+                return None
+            self.entries.move_to_end(raw_token)
+            return claims
+
+    def set(self, raw_token, claims):
+        with self.lock:
+            self.entries[raw_token] = claims
+            self.entries.move_to_end(raw_token)
+            while len(self.entries) > ws_auth_setting('CACHE_SIZE'):
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+claims_cache = ClaimsCache()
+
+
+def verify_claims(raw_token):
+    """the claims of a valid access token, None when it is invalid or expired"""
+    claims = claims_cache.get(raw_token)
+    if claims is None:
+        try:
+            claims = dict(AccessToken(raw_token).payload)
+        except TokenError:
+            return None
+        claims_cache.set(raw_token, claims)
+    return claims
+
+
+@database_sync_to_async
+def load_username(user_id):
+    return get_user_model().objects.filter(pk=user_id).values_list('username', flat=True).first()
+
+
+def token_from_scope(scope):
+    """(raw token or None, the subprotocols left for the consumer, the auth subprotocol to accept or None)"""
+    subprotocols = list(scope.get('subprotocols') or ())
+    marker = ws_auth_setting('SUBPROTOCOL')
+    if marker in subprotocols:
+        index = subprotocols.index(marker)
+        raw_token = subprotocols[index + 1] if index + 1 < len(subprotocols) else None
+        return raw_token, subprotocols[:index] + subprotocols[index + 2:], marker
+    values = parse_qs(scope.get('query_string', b'').decode('latin1')).get(ws_auth_setting('QUERY_PARAM'))
+    return (values[-1] if values else None), subprotocols, None
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """sets scope['user'] to a ClaimsUser when the connection carries a valid access token, and leaves
+    the user of the inner stack (session or anonymous) otherwise"""
+    async def __call__(self, scope, receive, send):
+        raw_token, subprotocols, auth_subprotocol = token_from_scope(scope)
+        if raw_token is None:
+            return await super().__call__(scope, receive, send)
+        #the token never reaches the consumer, select_fanout accepts auth_subprotocol when it has nothing better
+        scope = dict(scope, subprotocols=subprotocols, auth_subprotocol=auth_subprotocol)
+        claims = verify_claims(raw_token)
+        if claims is not None:
+            if 'username' not in claims:
+                #tokens from before the username claim, looked up once and kept with the claims
+                claims['username'] = await load_username(claims[api_settings.USER_ID_CLAIM])
+            if claims['username'] is not None:
+                scope['user'] = ClaimsUser(claims)
+        return await super().__call__(scope, receive, send)
+
+
+def JWTAuthMiddlewareStack(inner):
+    """token authentication on top of channels' session AuthMiddlewareStack"""
+    return AuthMiddlewareStack(JWTAuthMiddleware(inner))
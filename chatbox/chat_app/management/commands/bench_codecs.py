@@ -0,0 +1,68 @@
+import timeit
+from django.core.management.base import BaseCommand
+from chat_app import frame_codecs
+
+#the frames the consumers actually send and receive
+EVENTS = {
+    'chat_message': {
+        'type': 'chat_message', 'message_id': 1048576, 'message': 'hey, are we still on for tomorrow? 🙂',
+        'message_type': 'text', 'user_id': 4821, 'username': 'adaeze_o', 'avartar': '/media/avatars/adaeze.png',
+        'timestamp': '2024-05-02T18:24:09.512331+00:00',
+    },
+    'message_ack': {
+        'type': 'message_ack', 'client_id': 'c1f4a2', 'message_id': 1048576, 'time_stamp': '2024-05-02T18:24:09.512331+00:00',
+    },
+    'typing_users': {
+        'type': 'typing_users', 'conversation_id': 3310, 'typing_users': [
+            {'user_id': 4821, 'username': 'adaeze_o', 'started_typing': 1714674249.51},
+            {'user_id': 77, 'username': 'tunde', 'started_typing': 1714674250.02},
+            {'user_id': 1203, 'username': 'k.mensah', 'started_typing': 1714674251.77},
+        ],
+    },
+    'user_joined': {'type': 'user_joined', 'user_id': 4821, 'username': 'adaeze_o'},
+    'notification': {
+        'type': 'notification', 'notification_id': 99120, 'title': 'New message', 'message': 'adaeze_o sent you a message',
+        'notification_type': 'message', 'timestamp': '2024-05-02T18:24:09.512331+00:00',
+    },
+    'inbound chat_message': {'type': 'chat_message', 'message': 'on my way', 'message_types': 'text', 'client_id': 'c1f4a3'},
+}
+
+
+class Command(BaseCommand):
+    """encode/decode microbenchmark of the websocket codecs (chat_app.frame_codecs) on real event shapes,
+    stdlib json is always measured as the baseline"""
+    help = 'benchmark websocket frame codecs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=20000, help='operations per measurement')
+        parser.add_argument('--batch', type=int, default=20, help='frames joined into one batched frame')
+
+    def handle(self, *args, **options):
+        codecs = [('json (stdlib)', frame_codecs.JsonCodec())]
+        if frame_codecs.orjson is not None:
+            codecs.append(('json (orjson)', frame_codecs.OrjsonCodec()))
+        if frame_codecs.msgpack is not None:
+            codecs.append(('msgpack', frame_codecs.MsgpackCodec()))
+        else:
+            self.stdout.write('msgpack is not installed, skipping it')
+
+        number = options['number']
+        self.stdout.write(f"{'event':<22} {'codec':<14} {'bytes':>6} {'encode us':>10} {'decode us':>10}")
+        for event_name, payload in EVENTS.items():
+            for codec_name, codec in codecs:
+                frame = codec.encode(payload)
+                size = len(frame if codec.binary else frame.encode())
+                encode = timeit.timeit(lambda: codec.encode(payload), number=number) / number * 1e6
+                decode = timeit.timeit(lambda: codec.decode(frame), number=number) / number * 1e6
+                self.stdout.write(f'{event_name:<22} {codec_name:<14} {size:>6} {encode:>10.2f} {decode:>10.2f}')
+
+        #a batched frame joins frames that are already encoded, decoding it is what the client pays
+        payload = EVENTS['chat_message']
+        for codec_name, codec in codecs:
+            frames = [codec.encode(payload) for _ in range(options['batch'])]
+            joined = codec.join(frames)
+            assert codec.decode(joined) == [codec.decode(frames[0])] * options['batch']
+            join = timeit.timeit(lambda: codec.join(frames), number=number) / number * 1e6
+            decode = timeit.timeit(lambda: codec.decode(joined), number=number // 10) / (number // 10) * 1e6
+            size = len(joined if codec.binary else joined.encode())
+            self.stdout.write(f"{f'batch of {len(frames)}':<22} {codec_name:<14} {size:>6} {join:>10.2f} {decode:>10.2f}")
@@ -0,0 +1,124 @@
+import asyncio
+import json
+import time
+from asgiref.testing import ApplicationCommunicator
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+from chat_app.consumers import ChatConsumer
+from chat_app.fanout import fanout_setting, get_group_fanout
+from chat_app.frame_codecs import codec_setting, encode_frames
+from users_app.models import User, Conversation
+
+
+class PerEventConsumer(ChatConsumer):
+    """what ChatConsumer did before chat_app.fanout, a group event per message and every socket builds
+    and dumps its own frame"""
+    async def chat_message(self, event):
+        if event['user_id'] != self.user.id:
+            await self.send(text_data=json.dumps({
+               'type' : 'chat_message',
+               'message_id' : event['message_id'],
+               'message' : event['message'],
+               'message_type' : event['message_types'],
+               'user_id' : event['user_id'],
+               'username' : event['username'],
+               'avartar' : event['avatar'],
+               'timestamp' : event['time_stamp'],
+            }))
+
+
+class Command(BaseCommand):
+    """websocket fan-out benchmark: one sender bursts chat messages into a conversation with many
+    connected sockets. compares the old group_send per message, the coalesced fan-out for plain clients
+    and the batch subprotocol by websocket writes (one per websocket.send), bytes and cpu time"""
+    help = 'benchmark websocket writes and cpu for per-event and coalesced broadcasts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', type=int, default=200)
+        parser.add_argument('--events', type=int, default=50, help='events per burst, keep it under the channel layer capacity')
+        parser.add_argument('--bursts', type=int, default=5)
+
+    def handle(self, *args, **options):
+        sender, _ = User.objects.get_or_create(username='bench_fanout_sender', defaults={'email': 'bench_fanout_sender@example.com'})
+        receivers = []
+        for n in range(options['sockets']):
+            user, _ = User.objects.get_or_create(username=f'bench_fanout_{n}', defaults={'email': f'bench_fanout_{n}@example.com'})
+            receivers.append(user)
+        conversation = Conversation.objects.create(title='fan-out benchmark', is_group=True)
+        conversation.participants.add(sender, *receivers)
+        try:
+            modes = [
+                ('per-event', PerEventConsumer, []),
+                ('coalesced', ChatConsumer, []),
+                ('batched', ChatConsumer, [f"{codec_setting('PREFIX')}.batch"]),
+            ]
+            results = [(name, asyncio.run(self.run(consumer, subprotocols, conversation, sender, receivers, options))) for name, consumer, subprotocols in modes]
+        finally:
+            conversation.delete()
+
+        self.stdout.write(f"{'mode':<12} {'events':>8} {'writes':>8} {'KiB':>8} {'cpu ms':>8}")
+        for name, (events, writes, size, cpu) in results:
+            self.stdout.write(f'{name:<12} {events:>8} {writes:>8} {size / 1024:>8.0f} {cpu * 1000:>8.1f}')
+
+    async def run(self, consumer, subprotocols, conversation, sender, receivers, options):
+        """connects a socket per receiver, sends the bursts and counts what reaches the sockets"""
+        application = consumer.as_asgi()
+        sockets = []
+        for user in receivers:
+            socket = ApplicationCommunicator(application, {
+                'type': 'websocket',
+                'path': f'/ws/chat/{conversation.id}/',
+                'url_route': {'args': (), 'kwargs': {'conversation_id': str(conversation.id)}},
+                'user': user,
+                'subprotocols': subprotocols,
+                'headers': [],
+            })
+            await socket.send_input({'type': 'websocket.connect'})
+            assert (await socket.receive_output(5))['type'] == 'websocket.accept'
+            sockets.append(socket)
+        await self.drain(sockets)
+
+        layer = get_channel_layer()
+        group_name = f'chat_{conversation.id}'
+        events = writes = size = 0
+        cpu = 0.0
+        for burst in range(options['bursts']):
+            started = time.process_time()
+            for n in range(options['events']):
+                #the fields ChatConsumer.handle_chat_message broadcast before and after the fan-out layer
+                if consumer is PerEventConsumer:
+                    await layer.group_send(group_name, {
+                        'type': 'chat_message', 'message_id': n, 'message_types': 'text', 'message': f'burst {burst} message {n}',
+                        'user_id': sender.id, 'username': sender.username, 'avatar': None, 'time_stamp': '2024-01-01T00:00:00+00:00',
+                    })
+                else:
+                    await get_group_fanout(layer).publish(group_name, encode_frames({
+                        'type': 'chat_message', 'message_id': n, 'message': f'burst {burst} message {n}', 'message_type': 'text',
+                        'user_id': sender.id, 'username': sender.username, 'avartar': None, 'timestamp': '2024-01-01T00:00:00+00:00',
+                    }), sender.id)
+            frames = await self.drain(sockets)
+            cpu += time.process_time() - started
+            writes += len(frames)
+            size += sum(len(frame) for frame in frames)
+            events += sum(len(parsed) if isinstance(parsed, list) else 1 for parsed in map(json.loads, frames))
+
+        for socket in sockets:
+            await socket.send_input({'type': 'websocket.disconnect', 'code': 1000})
+            await socket.wait(5)
+        return events, writes, size, cpu
+
+    async def drain(self, sockets):
+        """waits until the sockets stopped sending and returns every text frame they sent"""
+        frames = []
+        quiet_rounds = 0
+        while quiet_rounds < 3:
+            await asyncio.sleep(fanout_setting('TICK') * 2)
+            received = 0
+            for socket in sockets:
+                while not socket.output_queue.empty():
+                    message = socket.output_queue.get_nowait()
+                    if message['type'] == 'websocket.send':
+                        frames.append(message['text'])
+                        received += 1
+            quiet_rounds = 0 if received else quiet_rounds + 1
+        return frames
@@ -0,0 +1,64 @@
+import asyncio
+import time
+from channels.db import database_sync_to_async
+from django.core.management.base import BaseCommand
+from chat_app.write_buffer import MessageWriteBuffer
+from users_app.models import User, Conversation, Message
+
+
+class Command(BaseCommand):
+    """load benchmark for chat message inserts: one Message.objects.create per frame (what
+    ChatConsumer.save_message used to do) against the batched write buffer"""
+    help = 'benchmark messages per second for per-row inserts versus the write-behind buffer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=5000)
+        parser.add_argument('--concurrency', type=int, default=200, help='simulated sockets sending at once')
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--max-delay', type=float, default=0.01)
+
+    def handle(self, *args, **options):
+        sender, _ = User.objects.get_or_create(
+            username='bench_sender', defaults={'email': 'bench_sender@example.com'}
+        )
+        conversation = Conversation.objects.create(title='write benchmark')
+        conversation.participants.add(sender)
+        try:
+            per_row = asyncio.run(self.run(self.per_row_sender(sender, conversation), options))
+            buffer = MessageWriteBuffer(options['batch_size'], options['max_delay'])
+            batched = asyncio.run(self.run(self.buffered_sender(buffer, sender, conversation), options))
+        finally:
+            conversation.delete()
+
+        self.stdout.write(f"{'mode':<10} {'msg/s':>10}")
+        self.stdout.write(f"{'per-row':<10} {per_row:>10.0f}")
+        self.stdout.write(f"{'batched':<10} {batched:>10.0f}")
+        self.stdout.write(f"speedup: {batched / per_row:.1f}x")
+
+    def per_row_sender(self, sender, conversation):
+        """the old save_message, a conversation lookup and an insert per message"""
+        @database_sync_to_async
+        def send(n):
+            Conversation.objects.get(id=conversation.id)
+            return Message.objects.create(sender=sender, conversation=conversation, content=f'message {n}')
+        return send
+
+    def buffered_sender(self, buffer, sender, conversation):
+        """the current save_message, every message goes through the write buffer"""
+        async def send(n):
+            return await buffer.submit(sender.id, conversation.id, f'message {n}')
+        return send
+
+    async def run(self, send, options):
+        """sends --messages messages from --concurrency tasks and returns messages per second"""
+        total, concurrency = options['messages'], options['concurrency']
+        counter = iter(range(total))
+
+        async def socket():
+            for n in counter:
+                message = await send(n)
+                assert message.pk is not None
+
+        started = time.perf_counter()
+        await asyncio.gather(*(socket() for _ in range(concurrency)))
+        return total / (time.perf_counter() - started)
@@ -0,0 +1,71 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Exists, OuterRef
+from chat_app.models import ConversationReadState, MessageDeliveryStatus
+from users_app.models import User, Conversation, Message
+
+
+class Command(BaseCommand):
+    """compares per-message receipt rows (message_delivery) with per-conversation watermarks
+    (conversation_read_state) for a group chat where every member reads every message"""
+    help = 'benchmark storage and latency of read receipts versus read watermarks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=200)
+        parser.add_argument('--messages', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        members, total = options['members'], options['messages']
+        users = [
+            User.objects.get_or_create(username=f'bench_member_{n}', defaults={'email': f'bench_member_{n}@example.com'})[0]
+            for n in range(members)
+        ]
+        conversation = Conversation.objects.create(title='receipts benchmark', is_group=True)
+        conversation.participants.add(*users)
+        Message.objects.bulk_create([
+            Message(sender=users[n % members], conversation=conversation, content=f'message {n}') for n in range(total)
+        ], batch_size=5000)
+        message_ids = list(conversation.messages.order_by('id').values_list('id', flat=True))
+        reader = users[0]
+
+        try:
+            #per-message rows, what mark_read used to store
+            started = time.perf_counter()
+            for user in users:
+                MessageDeliveryStatus.objects.bulk_create([
+                    MessageDeliveryStatus(message_id=message_id, user=user, delivery_status='read') for message_id in message_ids
+                ], batch_size=5000)
+            rows_write = time.perf_counter() - started
+            rows_count = MessageDeliveryStatus.objects.filter(message__conversation=conversation).count()
+            started = time.perf_counter()
+            Message.objects.filter(conversation=conversation).exclude(sender=reader).exclude(
+                Exists(MessageDeliveryStatus.objects.filter(message=OuterRef('pk'), user=reader, delivery_status='read'))
+            ).count()
+            rows_unread = time.perf_counter() - started
+
+            #watermarks
+            started = time.perf_counter()
+            for user in users:
+                ConversationReadState.advance(user.id, message_ids, 'read')
+            marks_write = time.perf_counter() - started
+            marks_count = ConversationReadState.objects.filter(conversation=conversation).count()
+            started = time.perf_counter()
+            ConversationReadState.unread_counts(reader.id, [conversation.id])
+            marks_unread = time.perf_counter() - started
+
+            self.stdout.write(f"{'':<22} {'receipt rows':>14} {'watermarks':>14}")
+            self.stdout.write(f"{'rows stored':<22} {rows_count:>14} {marks_count:>14}")
+            self.stdout.write(f"{'table size (bytes)':<22} {self.table_size(MessageDeliveryStatus):>14} {self.table_size(ConversationReadState):>14}")
+            self.stdout.write(f"{'mark all read (ms)':<22} {rows_write * 1000:>14.1f} {marks_write * 1000:>14.1f}")
+            self.stdout.write(f"{'unread count (ms)':<22} {rows_unread * 1000:>14.2f} {marks_unread * 1000:>14.2f}")
+        finally:
+            conversation.delete()
+
+    def table_size(self, model):
+        """pg_total_relation_size on postgres, '-' elsewhere"""
+        if connection.vendor != 'postgresql':
+            return '-'
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_total_relation_size(%s)', [model._meta.db_table])
+            return cursor.fetchone()[0]
@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, Max, Q, Value
+from django.db.models.functions import Greatest
+from chat_app.models import ConversationReadState, MessageDeliveryStatus
+
+
+class Command(BaseCommand):
+    """folds the per-message message_delivery rows into one ConversationReadState watermark per
+    (user, conversation). the highest read/delivered message becomes the watermark, so a message that was
+    skipped below it counts as read afterwards. rows are processed by user id range, a chunk per transaction"""
+    help = 'collapse message_delivery rows into conversation read watermarks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='users per chunk')
+        parser.add_argument('--delete', action='store_true', help='delete the collapsed message_delivery rows')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        user_ids = list(
+            MessageDeliveryStatus.objects.order_by('user_id').values_list('user_id', flat=True).distinct()
+        )
+        collapsed = 0
+        for start in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[start:start + chunk_size]
+            with transaction.atomic():
+                collapsed += self.collapse(chunk, options['delete'])
+            self.stdout.write(f'{min(start + chunk_size, len(user_ids))}/{len(user_ids)} users, {collapsed} watermarks')
+        self.stdout.write(self.style.SUCCESS(f'done, {collapsed} watermarks'))
+
+    def collapse(self, user_ids, delete):
+        rows = MessageDeliveryStatus.objects.filter(user_id__in=user_ids).values(
+            'user_id', 'message__conversation_id'
+        ).annotate(
+            read=Max('message_id', filter=Q(delivery_status='read')),
+            delivered=Max('message_id', filter=Q(delivery_status__in=['delivered', 'read'])),
+        ).order_by()
+
+        watermarks = [row for row in rows if row['delivered']]
+        ConversationReadState.objects.bulk_create([
+            ConversationReadState(user_id=row['user_id'], conversation_id=row['message__conversation_id'])
+            for row in watermarks
+        ], ignore_conflicts=True, batch_size=1000)
+        for row in watermarks:
+            #Greatest keeps watermarks that live traffic already moved past the old rows
+            ConversationReadState.objects.filter(
+                user_id=row['user_id'], conversation_id=row['message__conversation_id']
+            ).update(
+                last_read_message_id=Greatest(F('last_read_message_id'), Value(row['read'] or 0)),
+                last_delivered_message_id=Greatest(F('last_delivered_message_id'), Value(row['delivered'])),
+            )
+        if delete:
+            MessageDeliveryStatus.objects.filter(user_id__in=user_ids).delete()
+        return len(watermarks)
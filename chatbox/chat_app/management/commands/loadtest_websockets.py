@@ -0,0 +1,347 @@
+import asyncio
+import json
+import random
+import subprocess
+import time
+from asgiref.testing import ApplicationCommunicator
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings, setup_databases, teardown_databases
+from chat_app.frame_codecs import negotiate
+from chat_app.jwt_auth import claims_cache, ws_auth_setting
+from chat_app.presence import reset_presence
+from chat_app.typing_state import reset_typing_state
+from users_app.models import User, Conversation
+from users_app.serializers import ChatboxTokenObtainPairSerializer
+
+#the in-process stand-ins for redis, so a run only measures the application and the database
+LOADTEST_SETTINGS = {
+    'CHANNEL_LAYERS': {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer', 'CONFIG': {'capacity': 1000}}},
+    'CACHES': {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'loadtest'}},
+    'PASSWORD_HASHERS': ['django.contrib.auth.hashers.MD5PasswordHasher'],
+}
+
+#presence keeps the project's settings but lives in the locmem cache above, the redis backend needs a RedisCache
+LOADTEST_PRESENCE_BACKEND = 'chat_app.presence.CachePresenceBackend'
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def summary_ms(values):
+    """p50/p99/max of a list of seconds, in milliseconds"""
+    if not values:
+        return {'p50': None, 'p99': None, 'max': None}
+    return {
+        'p50': round(percentile(values, 0.5) * 1000, 2),
+        'p99': round(percentile(values, 0.99) * 1000, 2),
+        'max': round(max(values) * 1000, 2),
+    }
+
+
+class QueryCounter:
+    """counts the queries of every database connection, including the ones opened by the
+    database_sync_to_async thread while the test runs"""
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+class SimulatedClient:
+    """one browser tab on ws/chat/<id>/, going through the full ASGI stack (origin check, session or token
+    auth, routing). credential is a session key with --auth session and an access token with --auth jwt"""
+    def __init__(self, run, index, user, credential, conversation_id):
+        self.run = run
+        self.index = index
+        self.user = user
+        self.conversation_id = conversation_id
+        headers = [(b'origin', run.origin.encode())]
+        subprotocols = list(run.subprotocols)
+        if run.options['auth'] == 'jwt':
+            subprotocols += [ws_auth_setting('SUBPROTOCOL'), credential]
+        else:
+            headers.append((b'cookie', f'{settings.SESSION_COOKIE_NAME}={credential}'.encode()))
+        self.socket = ApplicationCommunicator(run.application, {
+            'type': 'websocket',
+            'path': f'/ws/chat/{conversation_id}/',
+            'raw_path': f'/ws/chat/{conversation_id}/'.encode(),
+            'query_string': b'',
+            'headers': headers,
+            'subprotocols': subprotocols,
+            'client': ('127.0.0.1', 10000 + index),
+            'server': ('127.0.0.1', 8000),
+        })
+        self.last_message_id = None
+        self.reader = None
+        self.codec = None
+
+    async def connect(self):
+        started = time.perf_counter()
+        await self.socket.send_input({'type': 'websocket.connect'})
+        message = await self.socket.receive_output(self.run.options['timeout'])
+        if message['type'] != 'websocket.accept':
+            raise RuntimeError(f'client {self.index} was refused: {message}')
+        #frames come in the codec of the subprotocol the server accepted, json when it accepted none of ours
+        accepted = message.get('subprotocol')
+        self.codec = negotiate([accepted] if accepted else None)[1]
+        self.run.connect_latencies.append(time.perf_counter() - started)
+        self.reader = asyncio.ensure_future(self.read())
+
+    async def read(self):
+        """records every frame the server pushes to this socket, a batch is a list of frames"""
+        while True:
+            message = await self.socket.output_queue.get()
+            if message['type'] != 'websocket.send':
+                continue
+            received_at = time.perf_counter()
+            if message.get('bytes') is not None:
+                frames = self.codec.decode(message['bytes'])
+            else:
+                frames = negotiate(None)[1].decode(message['text'])
+            for frame in frames if isinstance(frames, list) else [frames]:
+                self.run.record(self, frame, received_at)
+
+    async def send(self, frame):
+        await self.socket.send_input({'type': 'websocket.receive', 'text': json.dumps(frame)})
+
+    async def chat(self):
+        """the conversation loop: type, send, stop typing, mark the last received message read"""
+        await asyncio.sleep(random.random() * self.run.options['interval'])
+        for n in range(self.run.options['messages']):
+            token = f'{self.index}:{n}'
+            await self.send({'type': 'start_typing'})
+            self.run.sent_at[token] = time.perf_counter()
+            await self.send({'type': 'chat_message', 'message': f'loadtest {token}', 'client_id': token})
+            self.run.messages_sent += 1
+            await self.send({'type': 'stop_typing'})
+            if self.last_message_id:
+                await self.send({'type': 'message_read', 'message_id': self.last_message_id})
+            await asyncio.sleep(self.run.options['interval'])
+
+    async def disconnect(self):
+        await self.socket.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        try:
+            await self.socket.wait(self.run.options['timeout'])
+        finally:
+            if self.reader is not None:
+                self.reader.cancel()
+
+
+class LoadTestRun:
+    """the state shared by the simulated clients of one run"""
+    def __init__(self, application, options, origin):
+        self.application = application
+        self.options = options
+        self.origin = origin
+        self.subprotocols = [options['subprotocol']] if options['subprotocol'] else []
+        self.connect_latencies = []
+        self.delivery_latencies = []
+        self.ack_latencies = []
+        self.sent_at = {}
+        self.messages_sent = 0
+        self.deliveries = 0
+        self.errors = 0
+        self.expected_deliveries = 0
+
+    def record(self, client, frame, received_at):
+        kind = frame.get('type')
+        if kind == 'chat_message' and frame.get('message', '').startswith('loadtest '):
+            token = frame['message'][len('loadtest '):]
+            self.deliveries += 1
+            self.delivery_latencies.append(received_at - self.sent_at[token])
+            client.last_message_id = frame['message_id']
+        elif kind == 'message_ack':
+            self.ack_latencies.append(received_at - self.sent_at[frame['client_id']])
+        elif kind == 'error':
+            self.errors += 1
+
+
+class Command(BaseCommand):
+    """websocket load test of chatbox_project.asgi.application. it creates a throwaway test database,
+    swaps redis for the in-memory channel layer and locmem cache, seeds users and conversations and then
+    drives --clients simulated ChatConsumer clients in this process: connect, then per message
+    start_typing / chat_message / stop_typing / message_read.
+    reports connect latency, message ack and delivery latency (p50/p99), throughput and database queries,
+    --output writes the results as json and --compare prints the difference to an earlier result file"""
+    help = 'load test the websocket application with simulated chat clients'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=1000)
+        parser.add_argument('--room-size', type=int, default=10, help='clients per conversation')
+        parser.add_argument('--messages', type=int, default=5, help='messages sent by every client')
+        parser.add_argument('--interval', type=float, default=1.0, help='seconds between the messages of a client')
+        parser.add_argument('--auth', choices=['session', 'jwt'], default='session', help='session cookies or access tokens')
+        parser.add_argument('--subprotocol', default='', help='websocket subprotocol to offer, e.g. chatbox.batch or chatbox.msgpack.batch')
+        parser.add_argument('--timeout', type=float, default=30.0, help='seconds to wait for connects and deliveries')
+        parser.add_argument('--seed', type=int, default=0, help='random seed, so runs are comparable')
+        parser.add_argument('--keepdb', action='store_true', help='reuse the test database between runs')
+        parser.add_argument('--output', help='write the results to this json file')
+        parser.add_argument('--compare', help='an earlier --output file to compare against')
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        presence = {**getattr(settings, 'PRESENCE', {}), 'BACKEND': LOADTEST_PRESENCE_BACKEND, 'CACHE_ALIAS': 'default'}
+        with override_settings(**LOADTEST_SETTINGS, PRESENCE=presence):
+            reset_presence()
+            reset_typing_state()
+            claims_cache.clear() #every run starts with unverified tokens
+            old_config = setup_databases(verbosity=0, interactive=False, keepdb=options['keepdb'])
+            try:
+                results = self.run(options)
+            finally:
+                teardown_databases(old_config, verbosity=0, keepdb=options['keepdb'])
+                reset_presence()
+                reset_typing_state()
+
+        self.report(results)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+        if options['compare']:
+            with open(options['compare']) as baseline:
+                self.compare(json.load(baseline), results)
+
+    def run(self, options):
+        from chatbox_project.asgi import application
+
+        users, credentials, conversations = self.seed(options)
+        host = next((host.lstrip('.') for host in settings.ALLOWED_HOSTS if host != '*'), 'localhost')
+        run = LoadTestRun(application, options, f'http://{host}')
+        clients = [
+            SimulatedClient(run, index, user, credentials[user.id], conversations[index // options['room_size']])
+            for index, user in enumerate(users)
+        ]
+        #every other member of the room gets each message
+        for conversation_id in set(conversations):
+            members = sum(1 for client in clients if client.conversation_id == conversation_id)
+            run.expected_deliveries += members * (members - 1) * options['messages']
+
+        counter = QueryCounter()
+        counter.install(connection)
+        connection_created.connect(counter.install)
+        try:
+            return asyncio.run(self.drive(run, clients, counter))
+        finally:
+            connection_created.disconnect(counter.install)
+            if counter in connection.execute_wrappers:
+                connection.execute_wrappers.remove(counter)
+
+    async def drive(self, run, clients, counter):
+        options = run.options
+        started = time.perf_counter()
+        await asyncio.gather(*(client.connect() for client in clients))
+        connect_seconds = time.perf_counter() - started
+        connect_queries = counter.count
+        await asyncio.sleep(0.5) #let the join broadcasts settle before measuring messages
+
+        queries_before = counter.count
+        started = time.perf_counter()
+        await asyncio.gather(*(client.chat() for client in clients))
+        deadline = time.perf_counter() + options['timeout']
+        while run.deliveries < run.expected_deliveries and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        chat_seconds = time.perf_counter() - started
+        chat_queries = counter.count - queries_before
+
+        for client in clients:
+            await client.disconnect()
+
+        return {
+            'commit': self.commit(),
+            'params': {name: options[name] for name in ('clients', 'room_size', 'messages', 'interval', 'auth', 'subprotocol', 'seed')},
+            'database': connection.vendor,
+            'connect_ms': summary_ms(run.connect_latencies),
+            'connects_per_second': round(len(clients) / connect_seconds, 1),
+            'queries_per_connect': round(connect_queries / len(clients), 2),
+            'ack_ms': summary_ms(run.ack_latencies),
+            'delivery_ms': summary_ms(run.delivery_latencies),
+            'messages_sent': run.messages_sent,
+            'deliveries': run.deliveries,
+            'expected_deliveries': run.expected_deliveries,
+            'messages_per_second': round(run.messages_sent / chat_seconds, 1),
+            'deliveries_per_second': round(run.deliveries / chat_seconds, 1),
+            #everything the chat loop causes (typing, receipts, presence) divided by the messages sent
+            'queries_per_message': round(chat_queries / max(run.messages_sent, 1), 2),
+            'errors': run.errors,
+        }
+
+    def seed(self, options):
+        """creates the users, a logged in session or an access token for each and the conversations they chat in"""
+        total, room_size = options['clients'], options['room_size']
+        prefix = f'loadtest_{int(time.time())}'
+        with transaction.atomic():
+            users = User.objects.bulk_create([
+                User(username=f'{prefix}_{n}', email=f'{prefix}_{n}@example.com', password='!') for n in range(total)
+            ])
+            if users and users[0].pk is None: #databases that don't return ids from bulk_create
+                users = list(User.objects.filter(username__startswith=f'{prefix}_').order_by('id'))
+            credentials = {}
+            for user in users:
+                if options['auth'] == 'jwt':
+                    credentials[user.id] = str(ChatboxTokenObtainPairSerializer.get_token(user).access_token)
+                    continue
+                session = SessionStore()
+                session[SESSION_KEY] = str(user.pk)
+                session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+                session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+                session.create()
+                credentials[user.id] = session.session_key
+            conversations = []
+            for start in range(0, total, room_size):
+                conversation = Conversation.objects.create(title=f'{prefix} room {start // room_size}', is_group=True)
+                conversation.participants.add(*users[start:start + room_size])
+                conversations.append(conversation.id)
+        return users, credentials, conversations
+
+    def commit(self):
+        try:
+            return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def report(self, results):
+        self.stdout.write(f"commit {results['commit']} on {results['database']}, {results['params']}")
+        self.stdout.write(f"connect   {results['connect_ms']} ms, {results['connects_per_second']}/s, {results['queries_per_connect']} queries each")
+        self.stdout.write(f"ack       {results['ack_ms']} ms")
+        self.stdout.write(f"delivery  {results['delivery_ms']} ms")
+        self.stdout.write(
+            f"messages  {results['messages_sent']} sent ({results['messages_per_second']}/s), "
+            f"{results['deliveries']}/{results['expected_deliveries']} delivered ({results['deliveries_per_second']}/s), "
+            f"{results['queries_per_message']} queries per message, {results['errors']} errors"
+        )
+
+    def compare(self, baseline, results):
+        """prints every number that moved between the baseline and this run"""
+        self.stdout.write(f"compared to {baseline.get('commit')}:")
+        rows = [
+            ('connect p99 ms', baseline['connect_ms']['p99'], results['connect_ms']['p99']),
+            ('delivery p50 ms', baseline['delivery_ms']['p50'], results['delivery_ms']['p50']),
+            ('delivery p99 ms', baseline['delivery_ms']['p99'], results['delivery_ms']['p99']),
+            ('messages/s', baseline['messages_per_second'], results['messages_per_second']),
+            ('deliveries/s', baseline['deliveries_per_second'], results['deliveries_per_second']),
+            ('queries/connect', baseline['queries_per_connect'], results['queries_per_connect']),
+            ('queries/message', baseline['queries_per_message'], results['queries_per_message']),
+        ]
+        if baseline['params'] != results['params']:
+            self.stdout.write(self.style.WARNING(f"different parameters: {baseline['params']}"))
+        for name, before, after in rows:
+            if before in (None, 0) or after is None:
+                change = ''
+            else:
+                change = f'{(after - before) / before * 100:+.1f}%'
+            self.stdout.write(f'{name:<18} {before!s:>10} {after!s:>10} {change:>8}')
@@ -0,0 +1,20 @@
+import time
+from django.core.management.base import BaseCommand
+from chat_app.presence import snapshot_presence
+
+
+class Command(BaseCommand):
+    """writes the shared presence registry to the online_users table, meant to run from cron
+    or as a small sidecar process when the cache presence backend is used"""
+    help = 'snapshot the presence registry to postgres'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--every', type=int, default=0, help='keep running and snapshot every N seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            online_count = snapshot_presence()
+            self.stdout.write(f'{online_count} users online')
+            if not options['every']:
+                break
+            time.sleep(options['every'])
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.7 on 2026-10-18 14:58
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users_app', '0003_conversation_summary'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat_app', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationReadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_delivered_message_id', models.BigIntegerField(default=0)),
+                ('last_read_message_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='users_app.conversation')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'conversation_read_state',
+                'indexes': [models.Index(fields=['conversation', 'last_delivered_message_id'], name='conversatio_convers_f3bb31_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='conversationreadstate',
+            constraint=models.UniqueConstraint(fields=('user', 'conversation'), name='unique_user_conversation_read_state'),
+        ),
+    ]
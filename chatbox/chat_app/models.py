@@ -1,4 +1,6 @@
 from django.db import models
+from django.db.models import Count, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 from users_app.models import Conversation
@@ -27,6 +29,13 @@ class ChatRoom(models.Model):
     def __str__(self):
         return f'Room: {self.name}'
     
+    @classmethod
+    def with_online_counts(cls, queryset=None):
+        """annotates online_users_count (the online_users rows in each room) in the same query as the rooms,
+        instead of a COUNT per room"""
+        queryset = cls.objects.all() if queryset is None else queryset
+        return queryset.annotate(online_users_count=Count('onlineuser'))
+    
 
 
 class OnlineUser(models.Model):
@@ -99,4 +108,128 @@ class MessageDeliveryStatus(models.Model):
         #there would be no need to create another record of message read, when message sent has already being recorded, it would just update on the database 
        
     def __str__(self):
-        return f"message {self.message.id} - {self.delivery_status} - by {self.user.username}" 
\ No newline at end of file
+        return f"message {self.message.id} - {self.delivery_status} - by {self.user.username}"
+    
+    @classmethod
+    def bulk_mark(cls, user_id, message_ids, delivery_status, chunk_size=None):
+        """marks many messages of one user as delivered/read and returns how many changed.
+        statuses are no longer stored per message, this moves the user's ConversationReadState watermarks"""
+        return ConversationReadState.advance(user_id, message_ids, delivery_status, chunk_size)
+
+
+class ConversationReadState(models.Model):
+    """the read/delivered watermark of a user in a conversation: every message with an id up to
+    last_read_message_id is read, up to last_delivered_message_id is delivered. it replaces one
+    MessageDeliveryStatus row per (message, user) with one row per (user, conversation)"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_states')
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='read_states')
+    last_delivered_message_id = models.BigIntegerField(default=0) #always >= last_read_message_id
+    last_read_message_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    BULK_CHUNK_SIZE = 1000
+    
+    class Meta:
+        """extra information"""
+        db_table = 'conversation_read_state'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'conversation'], name='unique_user_conversation_read_state')
+        ]
+        indexes = [
+            #"seen by" lists: who in this conversation got past a given message
+            models.Index(fields=['conversation', 'last_delivered_message_id']),
+        ]
+        
+    def __str__(self):
+        return f"{self.user_id} read {self.conversation_id} up to {self.last_read_message_id}"
+    
+    def status_of(self, message_id):
+        """the delivery status this watermark gives a message, None when it is not delivered yet"""
+        if message_id <= self.last_read_message_id:
+            return 'read'
+        if message_id <= self.last_delivered_message_id:
+            return 'delivered'
+        return None
+    
+    @classmethod
+    def advance(cls, user_id, message_ids, delivery_status, chunk_size=None):
+        """moves the user's watermarks up to the highest given message of each conversation and returns
+        how many of the given messages changed status. the UPDATE only matches watermarks below the new
+        value, so statuses never move backwards even with concurrent requests. ids of messages the user
+        can't see (not in one of their conversations, or missing) are skipped"""
+        from users_app.membership import user_conversation_ids
+        
+        if delivery_status == 'sent':
+            return 0 #anything above the watermarks is 'sent' already
+        read = delivery_status == 'read'
+        chunk_size = chunk_size or cls.BULK_CHUNK_SIZE
+        message_ids = sorted(set(message_ids))
+        conversation_ids = user_conversation_ids(user_id)
+        
+        changed = 0
+        read_conversation_ids = set()
+        for start in range(0, len(message_ids), chunk_size):
+            by_conversation = {}
+            for message_id, conversation_id in Message.objects.filter(
+                id__in=message_ids[start:start + chunk_size],
+                conversation_id__in=conversation_ids,
+            ).values_list('id', 'conversation_id'):
+                by_conversation.setdefault(conversation_id, []).append(message_id)
+            if not by_conversation:
+                continue
+            
+            states = {state.conversation_id: state for state in cls.objects.filter(user_id=user_id, conversation_id__in=by_conversation)}
+            cls.objects.bulk_create(
+                [cls(user_id=user_id, conversation_id=conversation_id) for conversation_id in by_conversation if conversation_id not in states],
+                ignore_conflicts=True,
+            )
+            for conversation_id, ids in by_conversation.items():
+                state = states.get(conversation_id)
+                old = 0 if state is None else (state.last_read_message_id if read else state.last_delivered_message_id)
+                new = max(ids)
+                if new <= old:
+                    continue
+                changed += sum(1 for message_id in ids if message_id > old)
+                if read:
+                    read_conversation_ids.add(conversation_id)
+                    cls.objects.filter(user_id=user_id, conversation_id=conversation_id, last_read_message_id__lt=new).update(
+                        last_read_message_id=new,
+                        last_delivered_message_id=Greatest(F('last_delivered_message_id'), Value(new)),
+                        updated_at=timezone.now(),
+                    )
+                else:
+                    cls.objects.filter(user_id=user_id, conversation_id=conversation_id, last_delivered_message_id__lt=new).update(
+                        last_delivered_message_id=new,
+                        updated_at=timezone.now(),
+                    )
+        if read_conversation_ids:
+            #reading is rare next to sending, so the badge is recounted exactly instead of decremented
+            from notifications.models import UnreadCounter
+            UnreadCounter.recount_conversations(user_id, read_conversation_ids)
+        return changed
+    
+    @classmethod
+    def seen_by(cls, message):
+        """who got the message, as unsaved MessageDeliveryStatus objects so the old serializer still works"""
+        states = cls.objects.filter(
+            conversation_id=message.conversation_id,
+            last_delivered_message_id__gte=message.id,
+        ).select_related('user')
+        return [
+            MessageDeliveryStatus(message=message, user=state.user, delivery_status=state.status_of(message.id), timestamp=state.updated_at)
+            for state in states
+        ]
+    
+    @classmethod
+    def unread_counts(cls, user_id, conversation_ids):
+        """{conversation_id: unread messages} for the user, a single grouped COUNT over the messages above the watermark"""
+        watermark = cls.objects.filter(
+            user_id=user_id, conversation_id=OuterRef('conversation_id')
+        ).values('last_read_message_id')[:1]
+        rows = Message.objects.filter(
+            conversation_id__in=conversation_ids,
+            id__gt=Coalesce(Subquery(watermark), Value(0)),
+        ).exclude(sender_id=user_id).order_by().values('conversation_id').annotate(unread=Count('id'))
+        counts = {conversation_id: 0 for conversation_id in conversation_ids}
+        counts.update({row['conversation_id']: row['unread'] for row in rows})
+        return counts
@@ -0,0 +1,497 @@
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.redis import RedisCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+#PRESENCE REGISTRY
+#who is online lives here instead of the online_users table, websocket connects and disconnects
+#only touch the registry, postgres gets a batched snapshot every PRESENCE['SNAPSHOT_INTERVAL'] seconds.
+#a user is online as long as at least one of their connections (tabs) has a live heartbeat.
+#in production RedisPresenceBackend keeps it in redis with one atomic script per change, so a heartbeat only
+#touches the user's own keys and workers never overwrite each other.
+
+DEFAULTS = {
+    'BACKEND': 'chat_app.presence.InMemoryPresenceBackend',
+    'TTL': 90,
+    'SNAPSHOT_INTERVAL': 30,
+    'CACHE_ALIAS': 'default',
+    'ROOM_COUNTS': 'database',
+}
+
+
+def presence_setting(name):
+    """reads a key from settings.PRESENCE, falling back to the defaults above"""
+    return getattr(settings, 'PRESENCE', {}).get(name, DEFAULTS[name])
+
+
+class PresenceEntry:
+    """the state of one online user, connections maps a connection id (channel name) to when it expires"""
+    def __init__(self, user_id, connections=None, room_id=None, last_seen=None):
+        self.user_id = user_id
+        self.connections = connections or {}
+        self.room_id = room_id
+        self.last_seen = last_seen or time.time()
+
+    def prune(self, now):
+        """drops connections whose heartbeat has expired"""
+        self.connections = {conn: expires for conn, expires in self.connections.items() if expires > now}
+        return self
+
+    @property
+    def is_online(self):
+        return bool(self.connections)
+
+    def to_dict(self):
+        return {'connections': self.connections, 'room_id': self.room_id, 'last_seen': self.last_seen}
+
+
+class BasePresenceBackend:
+    """the interface every presence backend implements, subclasses only have to load and store entries"""
+    def __init__(self, ttl=None):
+        self.ttl = ttl or presence_setting('TTL')
+
+    #STORAGE, implemented by the backends
+    def load(self, user_id):
+        raise NotImplementedError
+
+    def store(self, entry):
+        raise NotImplementedError
+
+    def online_user_ids(self, offset=0, limit=None):
+        """the ids of the online users, limit of them from offset in the backend's order"""
+        raise NotImplementedError
+
+    def online_count(self):
+        return len(self.online_user_ids())
+
+    #PUBLIC API
+    def connect(self, user_id, connection_id, room_id=None):
+        """registers a connection, returns True when this is the user's first live connection"""
+        now = time.time()
+        entry = self.load(user_id).prune(now)
+        was_online = entry.is_online
+        entry.connections[connection_id] = now + self.ttl
+        entry.last_seen = now
+        if room_id is not None:
+            entry.room_id = room_id
+        self.store(entry)
+        return not was_online
+
+    def heartbeat(self, user_id, connection_id):
+        """pushes the expiry of a connection forward, a heartbeat from an unknown connection re-registers it"""
+        self.connect(user_id, connection_id)
+
+    def disconnect(self, user_id, connection_id):
+        """drops a connection, returns True when it was the user's last one"""
+        entry = self.load(user_id).prune(time.time())
+        entry.connections.pop(connection_id, None)
+        entry.last_seen = time.time()
+        self.store(entry)
+        return not entry.is_online
+
+    def clear(self, user_id):
+        """forces a user offline no matter how many connections they have"""
+        entry = self.load(user_id)
+        entry.connections = {}
+        self.store(entry)
+
+    def set_room(self, user_id, room_id):
+        """records the chat room the user is currently in, returns False when the user has no live connection"""
+        entry = self.load(user_id).prune(time.time())
+        if entry.is_online:
+            entry.room_id = room_id
+            self.store(entry)
+        return entry.is_online
+
+    def touch(self, user_id):
+        """moves the user's last_seen to now without extending any connection, returns whether they are online"""
+        entry = self.load(user_id).prune(time.time())
+        if entry.is_online:
+            entry.last_seen = time.time()
+            self.store(entry)
+        return entry.is_online
+
+    def current_room_id(self, user_id):
+        """the room of an online user, None when they are in none or offline"""
+        entry = self.load(user_id).prune(time.time())
+        return entry.room_id if entry.is_online else None
+
+    def leave_room(self, user_id, room_id):
+        """clears the user's room if it is room_id, returns True when it was"""
+        entry = self.load(user_id).prune(time.time())
+        if not entry.is_online or entry.room_id != room_id:
+            return False
+        entry.room_id = None
+        self.store(entry)
+        return True
+
+    def is_online(self, user_id):
+        return self.load(user_id).prune(time.time()).is_online
+
+    def room_counts(self):
+        """{room id: online users in it}, from one read of the registry"""
+        counts = {}
+        for entry in self.entries():
+            if entry.room_id is not None:
+                counts[entry.room_id] = counts.get(entry.room_id, 0) + 1
+        return counts
+
+    def entries(self, user_ids=None):
+        """the online users among user_ids (every online user by default), as PresenceEntry objects"""
+        now = time.time()
+        result = []
+        for user_id in self.online_user_ids() if user_ids is None else user_ids:
+            entry = self.load(user_id).prune(now)
+            if entry.is_online:
+                result.append(entry)
+        return result
+
+
+class OnlineUserIds:
+    """the online ids of a backend as something django's Paginator can page, only the slice of the
+    requested page is read from the registry"""
+    def __init__(self, backend):
+        self.backend = backend
+
+    def count(self):
+        return self.backend.online_count()
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self.backend.online_user_ids(key, 1)[0]
+        start = key.start or 0
+        return self.backend.online_user_ids(start, None if key.stop is None else max(0, key.stop - start))
+
+
+class InMemoryPresenceBackend(BasePresenceBackend):
+    """keeps presence in a dict, it is per process so it is meant for tests and single worker setups"""
+    def __init__(self, ttl=None):
+        super().__init__(ttl)
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def load(self, user_id):
+        with self._lock:
+            data = self._entries.get(user_id)
+            if data is None:
+                return PresenceEntry(user_id)
+            return PresenceEntry(user_id, dict(data['connections']), data['room_id'], data['last_seen'])
+
+    def store(self, entry):
+        with self._lock:
+            if entry.is_online:
+                self._entries[entry.user_id] = entry.to_dict()
+            else:
+                self._entries.pop(entry.user_id, None)
+
+    def online_user_ids(self, offset=0, limit=None):
+        now = time.time()
+        with self._lock:
+            user_ids = sorted(user_id for user_id, data in self._entries.items() if any(expires > now for expires in data['connections'].values()))
+        return user_ids[offset:None if limit is None else offset + limit]
+
+
+class CachePresenceBackend(BasePresenceBackend):
+    """keeps presence in any shared django cache (locmem, memcached), for single worker setups and caches
+    without redis, RedisPresenceBackend is the production one. one key per user expires on its own when the
+    heartbeats stop, plus an index key of online ids that is only read and written when a user comes online
+    or goes offline, heartbeats of online users don't touch it. writes are last-write-wins, two workers
+    changing the index at the same moment can lose one change until the user's next transition"""
+    key_prefix = 'presence:user:'
+    index_key = 'presence:online_ids'
+
+    def __init__(self, ttl=None, cache_alias=None):
+        super().__init__(ttl)
+        self.cache = caches[cache_alias or presence_setting('CACHE_ALIAS')]
+
+    def load(self, user_id):
+        data = self.cache.get(f'{self.key_prefix}{user_id}')
+        if data is None:
+            return PresenceEntry(user_id)
+        entry = PresenceEntry(user_id, data['connections'], data['room_id'], data['last_seen'])
+        entry.indexed = True #a live key means the id is in the index
+        return entry
+
+    def store(self, entry):
+        key = f'{self.key_prefix}{entry.user_id}'
+        indexed = getattr(entry, 'indexed', False)
+        if entry.is_online:
+            self.cache.set(key, entry.to_dict(), timeout=self.ttl)
+            if not indexed:
+                self.update_index(add=entry.user_id)
+        else:
+            self.cache.delete(key)
+            if indexed:
+                self.update_index(remove=entry.user_id)
+
+    def update_index(self, add=None, remove=None):
+        index = set(self.cache.get(self.index_key) or ())
+        if add is not None and add not in index:
+            index.add(add)
+        elif remove is not None and remove in index:
+            index.discard(remove)
+        else:
+            return
+        self.cache.set(self.index_key, index, timeout=None)
+
+    def entries(self, user_ids=None):
+        """loads the users with one get_many instead of a get per user, reading every online user also
+        drops the ids whose key already expired from the index so it does not grow forever"""
+        index = set(self.cache.get(self.index_key) or ()) if user_ids is None else None
+        now = time.time()
+        found = self.cache.get_many([f'{self.key_prefix}{user_id}' for user_id in (sorted(index) if user_ids is None else user_ids)])
+        result = []
+        for key, data in found.items():
+            user_id = int(key[len(self.key_prefix):])
+            entry = PresenceEntry(user_id, data['connections'], data['room_id'], data['last_seen']).prune(now)
+            if entry.is_online:
+                result.append(entry)
+        if index is not None:
+            alive_ids = {entry.user_id for entry in result}
+            if alive_ids != index:
+                self.cache.set(self.index_key, alive_ids, timeout=None)
+        return result
+
+    def online_user_ids(self, offset=0, limit=None):
+        """reads every entry to leave out the expired ones, the cache has no ordered index to page in"""
+        user_ids = sorted(entry.user_id for entry in self.entries())
+        return user_ids[offset:None if limit is None else offset + limit]
+
+
+#every script gets now as ARGV[1], drops the expired connections of KEYS[1] and counts the live ones
+PRUNE = """
+local now = tonumber(ARGV[1])
+local live = 0
+local conns = redis.call('HGETALL', KEYS[1])
+for i = 1, #conns, 2 do
+    if tonumber(conns[i + 1]) > now then
+        live = live + 1
+    else
+        redis.call('HDEL', KEYS[1], conns[i])
+    end
+end
+"""
+
+#ARGV: now, connection id, expiry, ttl, user id, room id or ''. returns 1 for the user's first live connection
+CONNECT = PRUNE + """
+redis.call('HSET', KEYS[1], ARGV[2], ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('HSET', KEYS[2], 'last_seen', ARGV[1])
+if ARGV[6] ~= '' then
+    redis.call('HSET', KEYS[2], 'room_id', ARGV[6])
+end
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+redis.call('ZADD', KEYS[3], ARGV[3], ARGV[5])
+if live == 0 then
+    return 1
+end
+return 0
+"""
+
+#ARGV: now, connection id, user id. returns 1 when no live connection is left
+DISCONNECT = """
+redis.call('HDEL', KEYS[1], ARGV[2])
+""" + PRUNE + """
+if live > 0 then
+    redis.call('HSET', KEYS[2], 'last_seen', ARGV[1])
+    return 0
+end
+redis.call('DEL', KEYS[1], KEYS[2])
+redis.call('ZREM', KEYS[3], ARGV[3])
+return 1
+"""
+
+#ARGV: now, room id. sets the room of an online user
+SET_ROOM = PRUNE + """
+if live > 0 then
+    redis.call('HSET', KEYS[2], 'room_id', ARGV[2])
+end
+return live
+"""
+
+#ARGV: now, room id. clears the room if it is room id, returns 1 when it was
+LEAVE_ROOM = PRUNE + """
+if live == 0 or redis.call('HGET', KEYS[2], 'room_id') ~= ARGV[2] then
+    return 0
+end
+redis.call('HDEL', KEYS[2], 'room_id')
+return 1
+"""
+
+#ARGV: now. moves last_seen of an online user to now
+TOUCH = PRUNE + """
+if live > 0 then
+    redis.call('HSET', KEYS[2], 'last_seen', ARGV[1])
+end
+return live
+"""
+
+IS_ONLINE = PRUNE + """
+return live
+"""
+
+
+class RedisPresenceBackend(BasePresenceBackend):
+    """keeps presence in redis, through the client of the django RedisCache CACHE_ALIAS. every change is
+    one script on the user's own keys, so workers never overwrite each other's changes and a heartbeat costs
+    O(connections of the user) whatever the number of online users:
+    - presence:conns:<id>, a hash of connection id -> expiry, the user is online while one hasn't expired
+    - presence:meta:<id>, a hash of room_id and last_seen
+    - presence:online, a sorted set of user id -> expiry of their latest heartbeat. connects add to it and
+      last disconnects remove from it (ZADD/ZREM), users of a worker that died drop out once their score
+      passes"""
+    def __init__(self, ttl=None, cache_alias=None):
+        super().__init__(ttl)
+        alias = cache_alias or presence_setting('CACHE_ALIAS')
+        self.cache = caches[alias]
+        if not isinstance(self.cache, RedisCache):
+            raise ImproperlyConfigured(f'RedisPresenceBackend needs a RedisCache, the {alias!r} cache is not one (CachePresenceBackend works on any cache)')
+        self.client = self.cache._cache.get_client(write=True)
+        self.scripts = {name: self.client.register_script(script) for name, script in (
+            ('connect', CONNECT), ('disconnect', DISCONNECT), ('set_room', SET_ROOM), ('leave_room', LEAVE_ROOM), ('touch', TOUCH), ('is_online', IS_ONLINE),
+        )}
+        self.online_key = self.cache.make_key('presence:online')
+
+    def keys(self, user_id):
+        return [self.cache.make_key(f'presence:conns:{user_id}'), self.cache.make_key(f'presence:meta:{user_id}'), self.online_key]
+
+    def run(self, script, user_id, *args):
+        return int(self.scripts[script](keys=self.keys(user_id), args=[repr(time.time()), *args]))
+
+    def entry(self, user_id, conns, meta, now):
+        connections = {conn.decode(): float(expires) for conn, expires in conns.items()}
+        room_id = meta.get(b'room_id')
+        last_seen = meta.get(b'last_seen')
+        return PresenceEntry(
+            user_id, connections, int(room_id) if room_id is not None else None, float(last_seen) if last_seen is not None else None,
+        ).prune(now)
+
+    def load(self, user_id):
+        conns_key, meta_key, _ = self.keys(user_id)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.hgetall(conns_key)
+        pipe.hgetall(meta_key)
+        conns, meta = pipe.execute()
+        return self.entry(user_id, conns, meta, time.time())
+
+    def connect(self, user_id, connection_id, room_id=None):
+        now = time.time()
+        return bool(self.run('connect', user_id, connection_id, repr(now + self.ttl), self.ttl, user_id, '' if room_id is None else room_id))
+
+    def disconnect(self, user_id, connection_id):
+        return bool(self.run('disconnect', user_id, connection_id, user_id))
+
+    def clear(self, user_id):
+        conns_key, meta_key, online_key = self.keys(user_id)
+        pipe = self.client.pipeline()
+        pipe.delete(conns_key, meta_key)
+        pipe.zrem(online_key, user_id)
+        pipe.execute()
+
+    def set_room(self, user_id, room_id):
+        return self.run('set_room', user_id, room_id) > 0
+
+    def touch(self, user_id):
+        return self.run('touch', user_id) > 0
+
+    def leave_room(self, user_id, room_id):
+        return bool(self.run('leave_room', user_id, room_id))
+
+    def is_online(self, user_id):
+        return self.run('is_online', user_id) > 0
+
+    def online_user_ids(self, offset=0, limit=None):
+        """in the order of their latest heartbeat's expiry"""
+        user_ids = self.client.zrangebyscore(self.online_key, time.time(), '+inf', start=offset, num=-1 if limit is None else limit)
+        return [int(user_id) for user_id in user_ids]
+
+    def online_count(self):
+        return self.client.zcount(self.online_key, time.time(), '+inf')
+
+    def entries(self, user_ids=None):
+        """the users read with one pipeline of two HGETALLs per user"""
+        now = time.time()
+        if user_ids is None:
+            #users whose heartbeats stopped without a disconnect (a worker died)
+            self.client.zremrangebyscore(self.online_key, '-inf', now)
+            user_ids = self.online_user_ids()
+        pipe = self.client.pipeline(transaction=False)
+        for user_id in user_ids:
+            conns_key, meta_key, _ = self.keys(user_id)
+            pipe.hgetall(conns_key)
+            pipe.hgetall(meta_key)
+        results = pipe.execute()
+        entries = [self.entry(user_id, results[2 * n], results[2 * n + 1], now) for n, user_id in enumerate(user_ids)]
+        return [entry for entry in entries if entry.is_online]
+
+
+_backend = None
+_backend_lock = threading.Lock()
+_last_snapshot = 0.0
+
+
+def get_presence():
+    """returns the process wide presence backend configured in settings.PRESENCE['BACKEND']"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = import_string(presence_setting('BACKEND'))()
+    return _backend
+
+
+def reset_presence():
+    """drops the current backend so the next get_presence() builds a fresh one (useful in tests)"""
+    global _backend, _last_snapshot
+    _backend = None
+    _last_snapshot = 0.0
+
+
+#SNAPSHOTS TO POSTGRES
+def snapshot_presence():
+    """writes the registry to the online_users table and users.is_online in a handful of batched queries"""
+    global _last_snapshot
+    from django.contrib.auth import get_user_model
+    from .models import OnlineUser
+    User = get_user_model()
+
+    entries = {entry.user_id: entry for entry in get_presence().entries()}
+    online_ids = set(entries)
+
+    with transaction.atomic():
+        OnlineUser.objects.exclude(user_id__in=online_ids).delete()
+        existing = {row.user_id: row for row in OnlineUser.objects.filter(user_id__in=online_ids)}
+
+        to_create, to_update = [], []
+        for user_id, entry in entries.items():
+            last_activity = datetime.fromtimestamp(entry.last_seen, tz=dt_timezone.utc)
+            row = existing.get(user_id)
+            if row is None:
+                to_create.append(OnlineUser(user_id=user_id, current_room_id=entry.room_id, last_activity=last_activity))
+            else:
+                row.current_room_id = entry.room_id
+                row.last_activity = last_activity
+                to_update.append(row)
+        OnlineUser.objects.bulk_create(to_create, batch_size=1000)
+        OnlineUser.objects.bulk_update(to_update, ['current_room', 'last_activity'], batch_size=1000)
+
+        User.objects.filter(is_online=True).exclude(id__in=online_ids).update(is_online=False)
+        User.objects.filter(id__in=online_ids, is_online=False).update(is_online=True)
+
+    _last_snapshot = time.time()
+    return len(online_ids)
+
+
+def snapshot_presence_if_due():
+    """runs snapshot_presence when the last one is older than SNAPSHOT_INTERVAL, otherwise does nothing"""
+    if time.time() - _last_snapshot < presence_setting('SNAPSHOT_INTERVAL'):
+        return None
+    return snapshot_presence()
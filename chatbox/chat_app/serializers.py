@@ -1,4 +1,5 @@
 from rest_framework import serializers
+from chatbox_project.instrumentation import InstrumentedSerializerMixin
 from .models import *
 from django.contrib.auth import get_user_model
 
@@ -8,28 +9,32 @@ User = get_user_model()
 #2. serializer represent information you want to represent in
 #serializers define the structure of an output
 
-class ChatRoomSerializer(serializers.ModelSerializer):
+class ChatRoomSerializer(InstrumentedSerializerMixin, serializers.ModelSerializer):
     """The serializer after a chat room model""" 
-    get_online_users_count = serializers.SerializerMethodField()
+    online_users_count = serializers.SerializerMethodField()
     
     class Meta:
         """it tells django which model to move with"""
         model = ChatRoom
-        fields = ['name', 'conversation', 'created_at', 'is_active']
+        fields = ['id', 'name', 'conversation', 'created_at', 'is_active', 'online_users_count']
         read_only_fields = ['created_at', 'is_active']
         
     def get_online_users_count(self, obj):
         """a method that counts the numbers of online users in a room"""
-        return OnlineUser.objects.filter(current_room=obj).count()
+        #either the live presence counts passed in the context, or the annotation of ChatRoom.with_online_counts
+        counts = self.context.get('online_counts')
+        if counts is not None:
+            return counts.get(obj.id, 0)
+        return getattr(obj, 'online_users_count', None)
     
 
-class OnlineUserSerializer(serializers.ModelSerializer):
+class OnlineUserSerializer(InstrumentedSerializerMixin, serializers.ModelSerializer):
     """a method serializer for online user"""
     user = serializers.StringRelatedField()
     username = serializers.CharField(source='user.username', read_only=True)
     avatar = serializers.ImageField(source='user.avatar', read_only=True)
     is_recently_active = serializers.SerializerMethodField()
-    current_room_name = serializers.CharField(source='current_room.name')
+    current_room_name = serializers.CharField(source='current_room.name', read_only=True, default=None)
     
     class Meta:
         """the table explains the additional behavioural structure"""
@@ -43,7 +48,7 @@ class OnlineUserSerializer(serializers.ModelSerializer):
         return obj.is_recently_active()
 
 
-class TypingIndicatorSerializer(serializers.ModelSerializer):
+class TypingIndicatorSerializer(InstrumentedSerializerMixin, serializers.ModelSerializer):
     """The serializer that shows information about typing"""
     user = serializers.StringRelatedField()
     username = serializers.CharField(source='user.username', read_only=True)
@@ -52,7 +57,7 @@ class TypingIndicatorSerializer(serializers.ModelSerializer):
     class Meta:
         """additional information concerning the information"""
         model = TypingIndicator
-        fields = ['id', 'user', 'username', 'avatar' 'is_typing', 'conversation_id']
+        fields = ['id', 'user', 'username', 'avartar', 'is_typing', 'conversation_id']
         read_only = ['id', 'started_typing']
         
     def create(self, validated_data):
@@ -70,16 +75,16 @@ class TypingIndicatorSerializer(serializers.ModelSerializer):
         return typing_indicator
     
 
-class MessageDeliveryStatusSerializer(serializers.ModelSerializer):
+class MessageDeliveryStatusSerializer(InstrumentedSerializerMixin, serializers.ModelSerializer):
     """serializer for message delivery status"""
     username = serializers.CharField(source='user.username', read_only=True)
     class Meta:
         model = MessageDeliveryStatus
-        fields = ['user', 'username' 'message', 'delivery_status', 'timestamp']
+        fields = ['user', 'username', 'message', 'delivery_status', 'timestamp']
         read_only = ['id','timestamp']
 
 
-class UserOnlinePresenceSerializer(serializers.Serializer):
+class UserOnlinePresenceSerializer(InstrumentedSerializerMixin, serializers.Serializer):
     """a serializer class that shows the online presence of a user in a room"""
     user = serializers.StringRelatedField()
     avatar = serializers.ImageField(source='user.avatar')
@@ -88,7 +93,7 @@ class UserOnlinePresenceSerializer(serializers.Serializer):
     last_seen = serializers.DateTimeField()
     
 
-class ConversationOnlineUserSerializer(serializers.Serializer):
+class ConversationOnlineUserSerializer(InstrumentedSerializerMixin, serializers.Serializer):
     """a serializer class that shows the number of online users"""
     online_user = OnlineUserSerializer(many=True, read_only=True)
     conversation_id = serializers.IntegerField()
@@ -96,15 +101,15 @@ class ConversationOnlineUserSerializer(serializers.Serializer):
     online_count = serializers.IntegerField()
     
 
-class TypingStatusSerializer(serializers.Serializer):
+class TypingStatusSerializer(InstrumentedSerializerMixin, serializers.Serializer):
     """a serializer class that typing status users"""
     conversation_id = serializers.IntegerField()
     is_typing = serializers.BooleanField()
     
-class BulkMessageStatusSerializer(serializers.Serializer):
+class BulkMessageStatusSerializer(InstrumentedSerializerMixin, serializers.Serializer):
     """serializer for bulk status"""
     message_id = serializers.ListField(child=serializers.IntegerField(), min_length=1)
-    message_status = serializers.ChoiceField(choices=MessageDeliveryStatus.STATUS_CHOICES)
+    message_status = serializers.ChoiceField(choices=MessageDeliveryStatus.STATUS_CHOICES, required=False) #mark_read and mark_delivered set the status themselves
     
     def create(self, validated_value):
         """validate status progression: sent->delivered->read"""
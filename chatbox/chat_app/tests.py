@@ -1,3 +1,511 @@
-from django.test import TestCase
+import asyncio
+import os
+import sys
+import threading
+from types import SimpleNamespace
+from unittest import mock, skipUnless
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+from django.contrib.auth.models import AnonymousUser
+from django.test import TestCase, override_settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework.serializers import BaseSerializer
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from chatbox_project.instrumentation import assert_query_budget, finish_sample, registry, start_sample
+from chatbox_project.testing import ENFORCED_BUDGETS, LOCMEM_CACHES, QueryCountTestMixin
+from users_app.models import User, Conversation, Message
+from users_app.serializers import ChatboxTokenObtainPairSerializer
+from .jwt_auth import ClaimsUser, JWTAuthMiddleware, claims_cache
+from .fanout import CoalescingFanoutMixin, fanout_batch_event
+from .frame_codecs import JsonCodec, MsgpackCodec, _derived_frame, available_codecs, encode_frames, get_codecs
+from .models import ChatRoom, OnlineUser, TypingIndicator, ConversationReadState
+from .serializers import ChatRoomSerializer
+from .typing_state import TypingState, get_typing_state
+from redis.exceptions import ConnectionError as RedisConnectionError
+from .presence import CachePresenceBackend, InMemoryPresenceBackend, OnlineUserIds, RedisPresenceBackend, get_presence, reset_presence, snapshot_presence
+from .consumers import ChatConsumer
+from .write_buffer import BufferClosed, close_message_buffers, get_message_buffer, install_daphne_shutdown_hook, lifespan
+from .views import ChatRoomViewSet, OnlineUserViewSet, TypingIndicatorViewSet, MessageDeliveryStatusViewSet
 
 # Create your tests here.
+IN_MEMORY_PRESENCE = {'BACKEND': 'chat_app.presence.InMemoryPresenceBackend'}
+#the redis presence tests run against this database and skip when nothing answers there
+TEST_REDIS_URL = os.environ.get('TEST_REDIS_URL', 'redis://localhost:6379/15')
+REDIS_CACHES = {
+    **LOCMEM_CACHES,
+    'presence': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': TEST_REDIS_URL, 'KEY_PREFIX': 'presence-tests'},
+}
+
+
+@override_settings(CACHES=LOCMEM_CACHES, INSTRUMENTATION=ENFORCED_BUDGETS, PRESENCE=IN_MEMORY_PRESENCE)
+class ListQueryCountTests(QueryCountTestMixin, TestCase):
+    """the chat list endpoints, with ROWS members online in one room"""
+    ROWS = 101
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='owner', email='owner@example.com')
+        cls.others = User.objects.bulk_create([
+            User(username=f'member_{n}', email=f'member_{n}@example.com') for n in range(cls.ROWS)
+        ])
+        cls.conversation = Conversation.objects.create(title='everyone', is_group=True)
+        cls.conversation.participants.add(cls.user, *cls.others)
+        cls.room = ChatRoom.objects.create(name='lobby', conversation=cls.conversation)
+        cls.message = Message.objects.create(conversation=cls.conversation, sender=cls.user, content='hello')
+        ConversationReadState.objects.bulk_create([
+            ConversationReadState(user=user, conversation=cls.conversation, last_delivered_message_id=cls.message.id)
+            for user in cls.others
+        ])
+
+    def setUp(self):
+        reset_presence()
+        for user in self.others:
+            get_presence().connect(user.id, f'socket-{user.id}', room_id=self.room.id)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def tearDown(self):
+        reset_presence()
+
+    def test_online_user_list(self):
+        self.assert_constant_queries(OnlineUserViewSet, '/api/chatonline-user/')
+
+    def test_delivery_status_list(self):
+        self.assert_constant_queries(MessageDeliveryStatusViewSet, '/api/chatdelivery-status/', {'message_id': self.message.id})
+
+    def test_conversation_online_users(self):
+        """not paginated, so the page is the number of online members instead"""
+        budget = OnlineUserViewSet.query_budget['get_conversation_users']
+        counts = {}
+        for online in (1, 100):
+            reset_presence()
+            cache.clear()
+            for user in self.others[:online]:
+                get_presence().connect(user.id, f'socket-{user.id}', room_id=self.room.id)
+            with self.subTest(online=online), assert_query_budget(budget) as queries:
+                response = self.client.get('/api/chatonline-user/get_conversation_users/', {'conversation_id': self.conversation.id})
+            self.assertEqual(response.data['no of online users'], online)
+            counts[online] = len(queries)
+        self.assertEqual(counts[1], counts[100])
+
+    def test_serializer_time(self):
+        """instrumented serializers add to the open sample, DRF's own serializer.data is left alone"""
+        sample, token = start_sample('test', 'serializer_time')
+        try:
+            ChatRoomSerializer([self.room], many=True).data
+        finally:
+            finish_sample(sample, token)
+        self.assertGreater(sample.serializer_time, 0)
+        self.assertEqual(sample.serializer_depth, 0)
+        self.assertEqual(BaseSerializer.data.fget.__qualname__, 'BaseSerializer.data')
+
+    def test_sample_names_are_bounded(self):
+        """paths and methods that don't resolve to a view share one registry entry"""
+        registry.clear()
+        for n in range(3):
+            self.client.get(f'/no-such-page-{n}/')
+            self.client.generic('PURGE', '/api/chatonline-user/')
+        self.assertEqual(set(registry.totals), {('http', 'unresolved'), ('http', 'OnlineUserViewSet.other')})
+        self.assertEqual(registry.totals[('http', 'unresolved')]['count'], 3)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, INSTRUMENTATION=ENFORCED_BUDGETS)
+class TypingIndicatorTests(TestCase):
+    """the typing endpoints read and write the typing state, only members of the conversation get in"""
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='typist', email='typist@example.com')
+        cls.others = User.objects.bulk_create([
+            User(username=f'typist_{n}', email=f'typist_{n}@example.com') for n in range(100)
+        ])
+        cls.outsider = User.objects.create(username='outsider', email='outsider@example.com')
+        cls.conversation = Conversation.objects.create(title='typing', is_group=True)
+        cls.conversation.participants.add(cls.user, *cls.others)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_list_is_served_from_the_typing_state(self):
+        for user in self.others:
+            get_typing_state().start(self.conversation.id, user.id, user.username)
+        get_typing_state().start(self.conversation.id, self.user.id, self.user.username)
+        with assert_query_budget(TypingIndicatorViewSet.query_budget['list']):
+            response = self.client.get('/api/chattyping/', {'conversation_id': self.conversation.id, 'page_size': 100})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 100)
+        self.assertEqual(response.data['results'][0]['username'], 'typist_0')
+        self.assertFalse(TypingIndicator.objects.exists())
+
+    def test_create_starts_and_stops_typing(self):
+        response = self.client.post('/api/chattyping/', {'conversation_id': self.conversation.id, 'is_typing': True})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([user['user_id'] for user in get_typing_state().typing_users(self.conversation.id)], [self.user.id])
+        self.client.post('/api/chattyping/', {'conversation_id': self.conversation.id, 'is_typing': False})
+        self.assertEqual(get_typing_state().typing_users(self.conversation.id), [])
+        self.assertFalse(TypingIndicator.objects.exists())
+
+    def test_outsiders_are_turned_away(self):
+        get_typing_state().start(self.conversation.id, self.user.id, self.user.username)
+        self.client.force_authenticate(self.outsider)
+        params = {'conversation_id': self.conversation.id}
+        self.assertEqual(self.client.get('/api/chattyping/', params).status_code, 400)
+        self.assertEqual(self.client.get('/api/chattyping/who_is_typing/', params).status_code, 404)
+        self.assertEqual(self.client.post('/api/chattyping/', {**params, 'is_typing': True}).status_code, 400)
+        self.assertEqual(len(get_typing_state().typing_users(self.conversation.id)), 1)
+
+    def test_typists_on_other_workers_are_kept(self):
+        """every typist has a key of their own, a worker starting or stopping one typist leaves the others alone"""
+        first, second = TypingState(), TypingState()
+        self.assertTrue(first.start(self.conversation.id, self.user.id, self.user.username))
+        self.assertTrue(second.start(self.conversation.id, self.others[0].id, self.others[0].username))
+        self.assertEqual(len(first.typing_users(self.conversation.id)), 2)
+        self.assertIsNotNone(cache.get(first.key(self.conversation.id, self.others[0].id)))
+        self.assertTrue(second.stop(self.conversation.id, self.others[0].id))
+        self.assertFalse(first.start(self.conversation.id, self.user.id, self.user.username))
+        self.assertEqual([user['user_id'] for user in second.typing_users(self.conversation.id)], [self.user.id])
+        self.assertFalse(second.stop(self.conversation.id, self.others[0].id))
+
+
+@override_settings(CACHES=LOCMEM_CACHES, INSTRUMENTATION=ENFORCED_BUDGETS, PRESENCE=IN_MEMORY_PRESENCE)
+class ChatRoomOnlineCountTests(TestCase):
+    """the room list carries its online counts without a query per room, and they follow join/leave,
+    live from the registry or with the next snapshot from the online_users table"""
+    ROOMS = 100
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = User.objects.bulk_create([User(username=f'user_{n}', email=f'user_{n}@example.com') for n in range(3)])
+        conversation = Conversation.objects.create(title='rooms')
+        cls.rooms = ChatRoom.objects.bulk_create([ChatRoom(name=f'room {n}', conversation=conversation) for n in range(cls.ROOMS)])
+
+    def setUp(self):
+        reset_presence()
+        self.clients = []
+        for user in self.users:
+            client = APIClient()
+            client.force_authenticate(user)
+            self.clients.append(client)
+
+    def tearDown(self):
+        reset_presence()
+
+    def room_counts(self):
+        response = self.clients[0].get('/api/chatroom/', {'page_size': 100})
+        return {room['id']: room['online_users_count'] for room in response.data['results']}
+
+    def test_room_list_queries(self):
+        for live in (False, True):
+            with self.subTest(live=live), self.settings(PRESENCE={**IN_MEMORY_PRESENCE, 'ROOM_COUNTS': 'presence' if live else 'database'}):
+                counts = {}
+                for page_size in (1, 100):
+                    with assert_query_budget(ChatRoomViewSet.query_budget['list']) as queries:
+                        response = self.clients[0].get('/api/chatroom/', {'page_size': page_size})
+                    self.assertEqual(len(response.data['results']), page_size)
+                    counts[page_size] = len(queries)
+                self.assertEqual(counts[1], counts[100])
+
+    def connect_sockets(self):
+        reset_presence()
+        for user in self.users:
+            get_presence().connect(user.id, f'socket-{user.id}')
+
+    def test_counts_follow_join_and_leave(self):
+        first, second = self.rooms[0].id, self.rooms[1].id
+        for live in (False, True):
+            with self.subTest(live=live), self.settings(PRESENCE={**IN_MEMORY_PRESENCE, 'ROOM_COUNTS': 'presence' if live else 'database'}):
+                self.connect_sockets()
+                for client in self.clients:
+                    response = client.post(f'/api/chatroom/{first}/join_chatroom/')
+                    self.assertEqual(response.status_code, 200)
+                if live:
+                    self.assertEqual(response.data['chat room']['online_users_count'], 3)
+                self.clients[0].post(f'/api/chatroom/{second}/join_chatroom/')
+                response = self.clients[1].post(f'/api/chatroom/{first}/leave_chatroom/')
+                if live:
+                    self.assertEqual(response.data['chat room']['online_users_count'], 1)
+                else:
+                    snapshot_presence()
+                counts = self.room_counts()
+                self.assertEqual((counts[first], counts[second]), (1, 1))
+                response = self.clients[1].post(f'/api/chatroom/{first}/leave_chatroom/')
+                self.assertEqual(response.status_code, 400)
+                for client in self.clients:
+                    client.post(f'/api/chatroom/{first}/leave_chatroom/')
+                    client.post(f'/api/chatroom/{second}/leave_chatroom/')
+                snapshot_presence()
+                self.assertEqual(set(self.room_counts().values()), {0})
+
+    def test_rest_calls_are_not_connections(self):
+        response = self.clients[0].post(f'/api/chatroom/{self.rooms[0].id}/join_chatroom/')
+        self.assertEqual(response.status_code, 400)
+        response = self.clients[0].post('/api/chatonline-user/update_activity/')
+        self.assertFalse(response.data['is_online'])
+        self.assertFalse(get_presence().is_online(self.users[0].id))
+        self.assertFalse(OnlineUser.objects.exists())
+
+        self.connect_sockets()
+        with assert_query_budget(1): #the room, the registry is the only thing written
+            self.clients[0].post(f'/api/chatroom/{self.rooms[0].id}/join_chatroom/')
+        self.assertEqual(get_presence().current_room_id(self.users[0].id), self.rooms[0].id)
+        self.assertTrue(self.clients[0].post('/api/chatonline-user/update_activity/').data['is_online'])
+        self.assertFalse(OnlineUser.objects.exists())
+        get_presence().disconnect(self.users[0].id, f'socket-{self.users[0].id}')
+        self.assertFalse(get_presence().is_online(self.users[0].id))
+
+
+class JWTAuthMiddlewareTests(TestCase):
+    """sockets carrying an access token get a ClaimsUser without a query, the token is taken out of the
+    subprotocols, and bad tokens leave the user of the session stack"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='socket_user', email='socket_user@example.com')
+
+    def setUp(self):
+        claims_cache.clear()
+
+    def connect(self, query_string=b'', subprotocols=()):
+        """the scope the inner application receives"""
+        scopes = []
+
+        async def inner(scope, receive, send):
+            scopes.append(scope)
+        scope = {'type': 'websocket', 'query_string': query_string, 'subprotocols': list(subprotocols), 'user': AnonymousUser()}
+        async_to_sync(JWTAuthMiddleware(inner))(scope, None, None)
+        return scopes[0]
+
+    def test_query_param_without_queries(self):
+        access = str(ChatboxTokenObtainPairSerializer.get_token(self.user).access_token)
+        with self.assertNumQueries(0):
+            scope = self.connect(query_string=f'token={access}'.encode())
+        self.assertIsInstance(scope['user'], ClaimsUser)
+        self.assertEqual((scope['user'].id, scope['user'].username), (self.user.id, 'socket_user'))
+        self.assertEqual(scope['user'].email, 'socket_user@example.com') #loads the row on demand
+
+    def test_subprotocol_token_is_removed(self):
+        access = str(ChatboxTokenObtainPairSerializer.get_token(self.user).access_token)
+        scope = self.connect(subprotocols=['chatbox.batch', 'chatbox.jwt', access])
+        self.assertEqual((scope['subprotocols'], scope['auth_subprotocol']), (['chatbox.batch'], 'chatbox.jwt'))
+        self.assertEqual(scope['user'].id, self.user.id)
+
+    def test_tokens_without_username_are_looked_up_once(self):
+        access = str(AccessToken.for_user(self.user))
+        with self.assertNumQueries(1):
+            self.connect(query_string=f'token={access}'.encode())
+        with self.assertNumQueries(0):
+            scope = self.connect(query_string=f'token={access}'.encode())
+        self.assertEqual(scope['user'].username, 'socket_user')
+
+    def test_invalid_token_stays_anonymous(self):
+        scope = self.connect(query_string=b'token=not-a-token')
+        self.assertTrue(scope['user'].is_anonymous)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, PRESENCE=IN_MEMORY_PRESENCE, MESSAGE_WRITE_BUFFER={'BATCH_SIZE': 100, 'MAX_DELAY': 0.2})
+class WriteBufferShutdownTests(TestCase):
+    """messages still waiting in the write buffer are written before the server stops"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='shutdown_user', email='shutdown_user@example.com')
+        cls.conversation = Conversation.objects.create()
+        cls.conversation.participants.add(cls.user)
+
+    async def pending_message(self):
+        pending = asyncio.ensure_future(get_message_buffer().submit(self.user.id, self.conversation.id, 'last words'))
+        await asyncio.sleep(0.01)
+        self.assertFalse(pending.done())
+        return pending
+
+    async def test_lifespan_shutdown_flushes(self):
+        communicator = ApplicationCommunicator(lifespan, {'type': 'lifespan'})
+        await communicator.send_input({'type': 'lifespan.startup'})
+        self.assertEqual(await communicator.receive_output(), {'type': 'lifespan.startup.complete'})
+        pending = await self.pending_message()
+        await communicator.send_input({'type': 'lifespan.shutdown'})
+        self.assertEqual(await communicator.receive_output(5), {'type': 'lifespan.shutdown.complete'})
+        self.assertTrue(pending.done())
+        self.assertTrue(await Message.objects.filter(pk=pending.result().pk, content='last words').aexists())
+
+    async def test_daphne_shutdown_trigger_flushes(self):
+        reactor = mock.Mock()
+        with mock.patch.dict(sys.modules, {'twisted.internet.reactor': reactor}):
+            self.assertTrue(install_daphne_shutdown_hook())
+        phase, event, trigger = reactor.addSystemEventTrigger.call_args.args
+        self.assertEqual((phase, event), ('before', 'shutdown'))
+        pending = await self.pending_message()
+        await trigger().asFuture(asyncio.get_running_loop())
+        self.assertTrue(pending.done())
+        self.assertTrue(await Message.objects.filter(pk=pending.result().pk).aexists())
+
+    async def test_messages_after_shutdown_get_an_error(self):
+        await close_message_buffers()
+        with self.assertRaises(BufferClosed):
+            await get_message_buffer().submit(self.user.id, self.conversation.id, 'too late')
+        consumer = ChatConsumer()
+        consumer.user, consumer.conversation_id, consumer.codec = self.user, self.conversation.id, None
+        with mock.patch.object(ChatConsumer, 'check_blocked', return_value=None), \
+                mock.patch.object(ChatConsumer, 'send_event') as send_event:
+            await consumer.handle_chat_message({'message': 'too late', 'client_id': 'c1'})
+        frame = send_event.call_args.args[0]
+        self.assertEqual((frame['type'], frame['client_id']), ('error', 'c1'))
+        self.assertFalse(await Message.objects.filter(content='too late').aexists())
+
+
+class PresenceBackendTests:
+    """refcounting and expiry every presence backend has to get right, the subclasses make the backend"""
+    def make_backend(self):
+        raise NotImplementedError
+
+    def test_connections_are_refcounted(self):
+        presence = self.make_backend()
+        self.assertTrue(presence.connect(1, 'tab-1', room_id=7))
+        self.assertFalse(presence.connect(1, 'tab-2'))
+        self.assertTrue(presence.connect(2, 'tab-3', room_id=7))
+        self.assertEqual(sorted(presence.online_user_ids()), [1, 2])
+        self.assertEqual(presence.room_counts(), {7: 2})
+
+        self.assertFalse(presence.disconnect(1, 'tab-1'))
+        self.assertTrue(presence.is_online(1))
+        self.assertTrue(presence.disconnect(1, 'tab-2'))
+        self.assertFalse(presence.is_online(1))
+        self.assertEqual(presence.online_user_ids(), [2])
+        self.assertTrue(presence.leave_room(2, 7))
+        self.assertEqual(presence.room_counts(), {})
+
+    def test_connections_expire_without_heartbeats(self):
+        presence = self.make_backend()
+        with mock.patch('chat_app.presence.time.time', return_value=1000.0):
+            presence.connect(1, 'tab-1', room_id=7)
+            presence.connect(2, 'tab-2', room_id=7)
+        with mock.patch('chat_app.presence.time.time', return_value=1000.0 + presence.ttl / 2):
+            presence.heartbeat(2, 'tab-2')
+        with mock.patch('chat_app.presence.time.time', return_value=1001.0 + presence.ttl):
+            self.assertFalse(presence.is_online(1))
+            self.assertTrue(presence.is_online(2))
+            self.assertEqual(presence.online_user_ids(), [2])
+            self.assertEqual(presence.room_counts(), {7: 1})
+            #the expired tab doesn't count, the next one is a first connection again
+            self.assertTrue(presence.connect(1, 'tab-3'))
+            self.assertFalse(presence.disconnect(1, 'tab-1'))
+            self.assertTrue(presence.disconnect(1, 'tab-3'))
+
+    def test_pages_of_online_ids(self):
+        presence = self.make_backend()
+        for user_id in range(1, 6):
+            presence.connect(user_id, f'tab-{user_id}', room_id=7)
+        online_ids = OnlineUserIds(presence)
+        self.assertEqual(len(online_ids), 5)
+        pages = [online_ids[0:2], online_ids[2:4], online_ids[4:6]]
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual(sorted(sum(pages, [])), [1, 2, 3, 4, 5])
+        self.assertEqual(sorted(entry.user_id for entry in presence.entries([2, 4, 9])), [2, 4])
+
+
+class InMemoryPresenceBackendTests(PresenceBackendTests, TestCase):
+    def make_backend(self):
+        return InMemoryPresenceBackend()
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CachePresenceBackendTests(PresenceBackendTests, TestCase):
+    def make_backend(self):
+        cache.clear()
+        return CachePresenceBackend()
+
+    def test_heartbeats_leave_the_index_alone(self):
+        presence = self.make_backend()
+        presence.connect(1, 'tab-1')
+        with mock.patch.object(presence, 'update_index') as update_index:
+            presence.heartbeat(1, 'tab-1')
+            presence.connect(1, 'tab-2')
+            self.assertFalse(presence.disconnect(1, 'tab-1'))
+        update_index.assert_not_called()
+        self.assertTrue(presence.disconnect(1, 'tab-2'))
+        self.assertEqual(presence.online_user_ids(), [])
+
+
+@override_settings(CACHES=REDIS_CACHES)
+class RedisPresenceBackendTests(PresenceBackendTests, TestCase):
+    def make_backend(self):
+        presence = RedisPresenceBackend(cache_alias='presence')
+        try:
+            presence.client.ping()
+        except RedisConnectionError:
+            self.skipTest(f'no redis at {TEST_REDIS_URL}')
+        keys = list(presence.client.scan_iter('presence-tests:*'))
+        if keys:
+            presence.client.delete(*keys)
+        return presence
+
+    def test_needs_a_redis_cache(self):
+        with self.assertRaises(ImproperlyConfigured):
+            RedisPresenceBackend(cache_alias='default')
+
+    def test_workers_dont_overwrite_each_other(self):
+        self.make_backend()
+
+        def worker(first):
+            presence = RedisPresenceBackend(cache_alias='presence')
+            for user_id in range(first, first + 25):
+                presence.connect(user_id, f'tab-{user_id}')
+                presence.heartbeat(user_id, f'tab-{user_id}')
+
+        threads = [threading.Thread(target=worker, args=(first,)) for first in range(1, 201, 25)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(RedisPresenceBackend(cache_alias='presence').online_user_ids()), list(range(1, 201)))
+
+
+class RecordingSocket(CoalescingFanoutMixin):
+    """the frame handling of a consumer, with the frames it sends kept instead of written"""
+    def __init__(self, user_id, subprotocols=()):
+        self.scope = {'subprotocols': list(subprotocols)}
+        self.user = SimpleNamespace(id=user_id)
+        self.select_fanout()
+        self.sent = []
+
+    async def send(self, text_data=None, bytes_data=None):
+        self.sent.append(bytes_data if text_data is None else text_data)
+
+
+@skipUnless('msgpack' in get_codecs(), 'msgpack is not installed')
+class FrameCodecTests(TestCase):
+    """a broadcast is rendered to json once, other codecs only where a socket of theirs receives it"""
+
+    def setUp(self):
+        _derived_frame.cache_clear()
+
+    def test_only_json_is_rendered_by_the_sender(self):
+        with mock.patch.object(MsgpackCodec, 'encode') as encode:
+            frames = encode_frames({'type': 'chat_message', 'message': 'hello'})
+        encode.assert_not_called()
+        self.assertEqual(list(frames), ['json'])
+
+    def test_other_codecs_are_derived_once_per_process(self):
+        payload = {'type': 'chat_message', 'message_id': 1, 'message': 'hello'}
+        event = fanout_batch_event([[encode_frames(payload), None]])
+        plain = RecordingSocket(1)
+        binary = [RecordingSocket(n, ['chatbox.msgpack']) for n in range(2, 5)]
+        codec = get_codecs()['msgpack']
+        with mock.patch.object(MsgpackCodec, 'encode', wraps=codec.encode) as encode:
+            for socket in [plain, *binary]:
+                async_to_sync(socket.fanout_batch)(event)
+        self.assertEqual(encode.call_count, 1)
+        self.assertEqual(get_codecs()['json'].decode(plain.sent[0]), payload)
+        for socket in binary:
+            self.assertEqual(codec.decode(socket.sent[0]), payload)
+
+    def test_missing_libraries_are_logged(self):
+        with mock.patch('chat_app.frame_codecs.orjson', None), mock.patch('chat_app.frame_codecs.msgpack', None), \
+                self.assertLogs('chat_app.frame_codecs', 'WARNING') as logs:
+            codecs = available_codecs()
+        self.assertEqual(list(codecs), ['json'])
+        self.assertIs(type(codecs['json']), JsonCodec)
+        self.assertEqual(len(logs.records), 2)
@@ -0,0 +1,122 @@
+import asyncio
+import time
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from users_app.membership import conversation_member_ids
+from .frame_codecs import encode_frames
+
+#EPHEMERAL TYPING STATE
+#who is typing lives only in the cache, one key per typist (typing:<conversation>:<user>) that expires on its
+#own. a user only ever writes their own key, so typists on different workers can't overwrite each other.
+#the conversation's members (users_app.membership, already cached) are the index: the typing users are one
+#get_many of their keys. start_typing frames from someone who is already typing just push their expiry forward (and only
+#every TTL/2 seconds, so a fast typist is not a cache write per keystroke). broadcasts are coalesced:
+#each conversation gets at most one "who is typing" frame per BROADCAST_WINDOW in this process.
+
+DEFAULTS = {
+    'TTL': 6,
+    'BROADCAST_WINDOW': 0.5,
+    'CACHE_ALIAS': 'default',
+}
+
+
+def typing_setting(name):
+    """reads a key from settings.TYPING, falling back to the defaults above"""
+    return getattr(settings, 'TYPING', {}).get(name, DEFAULTS[name])
+
+
+class TypingState:
+    """the typing users of every conversation, one [username, started, expires] key per typist"""
+    key_prefix = 'typing:'
+
+    def __init__(self, ttl=None, cache_alias=None):
+        self.ttl = ttl or typing_setting('TTL')
+        self.cache = caches[cache_alias or typing_setting('CACHE_ALIAS')]
+
+    def key(self, conversation_id, user_id):
+        return f'{self.key_prefix}{conversation_id}:{user_id}'
+
+    def start(self, conversation_id, user_id, username):
+        """marks the user as typing, returns True when the set of typing users changed"""
+        now = time.time()
+        key = self.key(conversation_id, user_id)
+        current = self.cache.get(key)
+        if current is not None and current[2] <= now:
+            current = None
+        #debounce, someone who is already typing only needs a refresh once half their ttl is gone
+        if current and current[2] - now > self.ttl / 2:
+            return False
+        self.cache.set(key, [username, current[1] if current else now, now + self.ttl], timeout=self.ttl)
+        return current is None
+
+    def stop(self, conversation_id, user_id):
+        """removes the user from the typing users, returns True when they were typing"""
+        return bool(self.cache.delete(self.key(conversation_id, user_id)))
+
+    def typing_users(self, conversation_id, exclude=None):
+        """the users currently typing in the conversation, oldest typist first"""
+        now = time.time()
+        keys = {self.key(conversation_id, user_id): user_id for user_id in conversation_member_ids(conversation_id) if user_id != exclude}
+        typers = [(keys[key], value) for key, value in self.cache.get_many(keys).items() if value[2] > now]
+        return [
+            {'user_id': user_id, 'username': username, 'started_typing': started}
+            for user_id, (username, started, expires) in sorted(typers, key=lambda item: item[1][1])
+        ]
+
+
+_state = None
+
+
+def get_typing_state():
+    """returns the process wide TypingState"""
+    global _state
+    if _state is None:
+        _state = TypingState()
+    return _state
+
+
+def reset_typing_state():
+    """drops the current state object so settings changes are picked up (useful in tests)"""
+    global _state
+    _state = None
+
+
+#COALESCED BROADCASTS
+def typing_users_event(conversation_id, typing_users):
+    """the group event for ChatConsumer.typing_users, the frame is rendered once for everybody
+    who isn't typing, the raw list lets the typists leave themselves out of their own frame"""
+    payload = {'type': 'typing_users', 'conversation_id': conversation_id, 'typing_users': typing_users}
+    return {'type': 'typing_users', 'frames': encode_frames(payload), 'conversation_id': conversation_id, 'typing_users': typing_users}
+
+
+_pending = {} #conversation_id -> the task that will broadcast for it
+
+
+def schedule_typing_broadcast(channel_layer, conversation_id, group_name):
+    """makes sure a broadcast for the conversation is coming within one window, calling this
+    many times inside the window still ends up as a single group_send"""
+    if conversation_id not in _pending:
+        _pending[conversation_id] = asyncio.ensure_future(
+            _broadcast_loop(channel_layer, conversation_id, group_name)
+        )
+
+
+async def _broadcast_loop(channel_layer, conversation_id, group_name):
+    """waits one window, sends the current typing users if they changed, and keeps watching
+    while anybody is still typing so that expired typists are announced too"""
+    state = get_typing_state()
+    window = typing_setting('BROADCAST_WINDOW')
+    last_sent = None
+    try:
+        while True:
+            await asyncio.sleep(window)
+            typing_users = await database_sync_to_async(state.typing_users)(conversation_id)
+            current = [user['user_id'] for user in typing_users]
+            if current != last_sent:
+                await channel_layer.group_send(group_name, typing_users_event(conversation_id, typing_users))
+                last_sent = current
+            if not typing_users:
+                break
+    finally:
+        _pending.pop(conversation_id, None)
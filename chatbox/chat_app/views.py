@@ -5,7 +5,12 @@ from rest_framework.decorators import action
 from .models import *
 from django.utils import timezone
 from rest_framework import viewsets, permissions, status
-from datetime import timedelta, timezone
+from datetime import datetime, timedelta, timezone as dt_timezone
+from .presence import OnlineUserIds, get_presence, presence_setting
+from .typing_state import get_typing_state, typing_users_event
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from users_app.membership import conversation_member_ids, is_participant, user_conversation_ids
 
 # Create your views here.
 class ChatRoomViewSet(viewsets.ModelViewSet):
@@ -13,28 +18,42 @@ class ChatRoomViewSet(viewsets.ModelViewSet):
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = ChatRoomSerializer
     queryset = ChatRoom.objects.all()
+    query_budget = {'list': 2, 'active_rooms': 1} #count and page, the online counts come with the rooms
+    
+    def live_room_counts(self):
+        """True when PRESENCE['ROOM_COUNTS'] says the online counts come from the presence registry"""
+        return presence_setting('ROOM_COUNTS') == 'presence'
     
     def get_queryset(self):
         """get all active chatrooms"""
-        return ChatRoom.objects.filter(is_active=True)
+        rooms = ChatRoom.objects.filter(is_active=True).order_by('id')
+        if self.live_room_counts():
+            return rooms
+        return ChatRoom.with_online_counts(rooms)
+    
+    def get_serializer_context(self):
+        """the live counts are read once per request and shared by every room of the page"""
+        context = super().get_serializer_context()
+        if self.live_room_counts():
+            context['online_counts'] = get_presence().room_counts()
+        return context
     
-    @action(detail=True, methods='post')
+    @action(detail=True, methods=['post'])
     def join_chatroom(self, request, pk=None):
-        """joining a chatroom"""
-        chat_room = self.get_object
+        """joining a chatroom, only a user with an open chat socket is online and can be in a room"""
+        chat_room = self.get_object()
         user = request.user
         
-        online_user, created = OnlineUser.objects.update_or_create(
-            user=user,
-            defaults={
-                'current_room': chat_room,
-                'last_activity': timezone.now()
-            }
-        )
+        #the room lives in the registry, the online_users table (and the "database" counts) get it with the next snapshot
+        presence = get_presence()
+        previous_room_id = presence.current_room_id(user.id)
+        if not presence.set_room(user.id, chat_room.id):
+            return Response({'message': 'You are not online, open the chat socket first'}, status=status.HTTP_400_BAD_REQUEST)
+        #no reload, the live counts are read when the room is serialized and the annotated ones wait for the snapshot
         return Response({
             'message': f"joined {chat_room.name} successfully!",
-            'chat room': ChatRoomSerializer(chat_room).data,
-            'created': created
+            'chat room': self.get_serializer(chat_room).data,
+            'created': previous_room_id is None
         })
     
     @action(detail=True, methods=['post'])    
@@ -43,36 +62,31 @@ class ChatRoomViewSet(viewsets.ModelViewSet):
         user = request.user
         chat_room = self.get_object()
         
-        try: 
-            requested_user = OnlineUser.objects.get(user=user, current_room=chat_room)
-            requested_user.current_room == None
-            requested_user.save()
-            
-            return Response ({'message': f'{user} has sucessfully left the group'})
-        except requested_user.DoesNotExist:
+        if not get_presence().leave_room(user.id, chat_room.id):
             return Response({
                 'message': 'You are not in this room'
             }, status=status.HTTP_400_BAD_REQUEST)
         
+        return Response ({'message': f'{user} has sucessfully left the group',
+                          'chat room': self.get_serializer(chat_room).data})
+        
     @action(detail=True, methods=['get'])
     def online_user(self, request, pk=None):
         """get the total number of online users in a chat room"""
         chat_room = self.get_object()
         
-        online_user = OnlineUser.objects.filter(current_room=chat_room)
+        online_user = OnlineUser.objects.filter(current_room=chat_room).select_related('user', 'current_room')
         serializer = OnlineUserSerializer(online_user, many=True)
-        return Response({
-            serializer.data()
-        }, status=status.HTTP_200_OK)
+        return Response(serializer.data, status=status.HTTP_200_OK)
     
     @action(detail=False, methods=['get'])    
     def active_rooms(self, request):
         """get rooms where a current user is active"""
-        user = request.user
-        rooms = ChatRoom.objects.filter(user=user, is_active=True)
+        room_id = get_presence().current_room_id(request.user.id)
+        rooms = list(self.get_queryset().filter(id=room_id)) if room_id is not None else []
         
-        if rooms.exists(): 
-            serializer = ChatRoomSerializer(rooms, many=True)
+        if rooms: 
+            serializer = self.get_serializer(rooms, many=True)
             return Response(serializer.data, status=status.HTTP_200_OK)
     
         return Response({'message':'You are not active in any room'}, status=status.HTTP_204_NO_CONTENT)
@@ -80,46 +94,77 @@ class ChatRoomViewSet(viewsets.ModelViewSet):
     @action(detail=False, methods=['get'])
     def my_room(self, request):
         """get the room where an active user is"""
-        user = request.user
-        online_user = OnlineUser.objects.get(user=user)
-        
-        try:
-            
-            if online_user.current_room:
-                room_serializer = ChatRoomSerializer(online_user.current_room)
-                return Response (room_serializer.data)
-            else:
-                return Response({'message': 'Not in my room!'})
-            
-        except online_user.DoesNotExist:
+        presence = get_presence()
+        if not presence.is_online(request.user.id):
             return Response ({'message': 'the user is not onine in this room'})
         
+        room_id = presence.current_room_id(request.user.id)
+        room = self.get_queryset().filter(id=room_id).first() if room_id is not None else None
+        if room:
+            room_serializer = self.get_serializer(room)
+            return Response (room_serializer.data)
+        return Response({'message': 'Not in my room!'})
+        
 class OnlineUserViewSet(viewsets.ModelViewSet):
-    """the viewset that manages online users"""
+    """the viewset that manages online users, reads come from the presence registry
+    (chat_app.presence) and not from the online_users table, which is only a periodic snapshot"""
     queryset = OnlineUser.objects.all()
     serializer_class = OnlineUserSerializer
     permission_classes = [permissions.IsAuthenticated]
+    query_budget = {'list': 2, 'get_conversation_users': 3} #users and rooms. the conversation's rooms, its members and their users
     
     
     def get_queryset(self):
         """get the query set of all online users in the past five minutes"""
-        return OnlineUser.objects.filter(last_activity__gte=timezone.now() - timedelta(minutes=5))
+        #OnlineUserSerializer reads user.username, user.avatar and current_room.name
+        return OnlineUser.objects.filter(
+            last_activity__gte=timezone.now() - timedelta(minutes=5)
+        ).select_related('user', 'current_room')
+    
+    def get_online_users(self, user_ids, rooms=None):
+        """builds unsaved OnlineUser objects of the online users among user_ids from the presence registry,
+        in the order of user_ids. users and rooms (unless the caller has them) are loaded with one query
+        each so the serializer never has to hit the database"""
+        entries = {entry.user_id: entry for entry in get_presence().entries(user_ids)}
+        users = User.objects.in_bulk(list(entries))
+        if rooms is None:
+            rooms = ChatRoom.objects.in_bulk({entry.room_id for entry in entries.values() if entry.room_id})
+        
+        online_users = []
+        for user_id in user_ids:
+            entry = entries.get(user_id)
+            if entry is None or user_id not in users:
+                continue
+            online_users.append(OnlineUser(
+                user=users[entry.user_id],
+                current_room=rooms.get(entry.room_id),
+                last_activity=datetime.fromtimestamp(entry.last_seen, tz=dt_timezone.utc),
+            ))
+        return online_users
+    
+    def list(self, request, *args, **kwargs):
+        """list the online users straight from the presence registry, only the ids of the page are read
+        from it and only their users loaded"""
+        online_ids = OnlineUserIds(get_presence())
+        page = self.paginate_queryset(online_ids)
+        if page is not None:
+            serializer = self.get_serializer(self.get_online_users(page), many=True)
+            return self.get_paginated_response(serializer.data)
+        serializer = self.get_serializer(self.get_online_users(online_ids[:]), many=True)
+        return Response(serializer.data)
     
     @action(detail=False, methods=['post'])
     def update_activity(self, request):
         """update the queryset"""
         #check the last activity
-        #if the last activity is greater than five minutes
         #then check if the user is online/active
         #if he is then update it to the current time frame
-        online_user, created = OnlineUser.objects.filter(
-            user=request.user,
-            defaults={'last_activity': timezone.now()}
-        )
-        serializer = self.get_serializer(online_user)
-        return Response(serializer.data)
+        #a REST call is not a connection, only the sockets keep a user online, this moves last_seen forward
+        if not get_presence().touch(request.user.id):
+            return Response({'message': 'user is not online', 'is_online': False}, status=status.HTTP_200_OK)
+        return Response({'message': 'activity updated', 'is_online': True}, status=status.HTTP_200_OK)
     
-    @action(detail=False, methods='get')
+    @action(detail=False, methods=['get'])
     def get_conversation_users(self, request):
         """get online users for a specific conversation"""
         #thinking frame: get the online users by filtering the conversation out
@@ -127,7 +172,10 @@ class OnlineUserViewSet(viewsets.ModelViewSet):
         #we had to get the conversation id from the request
         conversation_id = request.query_params.get('conversation_id')
         if conversation_id:
-            conversation_user = self.get_queryset().filter(current_room__conversation_id=conversation_id)
+            #only the conversation's members are looked up in the registry, not everyone online
+            rooms = ChatRoom.objects.filter(conversation_id=conversation_id).in_bulk()
+            online_users = self.get_online_users(sorted(conversation_member_ids(conversation_id)), rooms=rooms)
+            conversation_user = [online_user for online_user in online_users if online_user.current_room_id in rooms]
             serializer = self.get_serializer(conversation_user, many=True)
             return Response({'online users': serializer.data,
                              'conversation id': conversation_id,
@@ -137,103 +185,139 @@ class OnlineUserViewSet(viewsets.ModelViewSet):
     @action(detail=False, methods=['post'])
     def set_offline(self, request):
         """to set an online user to be offline"""
-        #thinking frame: so since online user represent the user online, deleting the user online means it would be offline
-        #hope it won't cause a bottle neck in our database when we always want to delete a user when they are offline
-        #we first of all have to get the user that is making the request, the person is an online user
-        try:
-            online_user = OnlineUser.objects.get(user=request.user)
-            online_user.delete()
-            return Response({'message': 'user has been set to offline'}, status=status.HTTP_200_OK)
-        except online_user.DoesNotExist:
+        #thinking frame: the registry drops every connection of the user, the online_users row
+        #goes away with the next snapshot
+        presence = get_presence()
+        if not presence.is_online(request.user.id):
             return Response({'message': 'User was not online'})
+        presence.clear(request.user.id)
+        return Response({'message': 'user has been set to offline'}, status=status.HTTP_200_OK)
         
-class TypingIndicatorViewSet(viewsets.ModelViewSet):
+class TypingIndicatorViewSet(viewsets.GenericViewSet):
     """a logic that handles the typing indicator"""
-    queryset = TypingIndicator.objects.all()
+    #everything is served from the typing state (chat_app.typing_state), the typing_indicator table isn't used
     permission_classes = [permissions.IsAuthenticated]
-    serializer_class = TypingIndicatorSerializer
+    serializer_class = TypingStatusSerializer
+    query_budget = {'list': 1} #the membership check, none when the membership cache is warm
     
-    def get_queryset(self):
-        """returns the typing indicator for a user in a particular conversation"""
-        conversation_id = self.request.query_params.get('conversation_id')
-        if conversation_id:
-            return TypingIndicator.objects.filter(is_typing=True, conversation_id=conversation_id).exclude(user=self.request.user)
-        return TypingIndicator.objects.none() #returns an empty queryset
+    def list(self, request):
+        """returns the users typing in ?conversation_id=, the requesting user left out"""
+        conversation_id = self.get_typing_conversation_id(request)
+        if conversation_id is None:
+            return Response({'error': 'a valid conversation_id is required'}, status=status.HTTP_400_BAD_REQUEST)
+        typing_users = [
+            {**user, 'conversation_id': conversation_id, 'is_typing': True}
+            for user in get_typing_state().typing_users(conversation_id, exclude=request.user.id)
+        ]
+        return self.get_paginated_response(self.paginate_queryset(typing_users))
+    
+    def create(self, request):
+        """sets the typing status of the user in a conversation, the same as start_typing and stop_typing"""
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        if serializer.validated_data['is_typing']:
+            return self.start_typing(request)
+        return self.stop_typing(request)
+    
+    def get_typing_conversation_id(self, request):
+        """reads the conversation id from the request and checks the user takes part in it"""
+        conversation_id = request.data.get('conversation_id') or request.query_params.get('conversation_id')
+        try:
+            conversation_id = int(conversation_id)
+        except (TypeError, ValueError):
+            return None
+        #the member set rather than is_participant, typing_users reads the same cached set right after
+        if request.user.id not in conversation_member_ids(conversation_id):
+            return None
+        return conversation_id
     
-    def perform_create(self, serializer):
-        """it's usually used when you need it to carry out a task before saving,
-        in this case, you are setting the user to be a requested user"""
-        #why do we need to set the user before we create a typing indicator instance?
-        #because we want to make sure that the typing instance created is tied to the requested user,
-        #and we can only get it by 
-        serializer.save(user=self.request.user)
+    def broadcast_typing_users(self, conversation_id):
+        """REST typing changes are rare, so they push the current typing users straight away"""
+        async_to_sync(get_channel_layer().group_send)(
+            f'chat_{conversation_id}',
+            typing_users_event(conversation_id, get_typing_state().typing_users(conversation_id)),
+        )
     
     @action(detail=False, methods=['post'])    
     def start_typing(self, request):
         """start typing in a conversation"""
         #in order to incorportate start typing logic, you have to get the conversation id from the request
         #not just conversation_id, get the user
-        serializer = TypingIndicatorSerializer(data=request.data)
-        if serializer.is_valid():
-            conversation_id = serializer.validated_data('conversation_id')
-            typing_indicator, created = TypingIndicator.objects.update_or_create(
-                conversation_id=conversation_id,
-                user=request.user,
-                defaults={'is_typing': True}
-            )
-            response_serializer = TypingIndicatorSerializer(typing_indicator)
-            return Response(response_serializer.data, status=status.HTTP_200_OK)
-        return Response(serializer.errors, status=status.HTTP_200_OK)
+        #the typing state is memory only (chat_app.typing_state), nothing is written to the database
+        conversation_id = self.get_typing_conversation_id(request)
+        if conversation_id is None:
+            return Response({'error': 'a valid conversation_id is required'}, status=status.HTTP_400_BAD_REQUEST)
+        if get_typing_state().start(conversation_id, request.user.id, request.user.username):
+            self.broadcast_typing_users(conversation_id)
+        return Response({'conversation_id': conversation_id, 'is_typing': True}, status=status.HTTP_200_OK)
     
     @action(detail=False, methods=['post'])
     def stop_typing(self, request):
         """stop typping in a conversation"""
-        #we have to get the conversation id  from the serialized data
-        serializer = TypingIndicatorSerializer(data=request.data)
-        
-        if serializer.is_valid():
-            conversation_id = serializer.validated_data('conversation_id')
-            TypingIndicator.objects.filter(
-                conversation_id=conversation_id,
-                user=request.user,
-                defaults={'is_typing': False}
-            ).delete()
-            return Response({'message': 'stopped typing'}, status=status.HTTP_200_OK)
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        #we have to get the conversation id from the request
+        conversation_id = self.get_typing_conversation_id(request)
+        if conversation_id is None:
+            return Response({'error': 'a valid conversation_id is required'}, status=status.HTTP_400_BAD_REQUEST)
+        if get_typing_state().stop(conversation_id, request.user.id):
+            self.broadcast_typing_users(conversation_id)
+        return Response({'message': 'stopped typing'}, status=status.HTTP_200_OK)
     
-    @action(detail=True, methods=['get'])
+    @action(detail=False, methods=['get'])
     def who_is_typing(self, request):
         """get who is typing in a conversation"""
-        #get the conversation
-        #get the user
+        #served from the typing state, there is no database round trip
         conversation_id = self.request.query_params.get('conversation_id')
         if not conversation_id:
             """we want to handle and make sure that there is a conversation before we can be able
             to find who is typing"""
             return Response({'error': 'conversation id required'}, status=status.HTTP_400_BAD_REQUEST)
-        typing_users = TypingIndicator.objects.filter(
-            conversation_id=conversation_id,
-            is_typing=True,
-        ).exclude(user=request.user)
+        try:
+            conversation_id = int(conversation_id)
+        except ValueError:
+            return Response({'error': 'conversation id must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+        if not is_participant(conversation_id, request.user.id):
+            return Response({'error': 'conversation not found'}, status=status.HTTP_404_NOT_FOUND)
         
-        serializer = TypingIndicator(typing_users, many=True)
+        typing_users = get_typing_state().typing_users(conversation_id, exclude=request.user.id)
         return Response({'conversation_id': conversation_id,
-                         'who_is_typing': serializer.data,
-                         'count': len(serializer.data)}, status=status.HTTP_200_OK)
+                         'who_is_typing': typing_users,
+                         'count': len(typing_users)}, status=status.HTTP_200_OK)
         
 class MessageDeliveryStatusViewSet(viewsets.ModelViewSet):
     """manages the functional viewset of message delivery"""
     queryset = MessageDeliveryStatus.objects.all()
     serializer_class = MessageDeliveryStatusSerializer
-    permission_classes = permissions.IsAuthenticated
+    permission_classes = [permissions.IsAuthenticated]
+    query_budget = {'list': 3} #membership, the message, and the watermarks with their users
     
     def get_queryset(self):
         """return delivery status for a particular message"""
         message_id = self.request.query_params.get('message_id')
         if message_id:
-            return MessageDeliveryStatus.objects.filter(message_id=message_id)
+            return MessageDeliveryStatus.objects.filter(message_id=message_id).select_related('user')
         return MessageDeliveryStatus.objects.none()
     
+    def get_message(self, message_id):
+        """the message, if it is in one of the requesting user's conversations"""
+        try:
+            return Message.objects.filter(
+                id=int(message_id),
+                conversation_id__in=user_conversation_ids(self.request.user.id),
+            ).first()
+        except (TypeError, ValueError):
+            return None
+    
+    def list(self, request, *args, **kwargs):
+        """who has the message ("seen by"), computed from the conversation read watermarks"""
+        message = self.get_message(request.query_params.get('message_id'))
+        statuses = ConversationReadState.seen_by(message) if message else []
+        page = self.paginate_queryset(statuses)
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+        serializer = self.get_serializer(statuses, many=True)
+        return Response(serializer.data)
+    
     @action(detail=False, methods=['post'])
     def mark_delivered(self, request):
         """marks a particular message as read"""
@@ -243,17 +327,8 @@ class MessageDeliveryStatusViewSet(viewsets.ModelViewSet):
         if serializer.is_valid():
             message_ids = serializer.validated_data['message_id']
             
-            #tracks created instances, for easy debug
-            updated_count = 0
-            
-            for message_id in message_ids:
-                updated_status, created = MessageDeliveryStatus.objects.update_or_create(
-                    message_id=message_id,
-                    user=request.user,
-                    defaults={'delivery_status': 'delivered'}
-                )
-                if created or updated_status.delivery_status != 'delivered':
-                    updated_count += 1
+            #moves the delivered watermarks, a message that was already read stays read and isn't counted
+            updated_count = MessageDeliveryStatus.bulk_mark(request.user.id, message_ids, 'delivered')
             return Response({'message': f'{updated_count} messages were delivered',
                                  'updated_count': updated_count})
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -264,24 +339,13 @@ class MessageDeliveryStatusViewSet(viewsets.ModelViewSet):
         #first of all have to get the serialized request data, which serializer? - use bulk serializer
         #check if the serialized data is valid
         #supposed to get the message_id from the serialized data
-        #use the validated data to create or update the user, message_id and status
+        #MessageDeliveryStatus.bulk_mark moves the read watermarks and only counts messages that actually changed
         serializer = BulkMessageStatusSerializer(data=request.data)
         
         if serializer.is_valid():
             """get the message from the serialized data"""
             message_ids = serializer.validated_data['message_id']
-            updated_count = 0 #to track the number of messages that has probably been created and not on read mode
-            
-            for message_id in message_ids:
-                updated_status, created = MessageDeliveryStatus.objects.update_or_create(
-                    user=request.user,
-                    message_id=message_id,
-                    defaults={'delivery_status': 'read'},
-                )
-                
-                #checks if created or the updated status is not on read and increments
-                if created or updated_status.delivery_status != 'read':
-                    updated_count += 1
+            updated_count = MessageDeliveryStatus.bulk_mark(request.user.id, message_ids, 'read')
             return Response({'message': f'{updated_count} messages has been read',
                              'updated_count': updated_count}, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -298,13 +362,17 @@ class MessageDeliveryStatusViewSet(viewsets.ModelViewSet):
         if not message_id:
             return Response({'error': 'message_id is required'}, status=status.HTTP_400_BAD_REQUEST)
         
-        status_message = MessageDeliveryStatus.objects.filter(
+        #the status comes from the user's read watermark in the message's conversation
+        message = self.get_message(message_id)
+        state = ConversationReadState.objects.filter(
             user=request.user,
-            message_id=message_id,   
-        )
-        if not status_message.exists():
+            conversation_id=message.conversation_id,
+        ).first() if message else None
+        delivery_status = state.status_of(message.id) if state else None
+        if delivery_status is None:
                 return Response({'message': 'this message_id do not have a delivery status'}, status=status.HTTP_404_NOT_FOUND)
         
+        status_message = [MessageDeliveryStatus(message=message, user=request.user, delivery_status=delivery_status, timestamp=state.updated_at)]
         serializer = MessageDeliveryStatusSerializer(status_message, many=True)
         return Response({'message': serializer.data}, status=status.HTTP_200_OK)
         
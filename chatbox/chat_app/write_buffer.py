@@ -0,0 +1,178 @@
+import asyncio
+import sys
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from chatbox_project.instrumentation import finish_sample, start_sample
+from users_app.models import Message
+from users_app.signals import messages_created
+
+#WRITE-BEHIND BUFFER FOR CHAT MESSAGES
+#ChatConsumer.save_message hands its message to the buffer and awaits it. the buffer groups the messages
+#of every socket in this process into one bulk_create per batch (BATCH_SIZE rows or MAX_DELAY seconds,
+#whichever comes first), so a busy worker does one insert per batch instead of one per frame.
+#
+#durability: a message is only acknowledged to its sender after the batch holding it has committed,
+#so an ack always carries the real message id. messages still waiting in the buffer when the process
+#dies were never acknowledged, the client can resend them. a graceful shutdown should await close(),
+#which writes everything that is still queued. a closed buffer stays the loop's buffer and refuses later
+#messages with BufferClosed, the consumer turns that into an error frame so the client resends.
+
+DEFAULTS = {
+    'BATCH_SIZE': 100,
+    'MAX_DELAY': 0.01,
+}
+
+
+def buffer_setting(name):
+    """reads a key from settings.MESSAGE_WRITE_BUFFER, falling back to the defaults above"""
+    return getattr(settings, 'MESSAGE_WRITE_BUFFER', {}).get(name, DEFAULTS[name])
+
+
+class BufferClosed(RuntimeError):
+    """the buffer is shutting down and takes no more messages"""
+
+
+class MessageWriteBuffer:
+    """batches Message inserts coming from many websocket connections"""
+    def __init__(self, batch_size=None, max_delay=None):
+        self.batch_size = batch_size or buffer_setting('BATCH_SIZE')
+        self.max_delay = buffer_setting('MAX_DELAY') if max_delay is None else max_delay
+        self.queue = asyncio.Queue()
+        self.worker = None
+        self.closed = False
+
+    async def submit(self, sender_id, conversation_id, content, message_types='text'):
+        """queues a message and waits until it is in the database, returns the saved Message"""
+        if self.closed:
+            raise BufferClosed('the message write buffer is closed')
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.ensure_future(self._run())
+        future = asyncio.get_running_loop().create_future()
+        message = Message(
+            sender_id=sender_id,
+            conversation_id=conversation_id,
+            content=content,
+            message_types=message_types,
+        )
+        await self.queue.put((message, future))
+        return await future
+
+    async def close(self):
+        """stops taking messages and writes whatever is still queued"""
+        self.closed = True
+        if self.worker is not None and not self.worker.done():
+            await self.queue.join()
+            self.worker.cancel()
+
+    async def _run(self):
+        """collects a batch, writes it, repeats"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                results = await database_sync_to_async(self._write)([message for message, _ in batch])
+                for (_, future), result in zip(batch, results):
+                    if future.done():
+                        continue
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+            except Exception as exc:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _write(self, messages):
+        """writes a batch, measured as its own instrumentation sample since it serves many sockets"""
+        sample, token = start_sample('task', 'MessageWriteBuffer.write')
+        try:
+            return self._write_batch(messages)
+        finally:
+            finish_sample(sample, token, messages=len(messages))
+
+    def _write_batch(self, messages):
+        """one bulk_create for the whole batch, if it fails (a conversation was deleted, ...) the rows
+        are written one by one so only the bad ones fail"""
+        #bulk_create only gives the ids back on databases that support RETURNING (postgres, sqlite 3.35+)
+        if connection.features.can_return_rows_from_bulk_insert:
+            try:
+                with transaction.atomic():
+                    saved = Message.objects.bulk_create(messages)
+                    #bulk_create sends no post_save, so everything derived from new messages (conversation
+                    #summaries, unread counters) is updated here, in the same transaction
+                    messages_created.send(sender=Message, messages=saved)
+                    return saved
+            except DatabaseError:
+                pass
+
+        results = []
+        for message in messages:
+            message.pk = None
+            try:
+                with transaction.atomic():
+                    message.save(force_insert=True)
+                results.append(message)
+            except DatabaseError as exc:
+                results.append(exc)
+        return results
+
+
+_buffers = {} #one buffer per event loop
+
+
+def get_message_buffer():
+    """returns the write buffer of the running event loop"""
+    loop = asyncio.get_running_loop()
+    buffer = _buffers.get(loop)
+    if buffer is None:
+        for old_loop in [old_loop for old_loop in _buffers if old_loop.is_closed()]:
+            del _buffers[old_loop]
+        buffer = _buffers[loop] = MessageWriteBuffer()
+    return buffer
+
+
+async def close_message_buffers():
+    """flushes the buffer of the running loop, call it on graceful shutdown. the closed buffer is kept so
+    messages arriving afterwards are refused instead of going to a new buffer nobody flushes"""
+    await get_message_buffer().close()
+
+
+#SHUTDOWN
+#asgi.py flushes the buffers when the server stops: servers speaking the ASGI lifespan protocol (uvicorn,
+#hypercorn) through lifespan below, daphne (which has no lifespan) through a twisted shutdown trigger,
+#twisted waits for the flush before it stops the loop.
+
+async def lifespan(scope, receive, send):
+    """the ASGI lifespan application, flushes the buffers on lifespan.shutdown"""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_message_buffers()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+def install_daphne_shutdown_hook():
+    """flushes the buffers before daphne's reactor shuts down, does nothing outside of daphne (no reactor)"""
+    reactor = sys.modules.get('twisted.internet.reactor')
+    if reactor is None:
+        return False
+    from twisted.internet.defer import Deferred
+    reactor.addSystemEventTrigger('before', 'shutdown', lambda: Deferred.fromFuture(asyncio.ensure_future(close_message_buffers())))
+    return True
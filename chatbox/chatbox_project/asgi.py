@@ -2,7 +2,6 @@ import os
 
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 from channels.security.websocket import AllowedHostsOriginValidator
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "chatbox_project.settings")
@@ -12,11 +11,17 @@ django_asgi_app = get_asgi_application()
 
 #import websocket routing directly to avid premature model loading
 from chat_app.routing import websocket_urlpatterns
+from chat_app.jwt_auth import JWTAuthMiddlewareStack
+from chat_app.write_buffer import install_daphne_shutdown_hook, lifespan
+
+#messages still in the write buffer are written before the process stops
+install_daphne_shutdown_hook()
 
 application = ProtocolTypeRouter({
         'http' : django_asgi_app,
+        'lifespan' : lifespan,
         'websocket' : AllowedHostsOriginValidator(
-            AuthMiddlewareStack(
+            JWTAuthMiddlewareStack(
             URLRouter(
                 websocket_urlpatterns
             )
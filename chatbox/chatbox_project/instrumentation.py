@@ -0,0 +1,318 @@
+import contextvars
+import json
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse, HttpResponseForbidden
+from django.views import View
+
+#REQUEST / WEBSOCKET EVENT INSTRUMENTATION
+#every sampled unit of work (a REST request, a websocket event handled by a consumer, a write buffer
+#batch) gets a Sample that counts its queries, database time, serialization time and payload size.
+#serialization time is what InstrumentedSerializerMixin serializers spend in to_representation, the
+#DRF renderer and the websocket codecs.
+#samples are kept in a contextvar, asgiref copies it into database_sync_to_async threads so queries
+#run there are counted too. finished samples are added to the per-process registry, exported as
+#prometheus text at /metrics, and with LOG_SAMPLES on written as one json log line to the INSTRUMENTATION['LOGGER'] logger.
+#REST samples are named after the resolved view only, everything that doesn't resolve (404s, probes) shares
+#the 'unresolved' name so clients can't grow the registry and the prometheus labels with made up paths.
+#
+#views can declare a query_budget (an int, or {action: int} for viewsets). with ENFORCE_BUDGETS on
+#(tests) a request that goes over it raises QueryBudgetExceeded, assert_query_budget does the same
+#for any block of test code.
+
+DEFAULTS = {
+    'ENABLED': True,
+    'SAMPLE_RATE': 1.0,
+    'LOGGER': 'chatbox.instrumentation',
+    'LOG_SAMPLES': False,
+    'ENFORCE_BUDGETS': False,
+    'METRICS_ALLOWED_IPS': ['127.0.0.1', '::1'],
+}
+
+
+def instrumentation_setting(name):
+    """reads a key from settings.INSTRUMENTATION, falling back to the defaults above"""
+    return getattr(settings, 'INSTRUMENTATION', {}).get(name, DEFAULTS[name])
+
+
+class QueryBudgetExceeded(AssertionError):
+    """a view or a block of code ran more queries than it is allowed to"""
+
+
+class Sample:
+    """the measurements of one request or websocket event"""
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.serializer_depth = 0
+        self.payload_bytes = 0
+        self.budget = None
+        self.started = time.perf_counter()
+        self.closed = False
+
+    def as_dict(self, duration, **extra):
+        return {
+            'kind': self.kind,
+            'name': self.name,
+            'queries': self.queries,
+            'db_ms': round(self.db_time * 1000, 3),
+            'serializer_ms': round(self.serializer_time * 1000, 3),
+            'payload_bytes': self.payload_bytes,
+            'duration_ms': round(duration * 1000, 3),
+            **extra,
+        }
+
+
+_current = contextvars.ContextVar('instrumentation_sample', default=None)
+
+
+def current_sample():
+    """the open sample of the running request/event, None when it isn't sampled"""
+    sample = _current.get()
+    if sample is None or sample.closed:
+        return None
+    return sample
+
+
+def start_sample(kind, name):
+    """opens a sample if this unit of work is picked by SAMPLE_RATE, returns (sample or None, reset token)"""
+    if not instrumentation_setting('ENABLED') or random.random() >= instrumentation_setting('SAMPLE_RATE'):
+        return None, _current.set(None)
+    install()
+    sample = Sample(kind, name)
+    return sample, _current.set(sample)
+
+
+def finish_sample(sample, token, enforce=True, **extra):
+    """closes the sample, adds it to the registry and logs it"""
+    _current.reset(token)
+    if sample is None:
+        return
+    sample.closed = True
+    duration = time.perf_counter() - sample.started
+    registry.add(sample, duration)
+    if instrumentation_setting('LOG_SAMPLES'):
+        logging.getLogger(instrumentation_setting('LOGGER')).info(json.dumps(sample.as_dict(duration, **extra)))
+    if enforce and sample.budget is not None and sample.queries > sample.budget and instrumentation_setting('ENFORCE_BUDGETS'):
+        raise QueryBudgetExceeded(f'{sample.name} ran {sample.queries} queries, its budget is {sample.budget}')
+
+
+@contextmanager
+def measure_serialization():
+    """adds the time of the block to the current sample's serializer time, nested blocks count once"""
+    sample = current_sample()
+    if sample is None:
+        yield
+        return
+    sample.serializer_depth += 1
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        sample.serializer_depth -= 1
+        if sample.serializer_depth == 0:
+            sample.serializer_time += time.perf_counter() - started
+
+
+def record_payload(size):
+    """adds size bytes to the current sample's payload"""
+    sample = current_sample()
+    if sample is not None:
+        sample.payload_bytes += size
+
+
+def label_sample(suffix):
+    """refines the name of the current sample, e.g. ChatConsumer.receive -> ChatConsumer.receive:chat_message"""
+    sample = current_sample()
+    if sample is not None:
+        sample.name = f'{sample.name}:{suffix}'
+
+
+#QUERY COUNTING, an execute wrapper on every connection that only works while a sample is open
+def count_query(execute, sql, params, many, context):
+    sample = current_sample()
+    if sample is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        sample.queries += 1
+        sample.db_time += time.perf_counter() - started
+
+
+def wrap_connection(connection, **kwargs):
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+_installed = False
+_install_lock = threading.Lock()
+
+
+def install():
+    """hooks the query counter into every database connection, once per process"""
+    global _installed
+    if _installed:
+        return
+    with _install_lock:
+        if _installed:
+            return
+        connection_created.connect(wrap_connection)
+        for alias in connections:
+            wrap_connection(connections[alias])
+        _installed = True
+
+
+#REGISTRY AND PROMETHEUS EXPORT
+class Registry:
+    """per-process totals by (kind, name), every worker process exports its own"""
+    fields = ('count', 'queries', 'db_seconds', 'serializer_seconds', 'payload_bytes', 'duration_seconds', 'over_budget')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = {}
+
+    def add(self, sample, duration):
+        with self.lock:
+            totals = self.totals.setdefault((sample.kind, sample.name), dict.fromkeys(self.fields, 0))
+            totals['count'] += 1
+            totals['queries'] += sample.queries
+            totals['db_seconds'] += sample.db_time
+            totals['serializer_seconds'] += sample.serializer_time
+            totals['payload_bytes'] += sample.payload_bytes
+            totals['duration_seconds'] += duration
+            if sample.budget is not None and sample.queries > sample.budget:
+                totals['over_budget'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.totals = {}
+
+    def prometheus_text(self):
+        metrics = [
+            ('count', 'chatbox_samples_total', 'sampled requests and websocket events'),
+            ('queries', 'chatbox_db_queries_total', 'database queries of the sampled work'),
+            ('db_seconds', 'chatbox_db_seconds_total', 'time spent in the database'),
+            ('serializer_seconds', 'chatbox_serializer_seconds_total', 'time spent serializing payloads'),
+            ('payload_bytes', 'chatbox_payload_bytes_total', 'bytes of response bodies and websocket frames'),
+            ('duration_seconds', 'chatbox_duration_seconds_total', 'wall time of the sampled work'),
+            ('over_budget', 'chatbox_query_budget_exceeded_total', 'samples that ran more queries than their budget'),
+        ]
+        with self.lock:
+            totals = sorted(self.totals.items())
+        lines = []
+        for field, metric, description in metrics:
+            lines.append(f'# HELP {metric} {description}')
+            lines.append(f'# TYPE {metric} counter')
+            for (kind, name), values in totals:
+                name = name.replace('\\', '\\\\').replace('"', '\\"')
+                lines.append(f'{metric}{{kind="{kind}",name="{name}"}} {values[field]}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def metrics_view(request):
+    """prometheus scrape endpoint, only answers the allowed addresses"""
+    if request.META.get('REMOTE_ADDR') not in instrumentation_setting('METRICS_ALLOWED_IPS'):
+        return HttpResponseForbidden()
+    return HttpResponse(registry.prometheus_text(), content_type='text/plain; version=0.0.4')
+
+
+#REST
+UNRESOLVED = 'unresolved'
+
+
+class InstrumentationMiddleware:
+    """samples REST requests, named after the viewset action (MessageViewSet.list) or the url name, 'unresolved'
+    when no view matched"""
+    def __init__(self, get_response):
+        self.get_response = get_response
+        install()
+
+    def __call__(self, request):
+        sample, token = start_sample('http', UNRESOLVED)
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            finish_sample(sample, token, enforce=False, method=request.method, status=500)
+            raise
+        if sample is not None and not response.streaming:
+            sample.payload_bytes += len(response.content)
+        finish_sample(sample, token, method=request.method, status=response.status_code)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        sample = current_sample()
+        if sample is None:
+            return None
+        view_class = getattr(view_func, 'cls', None) or getattr(view_func, 'view_class', None)
+        actions = getattr(view_func, 'actions', None) or {}
+        method = request.method.lower()
+        action = actions.get(method)
+        if view_class is not None:
+            #the method is the client's too, made up ones are counted together
+            if method not in View.http_method_names:
+                method = 'other'
+            sample.name = f'{view_class.__name__}.{action or method}'
+        elif request.resolver_match is not None:
+            sample.name = request.resolver_match.view_name
+        budget = getattr(view_class or view_func, 'query_budget', None)
+        if isinstance(budget, dict):
+            budget = budget.get(action)
+        sample.budget = budget
+        return None
+
+    def process_template_response(self, request, response):
+        """DRF responses are rendered after the view, the renderer counts as serialization too"""
+        sample = current_sample()
+        if sample is not None:
+            started = time.perf_counter()
+
+            def rendered(response):
+                sample.serializer_time += time.perf_counter() - started
+            response.add_post_render_callback(rendered)
+        return response
+
+
+class InstrumentedSerializerMixin:
+    """counts to_representation as serializer time, for many=True every item is timed on its own
+    and nested serializers count once inside their parent"""
+    def to_representation(self, instance):
+        with measure_serialization():
+            return super().to_representation(instance)
+
+
+#WEBSOCKETS
+class InstrumentedConsumerMixin:
+    """samples every event a consumer handles (connect, receive, group events, disconnect)"""
+    async def dispatch(self, message):
+        handler = message['type'].replace('websocket.', '').replace('.', '_')
+        sample, token = start_sample('ws', f'{type(self).__name__}.{handler}')
+        try:
+            await super().dispatch(message)
+        finally:
+            finish_sample(sample, token)
+
+
+#TESTS
+@contextmanager
+def assert_query_budget(max_queries, using='default'):
+    """fails the test when the block runs more than max_queries queries, listing them"""
+    from django.test.utils import CaptureQueriesContext
+    with CaptureQueriesContext(connections[using]) as captured:
+        yield captured
+    if len(captured) > max_queries:
+        queries = '\n'.join(f'{n}. {query["sql"]}' for n, query in enumerate(captured.captured_queries, start=1))
+        raise QueryBudgetExceeded(f'{len(captured)} queries ran, the budget is {max_queries}:\n{queries}')
@@ -39,6 +39,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres", #trigram lookups for the user search
     "chat_app",
     "users_app",
     "notifications",
@@ -62,18 +63,21 @@ REST_FRAMEWORK = {
         'rest_framework_simplejwt.authentication.JWTAuthentication',
     ],
     'DEFAULT_PAGINATION_CLASS': 
-        'rest_framework.pagination.PageNumberPagination',
+        'users_app.pagination.PageSizePagination',
         'PAGE_SIZE': 20,
 }
 
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME' : timedelta(minutes=60),
     'REFRESH_TOKEN_LIFETIME' : timedelta(days=7),
-    'ROTATE_REFRESH_TOKEN' : True,
+    'ROTATE_REFRESH_TOKENS' : True,
     'BLACKLIST_AFTER_ROTATION' : True,
+    'TOKEN_OBTAIN_SERIALIZER' : 'users_app.serializers.ChatboxTokenObtainPairSerializer', #adds the username claim
+    'TOKEN_REFRESH_SERIALIZER' : 'users_app.serializers.ChatboxTokenRefreshSerializer', #blacklist through users_app.blacklist
 }
 
 MIDDLEWARE = [
+    "chatbox_project.instrumentation.InstrumentationMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -135,6 +139,161 @@ CHANNEL_LAYERS = {
 }
 
 
+#shared cache, presence and the other in-memory state live here so every daphne worker sees the same data
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": "redis://{host}:{port}/1".format(
+            host=config("REDIS_HOST", default="redis"),
+            port=config("REDIS_PORT", default=6379),
+        ),
+        "OPTIONS": {
+            "password": config("REDIS_PASSWORD", default=None),
+        },
+    },
+}
+
+#presence registry (chat_app.presence), who is online is kept in the cache and only snapshotted to postgres
+PRESENCE = {
+    "BACKEND": "chat_app.presence.RedisPresenceBackend", #needs a RedisCache CACHE_ALIAS, CachePresenceBackend works on any cache. use chat_app.presence.InMemoryPresenceBackend in tests
+    "TTL": 90, #seconds a connection stays online without a heartbeat
+    "SNAPSHOT_INTERVAL": 30, #seconds between batched writes to the online_users table
+    "ROOM_COUNTS": "database", #room online counts annotated from online_users (as of the last snapshot), "presence" reads the live registry
+}
+
+#typing indicators (chat_app.typing_state), memory only with one coalesced broadcast per window
+TYPING = {
+    "TTL": 6, #seconds a start_typing frame keeps the user typing
+    "BROADCAST_WINDOW": 0.5, #seconds, at most one "who is typing" frame per conversation per window
+}
+
+#chat messages from websockets are inserted in batches (chat_app.write_buffer), the sender is acked after commit
+MESSAGE_WRITE_BUFFER = {
+    "BATCH_SIZE": 100, #rows per bulk_create
+    "MAX_DELAY": 0.01, #seconds a message waits for its batch to fill up
+}
+
+#websocket broadcasts are coalesced per group (chat_app.fanout), clients connecting with a batch
+#subprotocol get the events of a TICK as one array frame
+FANOUT = {
+    "TICK": 0.02, #seconds frames wait for others to share their websocket write
+    "MAX_BATCH": 100, #events per batched frame
+}
+
+#websocket frame encoding per connection (chat_app.frame_codecs), chosen by subprotocol:
+#<PREFIX>.json, <PREFIX>.msgpack, with .batch appended for batched frames
+WEBSOCKET_CODECS = {
+    "PREFIX": "chatbox",
+    "ENABLED": ["json", "msgpack"], #json is always available, orjson is used for it when installed
+}
+
+#conversation membership cache (users_app.membership), invalidated by signals on Conversation.participants
+MEMBERSHIP_CACHE = {
+    "TIMEOUT": 3600, #seconds
+}
+
+#block graph cache (users_app.blocking), one entry of blocked/blocked-by ids per user, invalidated by
+#signals on User.blocker_users
+BLOCK_CACHE = {
+    "TIMEOUT": 3600, #seconds
+}
+
+#user search (users_app.search), trigram indexes on postgres and a plain icontains scan elsewhere
+USER_SEARCH = {
+    "MODE": "auto", #'trigram', 'basic', or 'auto' to use trigram on postgres
+    "MIN_LENGTH": 2, #shorter queries are refused
+    "EXCLUDE_BLOCKED": True, #default of the exclude_blocked query param
+}
+
+#message full-text search (users_app.message_search), a maintained tsvector column with a GIN index on postgres
+MESSAGE_SEARCH = {
+    "MODE": "auto", #'fulltext', 'basic', or 'auto' to use fulltext on postgres
+    "CONFIG": "simple", #text search configuration, run reindex_messages after changing it
+    "MIN_LENGTH": 2,
+    "CHUNK_SIZE": 5000, #ids per UPDATE in reindex_messages
+}
+
+#notification settings resolver (notifications.preferences), an LRU per process, saves invalidate the entry in
+#the saving process and the others reload it after TIMEOUT
+NOTIFICATION_PREFERENCES = {
+    "MAX_ENTRIES": 20000, #users kept per process
+    "TIMEOUT": 60, #seconds
+}
+
+#websocket token authentication (chat_app.jwt_auth), ?token=<access> or the subprotocols ['chatbox.jwt', <access>]
+WEBSOCKET_AUTH = {
+    "QUERY_PARAM": "token",
+    "SUBPROTOCOL": "chatbox.jwt",
+    "CACHE_SIZE": 10000, #verified tokens kept per process until they expire
+}
+
+#refresh token blacklist (users_app.blacklist), a bloom filter per process in front of the shared cache and the
+#token_blacklist tables. flush_expired_tokens clears the expired rows
+TOKEN_BLACKLIST = {
+    "BLOOM_CAPACITY": 1000000, #jtis per filter, it is rebuilt bigger when full
+    "BLOOM_ERROR_RATE": 0.001,
+    "SYNC_INTERVAL": 1.0, #seconds before a token blacklisted by another process is refused here, 0 for always
+    "FLUSH_CHUNK_SIZE": 10000, #rows per DELETE
+}
+
+#password hashes run in a bounded pool (users_app.login). ModelBackend stays listed after it so sessions
+#that were logged in through it (admin, session authenticated sockets) are still accepted, it never checks
+#a password because PooledModelBackend ends the login with PermissionDenied when one is wrong
+AUTHENTICATION_BACKENDS = ["users_app.login.PooledModelBackend", "django.contrib.auth.backends.ModelBackend"]
+LOGIN = {
+    "HASH_WORKERS": config("LOGIN_HASH_WORKERS", cast=int, default=4), #hashes at once per process, about the cpus it may use
+}
+
+#bulk user import (users_app.bulk_import), the import_users command and POST users/bulk_import/
+USER_IMPORT = {
+    "CHUNK_SIZE": 1000, #rows validated, hashed and inserted together
+    "PROCESSES": None, #hashing processes of the command, None for one per cpu
+    "MAX_API_ROWS": 100, #about 30s of PBKDF2 per request, bigger imports go through the command
+    "API_WORKERS": 2, #hashing threads of API imports, apart from the login pool
+}
+
+#message attachments (users_app.attachments), uploads are hashed as they stream in, downloads support Range and ETag
+ATTACHMENTS = {
+    "STORAGE": "attachments", #alias in STORAGES
+    "MAX_SIZE": config("ATTACHMENTS_MAX_SIZE", cast=int, default=100 * 1024 * 1024), #bytes per file
+    "CHUNK_SIZE": 64 * 1024, #bytes per read when streaming a download
+    "SENDFILE": config("ATTACHMENTS_SENDFILE", default=None), #'X-Accel-Redirect' behind nginx, 'X-Sendfile' behind apache
+    "SENDFILE_ROOT": "/protected-attachments/", #internal location the proxy maps to the storage location
+    "CACHE_MAX_AGE": 86400,
+}
+
+#send_bulk_notifications pipeline (notifications.bulk), recipients are filtered, inserted and pushed a chunk at a time
+BULK_NOTIFICATIONS = {
+    "CHUNK_SIZE": 2000, #recipients per settings query / transaction
+    "BATCH_SIZE": 500, #rows per INSERT
+    "MAX_IN_FLIGHT": 200, #pending group_sends before the pushes wait
+    "BACKGROUND_THRESHOLD": 5000, #bigger audiences run in a thread and are polled with bulk_progress
+    "PROGRESS_TIMEOUT": 3600, #seconds the progress of a job is kept
+    "STALE_AFTER": 300, #seconds without progress before a running job counts as orphaned and is marked failed
+}
+
+#query count / db time / serializer time / payload size per REST action and websocket event
+#(chatbox_project.instrumentation), exported at /metrics and, with LOG_SAMPLES, logged as one json line per sample
+INSTRUMENTATION = {
+    "ENABLED": True,
+    "SAMPLE_RATE": config("INSTRUMENTATION_SAMPLE_RATE", cast=float, default=0.1), #share of requests/events measured
+    "LOG_SAMPLES": config("INSTRUMENTATION_LOG_SAMPLES", cast=bool, default=False), #a json line per sample on the chatbox.instrumentation logger
+    "ENFORCE_BUDGETS": False, #turned on in tests, views over their query_budget fail
+    "METRICS_ALLOWED_IPS": ["127.0.0.1", "::1"], #who may scrape /metrics
+}
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {
+        "console": {"class": "logging.StreamHandler"},
+    },
+    "loggers": {
+        "chatbox.instrumentation": {"handlers": ["console"], "level": "INFO", "propagate": False},
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -172,8 +331,16 @@ USE_TZ = True
 STATIC_URL = "static/"
 STATIC_ROOT = BASE_DIR / "staticfiles" #where collected statics put files
 
-#Enabling compressed gzip files
-STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
+#Enabling compressed gzip files, and the storage of message attachments (users_app.attachments)
+STORAGES = {
+    "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+    "staticfiles": {"BACKEND": "whitenoise.storage.CompressedManifestStaticFilesStorage"},
+    #any Storage works (s3 through django-storages), attachments are only served through the API
+    "attachments": {
+        "BACKEND": "django.core.files.storage.FileSystemStorage",
+        "OPTIONS": {"location": config("ATTACHMENTS_ROOT", default=str(BASE_DIR / "attachments"))},
+    },
+}
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
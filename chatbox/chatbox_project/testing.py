@@ -0,0 +1,31 @@
+from django.core.cache import cache
+from .instrumentation import assert_query_budget
+
+#SHARED TEST HELPERS
+#settings the app tests override and the query count checks every list endpoint goes through.
+#the tests apply the settings themselves with override_settings, it can't decorate a plain mixin.
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+ENFORCED_BUDGETS = {'SAMPLE_RATE': 1.0, 'ENFORCE_BUDGETS': True, 'LOG_SAMPLES': False}
+
+
+class QueryCountTestMixin:
+    """for TestCases with an authenticated self.client: a list endpoint runs the same number of queries
+    for a page of 1 and a page of 100, and stays within the query_budget of its viewset"""
+    PAGE_SIZES = (1, 100)
+
+    def check_page(self, data, page_size):
+        """checks the body of one page, override to check more than its length"""
+        self.assertEqual(len(data['results']), page_size)
+
+    def assert_constant_queries(self, viewset, url, params=None, action='list'):
+        """requests every page size with cold caches and compares their query counts"""
+        budget = viewset.query_budget[action]
+        counts = {}
+        for page_size in self.PAGE_SIZES:
+            cache.clear()
+            with self.subTest(page_size=page_size), assert_query_budget(budget) as queries:
+                response = self.client.get(url, {**(params or {}), 'page_size': page_size})
+            self.assertEqual(response.status_code, 200)
+            self.check_page(response.data, page_size)
+            counts[page_size] = len(queries)
+        self.assertEqual(len(set(counts.values())), 1, counts)
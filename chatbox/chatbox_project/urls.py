@@ -16,6 +16,7 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from .instrumentation import metrics_view
 
 urlpatterns = [
     path("admin/", admin.site.urls),
@@ -28,4 +29,7 @@ urlpatterns = [
     
     #for chat app
     path('api/chat', include('chat_app.urls')),
+    
+    #prometheus scrape endpoint (chatbox_project.instrumentation)
+    path('metrics', metrics_view),
 ]
@@ -65,4 +65,19 @@ class CustomAdminNotificationSettings(admin.ModelAdmin):
             'classes': ['collapse']
         }),
     ]
-    
\ No newline at end of file
+    
+
+@admin.register(UnreadCounter)
+class CustomAdminUnreadCounter(admin.ModelAdmin):
+    """the maintained badge counts, reconcile_unread_counters fixes them if they drift"""
+    list_display = ['user', 'conversation', 'count', 'seen']
+    search_fields = ['user__username']
+    raw_id_fields = ['user', 'conversation']
+
+
+@admin.register(BulkNotificationRun)
+class CustomAdminBulkNotificationRun(admin.ModelAdmin):
+    """the durable state of bulk notification jobs, bulk_notification_jobs resumes the failed ones"""
+    list_display = ['job_id', 'sender', 'status', 'next_chunk', 'updated_at']
+    list_filter = ['status']
+    raw_id_fields = ['sender']
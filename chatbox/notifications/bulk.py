@@ -0,0 +1,219 @@
+import asyncio
+import threading
+import time
+import uuid
+from datetime import timedelta
+from asgiref.sync import async_to_sync
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.utils import timezone
+from .models import BulkNotificationRun, Notification, UnreadCounter
+from .preferences import filter_recipients
+
+#BULK NOTIFICATION PIPELINE
+#recipients are handled CHUNK_SIZE at a time: notifications.preferences resolves the chunk's settings (one
+#query for the ones it hasn't cached) and drops inactive users, the ones that turned the type off and the
+#ones in quiet hours. the rest are inserted with bulk_create(batch_size=BATCH_SIZE) and their counters
+#moved in the same transaction, then each delivery is pushed to its notifications_<user_id> group. at most MAX_IN_FLIGHT group_sends are
+#pending at once and the next chunk only starts when the pushes of the previous one are done, so neither
+#memory nor the channel layer grow with the audience.
+#progress is kept in the cache under the job id. audiences above BACKGROUND_THRESHOLD run in a thread
+#and the request returns the job id to poll.
+#every job also has a BulkNotificationRun row: a chunk's notifications, counters and the job's next_chunk
+#commit together, so a job whose thread died with its process (a restart, a deploy) resumes after its last
+#finished chunk without sending anything twice (BulkNotificationJob.resume, the bulk_notification_jobs
+#command). a running job whose row hasn't moved for STALE_AFTER seconds is orphaned: polling it or
+#running the command marks it failed, and a runner that lost its job stops at its next chunk.
+
+DEFAULTS = {
+    'CHUNK_SIZE': 2000,
+    'BATCH_SIZE': 500,
+    'MAX_IN_FLIGHT': 200,
+    'BACKGROUND_THRESHOLD': 5000,
+    'PROGRESS_TIMEOUT': 3600,
+    'STALE_AFTER': 300,
+    'CACHE_ALIAS': 'default',
+}
+
+def bulk_setting(name):
+    """reads a key from settings.BULK_NOTIFICATIONS, falling back to the defaults above"""
+    return getattr(settings, 'BULK_NOTIFICATIONS', {}).get(name, DEFAULTS[name])
+
+
+def progress_key(job_id):
+    return f'bulk_notifications:{job_id}'
+
+
+def get_progress(job_id):
+    """the progress of a job, None when it is unknown. an orphaned job is marked failed first"""
+    progress = caches[bulk_setting('CACHE_ALIAS')].get(progress_key(job_id))
+    if progress is not None and (progress['status'] not in ('pending', 'running') or time.time() - progress.get('heartbeat', 0) < bulk_setting('STALE_AFTER')):
+        return progress
+    fail_orphaned_jobs([job_id])
+    run = BulkNotificationRun.objects.filter(job_id=job_id).first()
+    return None if run is None else {**run.progress, 'status': run.status}
+
+
+def fail_orphaned_jobs(job_ids=None):
+    """marks the pending and running jobs whose row hasn't moved for STALE_AFTER seconds as failed, their
+    thread died with its process. returns their ids, BulkNotificationJob.resume carries them on"""
+    runs = BulkNotificationRun.objects.filter(
+        status__in=('pending', 'running'), updated_at__lt=timezone.now() - timedelta(seconds=bulk_setting('STALE_AFTER')),
+    )
+    if job_ids is not None:
+        runs = runs.filter(job_id__in=job_ids)
+    failed = []
+    for run in runs:
+        #the updated_at condition leaves a job that moved on meanwhile alone
+        if BulkNotificationRun.objects.filter(job_id=run.job_id, updated_at=run.updated_at).update(status='failed', runner='', updated_at=timezone.now()):
+            caches[bulk_setting('CACHE_ALIAS')].set(progress_key(run.job_id), {**run.progress, 'status': 'failed'}, timeout=bulk_setting('PROGRESS_TIMEOUT'))
+            failed.append(run.job_id)
+    return failed
+
+
+class JobLost(Exception):
+    """the job was marked failed (orphaned) or taken over by another runner while this one ran it"""
+
+
+class BulkNotificationJob:
+    """sends one notification to many recipients, see the pipeline notes above"""
+    def __init__(self, sender_id, recipients, notification_type, title, message,
+                 related_message_id=None, related_conversation_id=None, job_id=None):
+        self.sender_id = sender_id
+        self.recipient_ids = list(dict.fromkeys(recipients)) #no duplicates, order kept
+        self.fields = {
+            'notification_type': notification_type, 'title': title, 'message': message,
+            'related_message_id': related_message_id, 'related_conversation_id': related_conversation_id,
+        }
+        self.job_id = job_id or uuid.uuid4().hex
+        self.chunk_size = bulk_setting('CHUNK_SIZE')
+        self.next_chunk = 0
+        self.runner = uuid.uuid4().hex
+        self.state = {
+            'job_id': self.job_id, 'sender_id': sender_id, 'status': 'pending', 'total': len(self.recipient_ids),
+            'processed': 0, 'created': 0, 'skipped': 0, 'pushed': 0, 'push_failed': 0,
+        }
+
+    @classmethod
+    def resume(cls, job_id):
+        """the job of a failed run, set up to carry on after its last finished chunk. raises
+        BulkNotificationRun.DoesNotExist for an unknown job and ValueError for one that didn't fail"""
+        run = BulkNotificationRun.objects.get(job_id=job_id)
+        if run.status != 'failed':
+            raise ValueError(f'job {job_id} is {run.status}, only failed jobs resume')
+        job = cls(run.sender_id, run.recipient_ids, job_id=job_id, **run.fields)
+        job.chunk_size = run.chunk_size
+        job.next_chunk = run.next_chunk
+        job.state.update({key: value for key, value in run.progress.items() if key in job.state}, status='failed')
+        return job
+
+    @property
+    def total(self):
+        return self.state['total']
+
+    def save_progress(self, **changes):
+        """updates the progress in the cache and in the job's row (while this runner holds it)"""
+        self.state.update(changes, heartbeat=time.time())
+        caches[bulk_setting('CACHE_ALIAS')].set(progress_key(self.job_id), dict(self.state), timeout=bulk_setting('PROGRESS_TIMEOUT'))
+        BulkNotificationRun.objects.filter(job_id=self.job_id, runner=self.runner).update(
+            status=self.state['status'], progress=dict(self.state), updated_at=timezone.now(),
+        )
+
+    def claim(self):
+        """takes the job's row for this runner, a new job or a failed one, returns False when it is taken"""
+        if BulkNotificationRun.objects.filter(job_id=self.job_id, status='failed').update(runner=self.runner, status='running', updated_at=timezone.now()):
+            return True
+        _, created = BulkNotificationRun.objects.get_or_create(job_id=self.job_id, defaults={
+            'runner': self.runner, 'sender_id': self.sender_id, 'recipient_ids': self.recipient_ids,
+            'fields': self.fields, 'chunk_size': self.chunk_size,
+        })
+        return created or BulkNotificationRun.objects.filter(job_id=self.job_id, runner=self.runner).exists()
+
+    def run(self):
+        """sends every chunk after the last finished one and returns the final progress"""
+        if not self.claim():
+            raise JobLost(self.job_id)
+        self.save_progress(status='running')
+        try:
+            for chunk in range(self.next_chunk, -(-self.total // self.chunk_size)):
+                start = chunk * self.chunk_size
+                self.send_chunk(chunk, self.recipient_ids[start:start + self.chunk_size])
+        except JobLost:
+            raise
+        except Exception:
+            self.save_progress(status='failed')
+            raise
+        self.save_progress(status='done')
+        return dict(self.state)
+
+    def run_in_background(self):
+        """runs the job in a daemon thread of this process with its own database connection, the row
+        is written first so the job can be resumed if the thread dies with the process"""
+        self.claim()
+        self.save_progress()
+
+        def target():
+            try:
+                self.run()
+            finally:
+                connection.close()
+        threading.Thread(target=target, name=f'bulk-notifications-{self.job_id}', daemon=True).start()
+
+    def send_chunk(self, chunk, user_ids):
+        accepted = filter_recipients(user_ids, self.fields['notification_type'])
+        with transaction.atomic():
+            notifications = Notification.objects.bulk_create(
+                [Notification(recipient_id=user_id, sender_id=self.sender_id, **self.fields) for user_id, _ in accepted],
+                batch_size=bulk_setting('BATCH_SIZE'),
+            )
+            #bulk_create sends no post_save, so the counters of the recipients are moved here
+            UnreadCounter.add_notifications([user_id for user_id, _ in accepted], 1)
+            progress = {
+                **self.state,
+                'processed': self.state['processed'] + len(user_ids),
+                'created': self.state['created'] + len(notifications),
+                'skipped': self.state['skipped'] + len(user_ids) - len(accepted),
+            }
+            #the chunk only counts as finished with its notifications, a runner that lost the job rolls them back
+            if not BulkNotificationRun.objects.filter(job_id=self.job_id, runner=self.runner, status='running').update(
+                next_chunk=chunk + 1, progress=progress, updated_at=timezone.now(),
+            ):
+                raise JobLost(self.job_id)
+        self.state = progress
+        self.next_chunk = chunk + 1
+        #a push lost to a crash after the commit only misses the live delivery, the notification is stored
+        pushed, failed = async_to_sync(self.push)([
+            notification for notification, (_, push) in zip(notifications, accepted) if push
+        ])
+        self.save_progress(
+            pushed=self.state['pushed'] + pushed,
+            push_failed=self.state['push_failed'] + failed,
+        )
+
+    async def push(self, notifications):
+        """group_sends every notification to its recipient's group with at most MAX_IN_FLIGHT pending,
+        returns (pushed, failed). a full channel only loses the live push, the notification is stored"""
+        layer = get_channel_layer()
+        if layer is None or not notifications:
+            return 0, 0
+        slots = asyncio.Semaphore(bulk_setting('MAX_IN_FLIGHT'))
+
+        async def send(notification):
+            async with slots:
+                try:
+                    await layer.group_send(f'notifications_{notification.recipient_id}', {
+                        'type': 'notification_message',
+                        'notification_id': notification.id,
+                        'title': notification.title,
+                        'message': notification.message,
+                        'notification_type': notification.notification_type,
+                        'timestamp': notification.created_at.isoformat(),
+                    })
+                    return True
+                except ChannelFull:
+                    return False
+        results = await asyncio.gather(*[send(notification) for notification in notifications])
+        return sum(results), len(results) - sum(results)
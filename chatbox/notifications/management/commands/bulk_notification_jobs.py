@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from notifications.bulk import BulkNotificationJob, fail_orphaned_jobs
+from notifications.models import BulkNotificationRun
+
+
+class Command(BaseCommand):
+    """marks the bulk notification jobs whose thread died with its process (a restart, a deploy) as failed
+    and lists the failed jobs. --resume carries failed jobs on after their last finished chunk, in this
+    process, nothing that was already sent is sent again"""
+    help = 'fail orphaned bulk notification jobs, list or resume the failed ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--resume', nargs='*', metavar='JOB_ID', help='resume these failed jobs, every failed job when no id is given')
+
+    def handle(self, *args, **options):
+        for job_id in fail_orphaned_jobs():
+            self.stdout.write(f'{job_id}: orphaned, marked failed')
+        failed = BulkNotificationRun.objects.filter(status='failed').order_by('created_at')
+        if options['resume'] is None:
+            for run in failed:
+                self.stdout.write(f"{run.job_id}: failed after {run.progress.get('processed', 0)} of {len(run.recipient_ids)} recipients")
+            return
+
+        for job_id in options['resume'] or [run.job_id for run in failed]:
+            try:
+                job = BulkNotificationJob.resume(job_id)
+            except (BulkNotificationRun.DoesNotExist, ValueError) as error:
+                self.stderr.write(f'{job_id}: {error}')
+                continue
+            progress = job.run()
+            self.stdout.write(self.style.SUCCESS(f"{job_id}: done, {progress['created']} notifications created"))
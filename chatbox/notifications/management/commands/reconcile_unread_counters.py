@@ -0,0 +1,64 @@
+import time
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from chat_app.models import ConversationReadState
+from notifications.models import Notification, UnreadCounter
+from users_app.models import Conversation
+
+
+class Command(BaseCommand):
+    """recomputes the unread counters from the notifications and the read watermarks and fixes the
+    ones that drifted (notifications edited through the API, crashes between a write and its counter
+    update, ...). users are processed by id, a chunk per transaction, and only wrong counters are written"""
+    help = 'reconcile the unread counters with the notifications and messages they count'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='users per chunk')
+        parser.add_argument('--every', type=int, default=0, help='keep running and reconcile every N seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            user_ids = list(get_user_model().objects.order_by('id').values_list('id', flat=True))
+            fixed = 0
+            for start in range(0, len(user_ids), options['chunk_size']):
+                with transaction.atomic():
+                    fixed += self.reconcile(user_ids[start:start + options['chunk_size']])
+            self.stdout.write(self.style.SUCCESS(f'{len(user_ids)} users checked, {fixed} counters fixed'))
+            if not options['every']:
+                break
+            time.sleep(options['every'])
+
+    def reconcile(self, user_ids):
+        expected = {(user_id, None): 0 for user_id in user_ids}
+        for row in Notification.objects.filter(recipient_id__in=user_ids, is_read=False).values('recipient_id').annotate(unread=Count('id')).order_by():
+            expected[(row['recipient_id'], None)] = row['unread']
+
+        memberships = {}
+        for user_id, conversation_id in Conversation.participants.through.objects.filter(user_id__in=user_ids).values_list('user_id', 'conversation_id'):
+            memberships.setdefault(user_id, []).append(conversation_id)
+        for user_id, conversation_ids in memberships.items():
+            for conversation_id, count in ConversationReadState.unread_counts(user_id, conversation_ids).items():
+                expected[(user_id, conversation_id)] = count
+
+        actual = {
+            (user_id, conversation_id): unread
+            for user_id, conversation_id, unread in UnreadCounter.with_unread().filter(user_id__in=user_ids).values_list('user_id', 'conversation_id', 'unread')
+        }
+        #counters of conversations the user is no longer part of
+        stale = [key for key in actual if key not in expected]
+        for user_id, conversation_id in stale:
+            UnreadCounter.objects.filter(user_id=user_id, conversation_id=conversation_id).delete()
+
+        UnreadCounter.objects.bulk_create([
+            UnreadCounter(user_id=user_id, conversation_id=conversation_id)
+            for user_id, conversation_id in expected if (user_id, conversation_id) not in actual
+        ], ignore_conflicts=True, batch_size=1000)
+        wrong = [(key, count) for key, count in expected.items() if actual.get(key) != count]
+        for (user_id, conversation_id), count in wrong:
+            if conversation_id is None:
+                UnreadCounter.objects.filter(user_id=user_id, conversation__isnull=True).update(count=count)
+            else:
+                UnreadCounter.set_unread(user_id, {conversation_id: count})
+        return len(wrong) + len(stale)
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:02
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users_app', '0003_conversation_summary'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('notifications', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnreadCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.IntegerField(default=0)),
+                ('conversation', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='unread_counters', to='users_app.conversation')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='unread_counters', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'unread_counter',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='unreadcounter',
+            constraint=models.UniqueConstraint(condition=models.Q(('conversation__isnull', True)), fields=('user',), name='unique_notification_counter'),
+        ),
+        migrations.AddConstraint(
+            model_name='unreadcounter',
+            constraint=models.UniqueConstraint(condition=models.Q(('conversation__isnull', False)), fields=('user', 'conversation'), name='unique_conversation_counter'),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:11
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+#the conversation counters move from holding their unread count to seen against a total. with no total
+#rows yet (a total of 0), seen = -count keeps every badge where it was
+
+
+def counts_to_seen(apps, schema_editor):
+    UnreadCounter = apps.get_model('notifications', 'UnreadCounter')
+    UnreadCounter.objects.filter(conversation__isnull=False).update(seen=-F('count'), count=0)
+
+
+def seen_to_counts(apps, schema_editor):
+    UnreadCounter = apps.get_model('notifications', 'UnreadCounter')
+    ConversationMessageTotal = apps.get_model('notifications', 'ConversationMessageTotal')
+    total = ConversationMessageTotal.objects.filter(conversation_id=OuterRef('conversation_id')).values('messages')
+    UnreadCounter.objects.filter(conversation__isnull=False).update(
+        count=Coalesce(Subquery(total), 0) - F('seen'), seen=0,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users_app', '0006_message_attachment_storage'),
+        ('notifications', '0003_unread_counter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationMessageTotal',
+            fields=[
+                ('conversation', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='message_total', serialize=False, to='users_app.conversation')),
+                ('messages', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'conversation_message_total',
+            },
+        ),
+        migrations.AddField(
+            model_name='unreadcounter',
+            name='seen',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(counts_to_seen, seen_to_counts),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:12
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('notifications', '0004_unread_counter_totals'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BulkNotificationRun',
+            fields=[
+                ('job_id', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('recipient_ids', models.JSONField()),
+                ('fields', models.JSONField()),
+                ('chunk_size', models.PositiveIntegerField()),
+                ('next_chunk', models.PositiveIntegerField(default=0)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('runner', models.CharField(blank=True, max_length=32)),
+                ('progress', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='bulk_notification_runs', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'bulk_notification_run',
+                'indexes': [models.Index(fields=['status', 'updated_at'], name='bulk_notifi_status_6243b1_idx')],
+            },
+        ),
+    ]
@@ -1,4 +1,6 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, When
+from django.db.models.functions import Coalesce, Greatest
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 from users_app.models import Conversation, Message
@@ -54,7 +56,9 @@ class Notification(models.Model):
         if not self.is_read == True:
             self.is_read = True
             self.read_at = timezone.now()
-            self.save()
+            with transaction.atomic():
+                self.save()
+                UnreadCounter.add_notifications([self.recipient_id], -1)
             
 class NotificationSettings(models.Model):
     """specifies user's preference for notification settings"""
@@ -83,6 +87,173 @@ class NotificationSettings(models.Model):
         db_table = 'notification_setting'
         
         def __str__(self):
-            return f"settings for {self.user.username}"  
+            return f"settings for {self.user.username}"
+
+
+class ConversationMessageTotal(models.Model):
+    """how many messages a conversation has had, the single row a new message moves instead of the
+    unread counter of every participant. only differences against it mean anything (UnreadCounter.seen)"""
+    conversation = models.OneToOneField(Conversation, primary_key=True, on_delete=models.CASCADE, related_name='message_total')
+    messages = models.BigIntegerField(default=0)
+    
+    class Meta:
+        """extra information for the database table"""
+        db_table = 'conversation_message_total'
+    
+    def __str__(self):
+        return f"{self.conversation_id}: {self.messages}"
+    
+    @classmethod
+    def ensure(cls, conversation_ids):
+        """creates the missing total rows, existing ones are left alone"""
+        cls.objects.bulk_create([cls(conversation_id=conversation_id) for conversation_id in conversation_ids], ignore_conflicts=True)
+
+
+class UnreadCounter(models.Model):
+    """maintained badge counts, so polling unread counts is one indexed read instead of COUNT(*).
+    the row without a conversation counts the user's unread notifications in count. the others hold in
+    seen how many of the conversation's messages the user doesn't have to read (read, sent themselves, or
+    from before a recount), their unread count is ConversationMessageTotal.messages - seen: a new message
+    moves the total and the sender's row, not a row per participant. notifications.signals and the
+    notification views keep them moving, reconcile_unread_counters fixes any drift"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='unread_counters')
+    conversation = models.ForeignKey(Conversation, null=True, blank=True, on_delete=models.CASCADE, related_name='unread_counters')
+    count = models.IntegerField(default=0)
+    seen = models.BigIntegerField(default=0)
+    
+    class Meta:
+        """extra information for the database table"""
+        db_table = 'unread_counter'
+        constraints = [
+            models.UniqueConstraint(fields=['user'], condition=Q(conversation__isnull=True), name='unique_notification_counter'),
+            models.UniqueConstraint(fields=['user', 'conversation'], condition=Q(conversation__isnull=False), name='unique_conversation_counter'),
+        ]
+        
+    def __str__(self):
+        return f"{self.user_id} - {self.conversation_id or 'notifications'}: {self.count}"
+    
+    @classmethod
+    def ensure(cls, user_ids, conversation_id=None):
+        """creates the missing counter rows, existing ones are left alone"""
+        cls.objects.bulk_create(
+            [cls(user_id=user_id, conversation_id=conversation_id) for user_id in user_ids],
+            ignore_conflicts=True, batch_size=1000,
+        )
+    
+    @classmethod
+    def add_notifications(cls, user_ids, amount):
+        """moves the notification counters of the users by amount per occurrence of their id, never below zero.
+        users that appear the same number of times share one UPDATE"""
+        occurrences = {}
+        for user_id in user_ids:
+            occurrences[user_id] = occurrences.get(user_id, 0) + 1
+        if amount > 0:
+            cls.ensure(occurrences)
+        by_amount = {}
+        for user_id, times in occurrences.items():
+            by_amount.setdefault(times * amount, []).append(user_id)
+        for total, ids in by_amount.items():
+            cls.objects.filter(user_id__in=ids, conversation__isnull=True).update(count=Greatest(F('count') + total, 0))
     
-            
\ No newline at end of file
+    @classmethod
+    def recount_notifications(cls, user_id):
+        """sets the user's notification counter to the number of unread notification rows, one UPDATE"""
+        cls.ensure([user_id])
+        unread = Notification.objects.filter(
+            recipient_id=user_id, is_read=False
+        ).order_by().values('recipient_id').annotate(unread=Count('id')).values('unread')
+        cls.objects.filter(user_id=user_id, conversation__isnull=True).update(count=Coalesce(Subquery(unread), 0))
+    
+    @classmethod
+    def record_messages(cls, messages):
+        """a batch moves two rows whatever the size of the conversation: the conversation's total (one UPDATE
+        per conversation) and the sender's seen, their own messages aren't unread (one per (conversation, sender))"""
+        totals, sent = {}, {}
+        for message in messages:
+            totals[message.conversation_id] = totals.get(message.conversation_id, 0) + 1
+            key = (message.conversation_id, message.sender_id)
+            sent[key] = sent.get(key, 0) + 1
+        for conversation_id, amount in totals.items():
+            totals_row = ConversationMessageTotal.objects.filter(conversation_id=conversation_id)
+            if not totals_row.update(messages=F('messages') + amount):
+                ConversationMessageTotal.ensure([conversation_id])
+                totals_row.update(messages=F('messages') + amount)
+        for (conversation_id, sender_id), amount in sent.items():
+            cls.objects.filter(user_id=sender_id, conversation_id=conversation_id).update(seen=F('seen') + amount)
+    
+    @classmethod
+    def set_unread(cls, user_id, counts):
+        """makes the user's conversation counters show counts ({conversation_id: unread messages})"""
+        ConversationMessageTotal.ensure(counts)
+        cls.objects.bulk_create(
+            [cls(user_id=user_id, conversation_id=conversation_id) for conversation_id in counts],
+            ignore_conflicts=True,
+        )
+        for conversation_id, count in counts.items():
+            total = ConversationMessageTotal.objects.filter(conversation_id=conversation_id).values('messages')
+            cls.objects.filter(user_id=user_id, conversation_id=conversation_id).update(seen=Subquery(total) - count)
+    
+    @classmethod
+    def recount_conversations(cls, user_id, conversation_ids):
+        """sets the user's message counters to the exact number of messages above their read watermark"""
+        from chat_app.models import ConversationReadState
+        cls.set_unread(user_id, ConversationReadState.unread_counts(user_id, conversation_ids))
+    
+    @classmethod
+    def with_unread(cls):
+        """the counters annotated with unread: count for the notification row, total - seen for the others"""
+        total = ConversationMessageTotal.objects.filter(conversation_id=OuterRef('conversation_id')).values('messages')
+        return cls.objects.annotate(unread=Case(
+            When(conversation__isnull=True, then=F('count')),
+            default=Coalesce(Subquery(total), 0) - F('seen'),
+            output_field=models.BigIntegerField(),
+        ))
+    
+    @classmethod
+    def badges(cls, user_id):
+        """every badge count of the user from a single query"""
+        notifications, conversations = 0, {}
+        for conversation_id, count in cls.with_unread().filter(user_id=user_id).values_list('conversation_id', 'unread'):
+            if conversation_id is None:
+                notifications = count
+            elif count:
+                conversations[conversation_id] = count
+        return {
+            'notifications': notifications,
+            'messages': sum(conversations.values()),
+            'conversations': conversations,
+        }
+
+
+
+class BulkNotificationRun(models.Model):
+    """the durable state of a notifications.bulk job: what it sends and how far it got. a chunk's
+    notifications and the move of next_chunk commit together, so a job that stopped resumes after its
+    last finished chunk. runner is the token of the process running it, a runner that lost it stops"""
+    STATUSES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+    job_id = models.CharField(max_length=32, primary_key=True)
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='bulk_notification_runs')
+    recipient_ids = models.JSONField()
+    fields = models.JSONField()
+    chunk_size = models.PositiveIntegerField() #kept so the chunks don't move when a resumed job has other settings
+    next_chunk = models.PositiveIntegerField(default=0)
+    status = models.CharField(max_length=10, choices=STATUSES, default='pending')
+    runner = models.CharField(max_length=32, blank=True)
+    progress = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True) #moves with every chunk, a running job that stops moving is orphaned
+    
+    class Meta:
+        """extra information for the database table"""
+        db_table = 'bulk_notification_run'
+        indexes = [
+            models.Index(fields=['status', 'updated_at']),
+        ]
+    
+    def __str__(self):
+        return f"{self.job_id} {self.status} ({self.next_chunk} chunks done)"
@@ -0,0 +1,150 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+
+#NOTIFICATION PREFERENCES
+#every dispatch checks the recipients' NotificationSettings, they are resolved here from an in-process LRU of
+#MAX_ENTRIES users. the misses of a lookup are loaded together by one query joining the users to their
+#settings, users without a settings row get the model defaults. notifications.signals drops a user's entry
+#when their settings or user row are saved or deleted in this process, other processes pick the change up
+#once their entry is older than TIMEOUT.
+#filter_recipients decides once per distinct set of preferences in the batch instead of once per user,
+#most users keep the defaults so a whole audience usually comes down to a couple of evaluations.
+
+DEFAULTS = {
+    'MAX_ENTRIES': 20000,
+    'TIMEOUT': 60,
+}
+
+Preferences = namedtuple('Preferences', [
+    'active', 'push', 'email', 'new_messages', 'friend_request', 'mention', 'group_invites', 'quiet_start', 'quiet_end',
+])
+
+#what a user without a NotificationSettings row gets, shared by all of them
+DEFAULT_PREFERENCES = Preferences(True, True, True, True, True, True, True, None, None)
+
+#the switch of each notification type, types that aren't here can't be turned off
+TYPE_FLAGS = {
+    'message': 'new_messages',
+    'friend_request': 'friend_request',
+    'mention': 'mention',
+    'group_invite': 'group_invites',
+}
+
+#the columns of one user in the order of Preferences
+FIELDS = (
+    'id', 'is_active',
+    'notification_settings__enable_push_notifications',
+    'notification_settings__enable_email_notifications',
+    'notification_settings__notify_new_messages',
+    'notification_settings__notify_friend_request',
+    'notification_settings__notify_mention',
+    'notification_settings__notify_group_invites',
+    'notification_settings__quiet_hours_start',
+    'notification_settings__quiet_hours_end',
+)
+
+
+def preferences_setting(name):
+    """reads a key from settings.NOTIFICATION_PREFERENCES, falling back to the defaults above"""
+    return getattr(settings, 'NOTIFICATION_PREFERENCES', {}).get(name, DEFAULTS[name])
+
+
+def in_quiet_hours(start, end, now):
+    """True when the time now falls in [start, end), a window can run past midnight (22:00 - 07:00)"""
+    if start is None or end is None:
+        return False
+    if start <= end:
+        return start <= now < end
+    return now >= start or now < end
+
+
+def accepts(preferences, notification_type, now):
+    """whether a user with these preferences takes the notification type at the time now"""
+    flag = TYPE_FLAGS.get(notification_type)
+    return (
+        preferences.active
+        and (flag is None or getattr(preferences, flag))
+        and not in_quiet_hours(preferences.quiet_start, preferences.quiet_end, now)
+    )
+
+
+class PreferencesCache:
+    """LRU of user id -> Preferences, entries expire after TIMEOUT seconds"""
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_many(self, user_ids):
+        """{user_id: Preferences} of the existing users among user_ids, the misses loaded with one query"""
+        found, missing = {}, []
+        now = time.monotonic()
+        with self.lock:
+            for user_id in user_ids:
+                entry = self.entries.get(user_id)
+                if entry is not None and entry[1] > now:
+                    self.entries.move_to_end(user_id)
+                    found[user_id] = entry[0]
+                else:
+                    missing.append(user_id)
+        if missing:
+            loaded = self.load(missing)
+            self.store(loaded)
+            found.update(loaded)
+        return found
+
+    def load(self, user_ids):
+        loaded = {}
+        for user_id, active, *flags, quiet_start, quiet_end in get_user_model().objects.filter(id__in=user_ids).values_list(*FIELDS):
+            #the flags are None when the user has no settings row, which means the default (on)
+            preferences = Preferences(active, *[flag is not False for flag in flags], quiet_start, quiet_end)
+            loaded[user_id] = DEFAULT_PREFERENCES if preferences == DEFAULT_PREFERENCES else preferences
+        return loaded
+
+    def store(self, loaded):
+        expires = time.monotonic() + preferences_setting('TIMEOUT')
+        max_entries = preferences_setting('MAX_ENTRIES')
+        with self.lock:
+            for user_id, preferences in loaded.items():
+                self.entries[user_id] = (preferences, expires)
+                self.entries.move_to_end(user_id)
+            while len(self.entries) > max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, user_ids):
+        with self.lock:
+            for user_id in user_ids:
+                self.entries.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+preferences_cache = PreferencesCache()
+
+
+def get_preferences(user_id):
+    """the Preferences of one user, None when the user doesn't exist"""
+    return preferences_cache.get_many([user_id]).get(user_id)
+
+
+def filter_recipients(user_ids, notification_type, at=None):
+    """the users among user_ids that take the notification type at the time at (a datetime, now by default),
+    as (user_id, push) pairs in the order given, where push is their enable_push_notifications"""
+    now = timezone.localtime(at).time()
+    found = preferences_cache.get_many(user_ids)
+    decisions = {}
+    accepted = []
+    for user_id in user_ids:
+        preferences = found.get(user_id)
+        if preferences is None:
+            continue
+        if preferences not in decisions:
+            decisions[preferences] = accepts(preferences, notification_type, now)
+        if decisions[preferences]:
+            accepted.append((user_id, preferences.push))
+    return accepted
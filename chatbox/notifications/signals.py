@@ -0,0 +1,61 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from users_app.models import Conversation, User
+from users_app.signals import messages_created
+from .models import Notification, NotificationSettings, UnreadCounter
+from .preferences import preferences_cache
+
+
+@receiver(messages_created)
+def count_new_messages(sender, messages, **kwargs):
+    """every other participant of the conversation has one more unread message"""
+    UnreadCounter.record_messages(messages)
+
+
+@receiver(post_save, sender=Notification)
+def count_new_notification(sender, instance, created, **kwargs):
+    """single notifications bump the recipient's counter, bulk_create callers move the counters themselves"""
+    if created and not instance.is_read:
+        UnreadCounter.add_notifications([instance.recipient_id], 1)
+
+
+@receiver(post_delete, sender=Notification)
+def uncount_deleted_notification(sender, instance, **kwargs):
+    if not instance.is_read:
+        UnreadCounter.add_notifications([instance.recipient_id], -1)
+
+
+@receiver(post_save, sender=NotificationSettings)
+@receiver(post_delete, sender=NotificationSettings)
+def settings_changed(sender, instance, **kwargs):
+    """the cached preferences of the user are reloaded on their next lookup"""
+    preferences_cache.invalidate([instance.user_id])
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    #is_active is part of the preferences
+    preferences_cache.invalidate([instance.pk])
+
+
+@receiver(m2m_changed, sender=Conversation.participants.through)
+def participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """new participants get a counter that already holds the conversation's unread messages,
+    participants that leave lose theirs"""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    #the users_app receiver runs first and keeps the ids that a clear removed
+    related_ids = pk_set if action != 'post_clear' else getattr(instance, '_cleared_membership_ids', [])
+    if reverse:
+        pairs = [(instance.pk, conversation_id) for conversation_id in related_ids]
+    else:
+        pairs = [(user_id, instance.pk) for user_id in related_ids]
+
+    if action == 'post_add':
+        for user_id, conversation_id in pairs:
+            UnreadCounter.recount_conversations(user_id, [conversation_id])
+    elif reverse:
+        UnreadCounter.objects.filter(user_id=instance.pk, conversation_id__in=related_ids).delete()
+    else:
+        UnreadCounter.objects.filter(conversation_id=instance.pk, user_id__in=related_ids).delete()
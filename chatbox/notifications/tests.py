@@ -1,3 +1,270 @@
-from django.test import TestCase
+from datetime import date, datetime, time, timedelta
+from unittest import mock
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.test import TestCase, override_settings
+from django.core.cache import cache
+from django.utils import timezone
+from rest_framework.test import APIClient
+from chatbox_project.testing import ENFORCED_BUDGETS, LOCMEM_CACHES, QueryCountTestMixin
+from chat_app.models import ConversationReadState
+from users_app.models import Conversation, Message, User
+from .bulk import BulkNotificationJob, JobLost, fail_orphaned_jobs, get_progress
+from .preferences import filter_recipients, in_quiet_hours, preferences_cache
+from .models import BulkNotificationRun, Notification, NotificationSettings, UnreadCounter
+from .views import NotificationViewSet
 
 # Create your tests here.
+
+
+@override_settings(CACHES=LOCMEM_CACHES, INSTRUMENTATION=ENFORCED_BUDGETS)
+class ListQueryCountTests(QueryCountTestMixin, TestCase):
+    """the notification lists, every notification on the page comes with its sender"""
+    ROWS = 101
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='recipient', email='recipient@example.com')
+        senders = User.objects.bulk_create([
+            User(username=f'sender_{n}', email=f'sender_{n}@example.com') for n in range(cls.ROWS)
+        ])
+        Notification.objects.bulk_create([
+            Notification(recipient=cls.user, sender=sender, title='New message', message=f'message {n}')
+            for n, sender in enumerate(senders)
+        ])
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def check_page(self, data, page_size):
+        """the sender is serialized from the same query"""
+        super().check_page(data, page_size)
+        self.assertIsNotNone(data['results'][0]['sender'])
+
+    def test_notification_list(self):
+        self.assert_constant_queries(NotificationViewSet, '/api/notifications')
+
+    def test_list_notifications(self):
+        self.assert_constant_queries(NotificationViewSet, '/api/notificationslist_notifications/', {'is_read': 'false'}, action='list_notifications')
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES,
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    BULK_NOTIFICATIONS={'CHUNK_SIZE': 3, 'BATCH_SIZE': 2},
+)
+class BulkNotificationTests(TestCase):
+    """send_bulk_notifications skips the recipients whose settings refuse the type or are in quiet hours,
+    pushes only to those with push notifications on, and reports its progress"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sender = User.objects.create(username='sender', email='sender@example.com')
+        cls.recipients = User.objects.bulk_create([
+            User(username=f'recipient_{n}', email=f'recipient_{n}@example.com') for n in range(7)
+        ])
+        muted, quiet, no_push, inactive = cls.recipients[:4]
+        NotificationSettings.objects.create(user=muted, notify_mention=False)
+        now = timezone.localtime()
+        NotificationSettings.objects.create(
+            user=quiet, quiet_hours_start=(now - timedelta(hours=1)).time(), quiet_hours_end=(now + timedelta(hours=1)).time()
+        )
+        NotificationSettings.objects.create(user=no_push, enable_push_notifications=False)
+        inactive.is_active = False
+        inactive.save()
+
+    def setUp(self):
+        cache.clear()
+        preferences_cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.sender)
+
+    def send(self, **data):
+        payload = {
+            'recipients': [user.id for user in self.recipients] + [self.recipients[-1].id],
+            'notification_type': 'mention', 'title': 'Mentioned', 'message': 'you were mentioned',
+        }
+        return self.client.post('/api/notificationssend_bulk_notifications/', {**payload, **data}, format='json')
+
+    def test_settings_are_respected(self):
+        response = self.send()
+        self.assertEqual(response.status_code, 200)
+        progress = response.data['progress']
+        self.assertEqual(
+            {key: progress[key] for key in ('status', 'total', 'processed', 'created', 'skipped', 'pushed')},
+            {'status': 'done', 'total': 7, 'processed': 7, 'created': 4, 'skipped': 3, 'pushed': 3},
+        )
+        self.assertEqual(
+            set(Notification.objects.values_list('recipient_id', flat=True)),
+            {user.id for user in self.recipients[2:3] + self.recipients[4:]},
+        )
+        self.assertEqual(UnreadCounter.badges(self.recipients[-1].id)['notifications'], 1)
+
+    def test_types_without_a_setting_ignore_the_switches(self):
+        response = self.send(notification_type='user_online')
+        self.assertEqual(response.data['count'], 5) #everyone active but the one in quiet hours
+
+    def test_push_reaches_the_recipient_group(self):
+        layer = get_channel_layer()
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(f'notifications_{self.recipients[-1].id}', channel)
+        self.send()
+        event = async_to_sync(layer.receive)(channel)
+        self.assertEqual(event['type'], 'notification_message')
+        self.assertEqual(event['notification_id'], Notification.objects.get(recipient=self.recipients[-1]).id)
+
+    def test_progress_is_only_shown_to_the_sender(self):
+        job_id = self.send().data['job_id']
+        response = self.client.get('/api/notificationsbulk_progress/', {'job_id': job_id})
+        self.assertEqual((response.status_code, response.data['created']), (200, 4))
+        self.client.force_authenticate(self.recipients[-1])
+        response = self.client.get('/api/notificationsbulk_progress/', {'job_id': job_id})
+        self.assertEqual(response.status_code, 404)
+
+    def job(self):
+        return BulkNotificationJob(
+            self.sender.id, [user.id for user in self.recipients], notification_type='mention', title='Mentioned', message='you were mentioned',
+        )
+
+    def test_resumes_after_the_last_finished_chunk(self):
+        job = self.job()
+        calls = []
+
+        def dies_on_the_second_chunk(user_ids, notification_type):
+            calls.append(user_ids)
+            if len(calls) == 2:
+                raise RuntimeError('worker restarted')
+            return filter_recipients(user_ids, notification_type)
+
+        with mock.patch('notifications.bulk.filter_recipients', side_effect=dies_on_the_second_chunk), self.assertRaises(RuntimeError):
+            job.run()
+        run = BulkNotificationRun.objects.get(job_id=job.job_id)
+        self.assertEqual((run.status, run.next_chunk, run.progress['processed']), ('failed', 1, 3))
+        created = Notification.objects.count()
+
+        progress = BulkNotificationJob.resume(job.job_id).run()
+        self.assertEqual({key: progress[key] for key in ('status', 'processed', 'created')}, {'status': 'done', 'processed': 7, 'created': 4})
+        self.assertEqual(Notification.objects.count(), 4)
+        self.assertEqual(Notification.objects.filter(recipient=self.recipients[2]).count(), created)
+        self.assertEqual(UnreadCounter.badges(self.recipients[-1].id)['notifications'], 1)
+
+    def test_orphaned_jobs_are_marked_failed(self):
+        job = self.job()
+        job.claim()
+        job.save_progress(status='running')
+        self.assertEqual(fail_orphaned_jobs(), [])
+        with override_settings(BULK_NOTIFICATIONS={'CHUNK_SIZE': 3, 'STALE_AFTER': 0}):
+            self.assertEqual(get_progress(job.job_id)['status'], 'failed')
+        self.assertEqual(BulkNotificationRun.objects.get(job_id=job.job_id).status, 'failed')
+        #the runner that lost its job doesn't send another chunk
+        with self.assertRaises(JobLost):
+            job.send_chunk(0, [self.recipients[-1].id])
+        self.assertFalse(Notification.objects.exists())
+
+    def test_quiet_hours_can_wrap_midnight(self):
+        self.assertTrue(in_quiet_hours(time(22), time(7), time(23, 30)))
+        self.assertTrue(in_quiet_hours(time(22), time(7), time(6, 59)))
+        self.assertFalse(in_quiet_hours(time(22), time(7), time(12)))
+        self.assertFalse(in_quiet_hours(time(9), time(17), time(17)))
+
+
+class NotificationPreferencesTests(TestCase):
+    """recipient filtering is served from the preferences LRU after one query, saves invalidate it,
+    and the single create path respects it"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sender = User.objects.create(username='sender', email='sender@example.com')
+        cls.users = User.objects.bulk_create([
+            User(username=f'user_{n}', email=f'user_{n}@example.com') for n in range(50)
+        ])
+        NotificationSettings.objects.create(user=cls.users[0], notify_new_messages=False)
+
+    def setUp(self):
+        preferences_cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.sender)
+
+    def test_one_query_then_cached(self):
+        ids = [user.id for user in self.users]
+        with self.assertNumQueries(1):
+            accepted = filter_recipients(ids, 'message')
+        self.assertEqual([user_id for user_id, _ in accepted], ids[1:])
+        with self.assertNumQueries(0):
+            self.assertEqual(filter_recipients(ids, 'message'), accepted)
+
+    def test_saving_settings_invalidates(self):
+        filter_recipients([self.users[1].id], 'message')
+        NotificationSettings.objects.create(user=self.users[1], quiet_hours_start=time(22), quiet_hours_end=time(7))
+        night = timezone.make_aware(datetime.combine(date.today(), time(23, 30)))
+        self.assertEqual(filter_recipients([self.users[1].id], 'message', at=night), [])
+        self.assertEqual(len(filter_recipients([self.users[1].id], 'message', at=night + timedelta(hours=12))), 1)
+
+    def test_create_respects_the_settings(self):
+        payload = {'title': 'New message', 'message': 'hello', 'notification_type': 'message'}
+        response = self.client.post('/api/notifications', {**payload, 'recipient': self.users[0].id}, format='json')
+        self.assertEqual((response.status_code, response.data['delivered']), (200, False))
+        response = self.client.post('/api/notifications', {**payload, 'recipient': self.users[1].id}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Notification.objects.get().recipient_id, self.users[1].id)
+
+    def test_reading_settings_creates_nothing(self):
+        self.client.force_authenticate(self.users[2])
+        response = self.client.get('/api/notificationssettings/my_settings/')
+        self.assertEqual((response.status_code, response.data['notify_mention']), (200, True))
+        self.assertFalse(NotificationSettings.objects.filter(user=self.users[2]).exists())
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class UnreadCounterTests(TestCase):
+    """a new message moves the conversation's total and the sender's row, not a row per member, and
+    mark_all_read leaves the badge at the unread rows it didn't mark"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sender, *cls.members = User.objects.bulk_create([
+            User(username=f'counter_{n}', email=f'counter_{n}@example.com') for n in range(50)
+        ])
+        cls.conversation = Conversation.objects.create(is_group=True)
+        cls.conversation.participants.add(cls.sender, *cls.members)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_messages_move_two_rows(self):
+        message = Message(conversation=self.conversation, sender=self.sender, content='hello')
+        Message.objects.bulk_create([message])
+        with self.assertNumQueries(2):
+            UnreadCounter.record_messages([message])
+        self.assertEqual(UnreadCounter.badges(self.members[0].id)['conversations'], {self.conversation.id: 1})
+        self.assertEqual(UnreadCounter.badges(self.sender.id)['messages'], 0)
+
+    def test_reading_and_joining_recount(self):
+        messages = [Message.objects.create(conversation=self.conversation, sender=self.sender, content=f'hello {n}') for n in range(3)]
+        reader = self.members[0]
+        ConversationReadState.advance(reader.id, [messages[1].id], 'read')
+        self.assertEqual(UnreadCounter.badges(reader.id)['messages'], 1)
+        newcomer = User.objects.create(username='counter_new', email='counter_new@example.com')
+        self.conversation.participants.add(newcomer)
+        self.assertEqual(UnreadCounter.badges(newcomer.id)['messages'], 3)
+        Message.objects.create(conversation=self.conversation, sender=newcomer, content='hi all')
+        self.assertEqual(UnreadCounter.badges(newcomer.id)['messages'], 3)
+        self.assertEqual(UnreadCounter.badges(reader.id)['messages'], 2)
+
+    def test_mark_all_read_keeps_a_notification_created_meanwhile(self):
+        recipient = self.members[0]
+        for n in range(2):
+            Notification.objects.create(recipient=recipient, sender=self.sender, title='New message', message=f'message {n}')
+        recount = UnreadCounter.recount_notifications
+
+        def created_meanwhile(user_id):
+            Notification.objects.create(recipient=recipient, sender=self.sender, title='New message', message='late')
+            recount(user_id)
+
+        client = APIClient()
+        client.force_authenticate(recipient)
+        with mock.patch.object(UnreadCounter, 'recount_notifications', side_effect=created_meanwhile):
+            self.assertEqual(client.post('/api/notificationsmark_all_read/').status_code, 200)
+        self.assertEqual(Notification.objects.filter(recipient=recipient, is_read=False).count(), 1)
+        self.assertEqual(UnreadCounter.badges(recipient.id)['notifications'], 1)
@@ -1,9 +1,12 @@
 from django.shortcuts import render
 from rest_framework import viewsets, status, permissions
 from rest_framework.decorators import action, api_view, permission_classes
+from django.db import transaction
 from django.db.models import Q 
 from .serializers import NotificationSenderSerializer, NotificationSettingsSerializer, BulkNotificationSerializer, NotificationSerializer, CreateNotificationSerializer
 from .models import *
+from .bulk import BulkNotificationJob, bulk_setting, get_progress
+from .preferences import filter_recipients
 from django.contrib.auth import get_user_model
 from rest_framework.response import Response
 
@@ -48,20 +51,35 @@ class NotificationViewSet(viewsets.ModelViewSet):
     """a viewset for models"""
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = NotificationSerializer
+    query_budget = {'list': 2, 'list_notifications': 2} #count and page, the senders come with the page
     
     def get_queryset(self):
-        notifications = Notification.objects.filter(recipient=self.request.user)
+        #NotificationSerializer nests the sender, so it is joined instead of loaded per notification
+        notifications = Notification.objects.filter(recipient=self.request.user).select_related('sender')
         return notifications
     
     def get_serializer_class(self, *args, **kwargs):
         """tells django the specific serializer to use for some action"""
-        if action == 'create':
+        if self.action == 'create':
             return CreateNotificationSerializer
         return NotificationSerializer
     
+    def create(self, request, *args, **kwargs):
+        """creates the notification unless the recipient's settings refuse its type right now"""
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        if not filter_recipients([data['recipient'].id], data.get('notification_type', 'message')):
+            return Response({'message': 'the recipient does not take this notification now', 'delivered': False},
+                            status=status.HTTP_200_OK)
+        self.perform_create(serializer)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+    
     def perform_create(self, serializer): #allows you customize what should happen after it has been created
         """to create notification"""
-        serializer.save(sender=self.request.user)#DRF already passes the validated serialized object
+        #the counter update of the post_save goes in with the row, so mark_all_read sees both or neither
+        with transaction.atomic():
+            serializer.save(sender=self.request.user)#DRF already passes the validated serialized object
     
     @action(detail=True, methods=['post'])
     def mark_as_read(self, request, pk=None):
@@ -75,7 +93,13 @@ class NotificationViewSet(viewsets.ModelViewSet):
     def mark_all_read(self, request):
         """a method that marks all the messages read"""
         queryset = self.get_queryset()
-        queryset.update(is_read=True, read_at=timezone.now())
+        with transaction.atomic():
+            #the counter row is locked first, a notification created meanwhile is counted after this commits.
+            #the counter is recounted from the rows instead of set to 0, which would lose such a notification
+            UnreadCounter.ensure([request.user.id])
+            list(UnreadCounter.objects.select_for_update().filter(user_id=request.user.id, conversation__isnull=True))
+            queryset.filter(is_read=False).update(is_read=True, read_at=timezone.now())
+            UnreadCounter.recount_notifications(request.user.id)
         
         #after updating we have to refresh the database by calling the the queryset again
         updated_queryset = self.get_queryset()
@@ -85,8 +109,8 @@ class NotificationViewSet(viewsets.ModelViewSet):
     @action(detail=False, methods=['get'])
     def unread_count(self, request):
         """a method that actually counts the number of unread notifications"""
-        unread_notifications = Notification.objects.filter(is_read=False, recipient=self.request.user)
-        count = unread_notifications.count()
+        #reads the maintained counter instead of counting the notifications table
+        count = UnreadCounter.badges(request.user.id)['notifications']
         return Response({"message" : f"You have {count} unread notifications"}, status=status.HTTP_200_OK)
     
     @action(detail=False, methods=['get'])
@@ -101,26 +125,35 @@ class NotificationViewSet(viewsets.ModelViewSet):
         """send bulk notifications"""
         serializer = BulkNotificationSerializer(data=request.data)
         
-        #check if all informations are correctly filled aand then get all recipients to loop through
+        #check if all informations are correctly filled and then hand the recipients to the chunked pipeline of notifications.bulk
         if serializer.is_valid():
-            data = serializer.validated_data
-            recipients = data.pop('recipients')
-            sender = self.request.user
+            job = BulkNotificationJob(sender_id=request.user.id, **serializer.validated_data)
             
-            #create a list of notifications that would save the notification objects created for each id
-            notifications =[]
-            #create a Notification object
-            for recipient_id in recipients: #loops through the whole recipient 
-                notifications.append(Notification(
-                    recipient_id=recipient_id, sender=sender, **data)
-                )
+            #big audiences are sent in the background, the client polls bulk_progress with the job id
+            if job.total > bulk_setting('BACKGROUND_THRESHOLD'):
+                job.run_in_background()
+                return Response({'message': f'sending notifications to {job.total} recipients',
+                                 'job_id': job.job_id, 'progress': dict(job.state)}, status=status.HTTP_202_ACCEPTED)
             
-            #after creating a notification object for each recipient, you have to then use the objects.bulk_create to be able to be saved on the database
-            bulk_notification = Notification.objects.bulk_create(notifications)
-            return Response({'message': f'{len(bulk_notification)} notifications sent',
-                             'count' : len(bulk_notification)}, status=status.HTTP_200_OK)
+            progress = job.run()
+            return Response({'message': f"{progress['created']} notifications sent",
+                             'count' : progress['created'], 'job_id': job.job_id, 'progress': progress}, status=status.HTTP_200_OK)
         return Response({'message': 'information is invalid'}, status=status.HTTP_400_BAD_REQUEST)
     
+    @action(detail=False, methods=['get'])
+    def bulk_progress(self, request):
+        """progress of a send_bulk_notifications job (?job_id=), only its sender can read it"""
+        progress = get_progress(request.query_params.get('job_id', ''))
+        if progress is None or progress['sender_id'] != request.user.id:
+            return Response({'error': 'job not found'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(progress, status=status.HTTP_200_OK)
+    
+    @action(detail=False, methods=['get'])
+    def badges(self, request):
+        """every badge count at once (unread notifications, unread messages per conversation and their total)
+        from the maintained counters, one query"""
+        return Response(UnreadCounter.badges(request.user.id), status=status.HTTP_200_OK)
+    
     @action(detail=False, methods=['post'])
     def clear_read(self, request):
         """clears all read messages"""
@@ -138,15 +171,13 @@ class NotificationViewSet(viewsets.ModelViewSet):
         #filter by notification types
         notification_type = request.query_params.get('notification_type')
         if notification_type:
-            queryset = notifications.filter(notification_type)
-            return queryset
+            notifications = notifications.filter(notification_type=notification_type)
         
         #filter by is_read
         is_read = request.query_params.get('is_read')
         if is_read:
             is_read_bool = is_read.lower() == 'true'
-            queryset = notifications.filter(is_read=is_read_bool)
-            return queryset
+            notifications = notifications.filter(is_read=is_read_bool)
         
         #pagination
         page = self.paginate_queryset(notifications)
@@ -154,7 +185,7 @@ class NotificationViewSet(viewsets.ModelViewSet):
             serializer = self.get_serializer(page, many=True)
             return self.get_paginated_response(serializer.data)
         
-        serializer = self.get_serializer(notifications)    
+        serializer = self.get_serializer(notifications, many=True)
         return Response(serializer.data)
 
 class NotificationSettingsViewSet(viewsets.ModelViewSet):
@@ -170,7 +201,10 @@ class NotificationSettingsViewSet(viewsets.ModelViewSet):
         """get or create notification settings for the current user
         in real world analogy, when the user logs in, it checks if the user
         has a record of notification settings and if not, it creates one for the user
-        so he can be able to edit"""
+        so he can be able to edit. reading them doesn't need the row, my_settings shows the defaults
+        without creating it"""
+        if self.action == 'my_settings':
+            return self.get_queryset().first() or NotificationSettings(user=self.request.user)
         settings, created = NotificationSettings.objects.get_or_create(user=self.request.user) #created is an inbuilt boolean value returned by get_or_create that returns true or false if the notification settings has been created
         return settings
     
@@ -190,7 +224,7 @@ class NotificationSettingsViewSet(viewsets.ModelViewSet):
         if serializer.is_valid():
             serializer.save()
             return Response(serializer.data)
-        return Response({'message': 'invalid information'}, serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'message': 'invalid information', 'errors': serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
     
     @action(detail=False, methods=['post'])
     def reset_default_settings(self, request):
@@ -198,14 +232,15 @@ class NotificationSettingsViewSet(viewsets.ModelViewSet):
         settings = self.get_object()
         
         #setting everything to a default value of true and none where necessary
-        NotificationSettings.enable_push_notifications = True
-        NotificationSettings.enable_email_notifications = True
-        NotificationSettings.notify_friend_request = True
-        NotificationSettings.notify_group_invites = True
-        NotificationSettings.notify_new_messages = True
-        NotificationSettings.notify_mention = True
-        NotificationSettings.quiet_hours_start = None
-        NotificationSettings.quiet_hours_end = None
+        settings.enable_push_notifications = True
+        settings.enable_email_notifications = True
+        settings.notify_friend_request = True
+        settings.notify_group_invites = True
+        settings.notify_new_messages = True
+        settings.notify_mention = True
+        settings.quiet_hours_start = None
+        settings.quiet_hours_end = None
+        settings.save() #the save drops the cached preferences
         
         serializer = self.get_serializer(settings)
         return Response({'message': 'settings reset to default', 'settings': serializer.data}, status=status.HTTP_200_OK)
\ No newline at end of file
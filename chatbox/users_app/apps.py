@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class UsersAppConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "users_app"
+
+    def ready(self):
+        #connects the cache invalidation receivers
+        from . import signals  # noqa: F401
@@ -0,0 +1,223 @@
+import hashlib
+import mimetypes
+import posixpath
+import re
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.storage import storages
+from django.core.files.uploadhandler import SkipFile, TemporaryFileUploadHandler
+from django.core.handlers.asgi import ASGIRequest
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.functional import LazyObject, empty
+from django.utils.http import content_disposition_header, quote_etag
+from django.utils.text import get_valid_filename
+
+#MESSAGE ATTACHMENTS
+#Message.file_attachement lives in the STORAGE alias of settings.STORAGES (a local directory by default,
+#s3 or anything else django-storages offers in production).
+#uploads: HashingUploadHandler writes the request body to a temporary file as it arrives, hashing it with
+#sha256 on the way and giving up on files past MAX_SIZE, nothing is held in memory. the file is stored
+#under message_files/<sha[:2]>/<sha>/<name> (on a local storage the temporary file is just moved there),
+#so the same file uploaded twice is stored once and the name carries the hash.
+#downloads: the sha256 is the ETag, so If-None-Match gets a 304 and If-Range resumes only the same file.
+#a Range gets a 206 with just those bytes. under daphne (ASGI) the body is an async iterator reading
+#CHUNK_SIZE at a time (django reads a sync iterator to the end before sending anything under ASGI),
+#under WSGI a whole file goes through FileResponse, which WSGI servers send with sendfile.
+#in production SENDFILE should hand the file to the proxy (X-Accel-Redirect/X-Sendfile to SENDFILE_ROOT +
+#name), which does ranges and zero-copy itself, django only checks access.
+#attachments from before the hashed names get a weak ETag of their size and mtime.
+
+DEFAULTS = {
+    'STORAGE': 'default',
+    'MAX_SIZE': 100 * 1024 * 1024,
+    'CHUNK_SIZE': 64 * 1024,
+    'SENDFILE': None,
+    'SENDFILE_ROOT': '/protected-attachments/',
+    'CACHE_MAX_AGE': 86400,
+}
+
+UPLOAD_TO = 'message_files'
+
+HASHED_NAME = re.compile(rf'^{UPLOAD_TO}/[0-9a-f]{{2}}/(?P<sha256>[0-9a-f]{{64}})/')
+
+RANGE = re.compile(r'^bytes=(?P<start>\d*)-(?P<end>\d*)$')
+
+
+def attachments_setting(name):
+    """reads a key from settings.ATTACHMENTS, falling back to the defaults above"""
+    return getattr(settings, 'ATTACHMENTS', {}).get(name, DEFAULTS[name])
+
+
+class AttachmentStorage(LazyObject):
+    """the storage of the STORAGE alias, resolved on first use like default_storage"""
+    def _setup(self):
+        self._wrapped = storages[attachments_setting('STORAGE')]
+
+
+attachment_storage = AttachmentStorage()
+
+
+def get_attachment_storage():
+    """the storage callable of Message.file_attachement"""
+    return attachment_storage
+
+
+@receiver(setting_changed)
+def storage_changed(setting, **kwargs):
+    if setting in ('STORAGES', 'ATTACHMENTS'):
+        attachment_storage._wrapped = empty
+
+
+class HashingUploadHandler(TemporaryFileUploadHandler):
+    """writes every uploaded file to a temporary file and its sha256 to file.sha256 as the chunks come
+    in. a file over MAX_SIZE is skipped and too_large is set"""
+    too_large = False
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        self.size += len(raw_data)
+        if self.size > attachments_setting('MAX_SIZE'):
+            self.too_large = True
+            self.file.close()
+            raise SkipFile()
+        self.sha256.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        file.sha256 = self.sha256.hexdigest()
+        return file
+
+
+def store_attachment(uploaded_file):
+    """saves a file received through HashingUploadHandler, returns its name in the storage"""
+    sha256 = uploaded_file.sha256
+    filename = get_valid_filename(posixpath.basename(uploaded_file.name or '')) or 'attachment'
+    name = f'{UPLOAD_TO}/{sha256[:2]}/{sha256}/{filename}'
+    if not attachment_storage.exists(name):
+        name = attachment_storage.save(name, uploaded_file)
+    return name
+
+
+def attachment_etag(name):
+    """the quoted ETag of a stored attachment"""
+    match = HASHED_NAME.match(name)
+    if match is not None:
+        return quote_etag(match['sha256'])
+    try:
+        modified = attachment_storage.get_modified_time(name)
+    except NotImplementedError:
+        return None
+    return f'W/"{attachment_storage.size(name):x}-{int(modified.timestamp()):x}"'
+
+
+def parse_range(header, size):
+    """(start, end) inclusive of a 'bytes=' Range header, None to send the whole file (no header, several
+    ranges or one covering the file). raises ValueError when the range can't be satisfied"""
+    match = RANGE.match((header or '').strip())
+    if match is None:
+        return None
+    start, end = match['start'], match['end']
+    if not start:
+        if not end:
+            return None
+        #bytes=-500, the last 500 bytes
+        start, end = max(0, size - int(end)), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise ValueError('unsatisfiable range')
+    if start == 0 and end == size - 1:
+        return None
+    return start, end
+
+
+def read_range(file, start, length, chunk_size):
+    """yields length bytes of file from start, closes the file at the end or when the client goes away"""
+    try:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+
+async def aread_range(file, start, length, chunk_size):
+    """read_range for ASGI: django only streams async iterators chunk by chunk, a sync one is read to the
+    end into a list before the first byte goes out. every read runs in a thread of its own pool so a slow
+    disk doesn't hold up the thread the sync views share"""
+    read = sync_to_async(file.read, thread_sensitive=False)
+    try:
+        await sync_to_async(file.seek, thread_sensitive=False)(start)
+        while length > 0:
+            chunk = await read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        await sync_to_async(file.close, thread_sensitive=False)()
+
+
+def attachment_response(request, name):
+    """the download response of a stored attachment: 304/412 from the conditional headers, a 206 for a
+    Range (unless If-Range names another version), the whole file otherwise"""
+    etag = attachment_etag(name)
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        filename = posixpath.basename(name)
+        content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        sendfile = attachments_setting('SENDFILE')
+        if sendfile:
+            #the proxy serves the file and the range, the request headers reach it unchanged
+            response = HttpResponse(content_type=content_type)
+            response.headers[sendfile] = attachments_setting('SENDFILE_ROOT') + name
+            response.headers['Content-Disposition'] = content_disposition_header(True, filename)
+            return with_cache_headers(response, etag)
+
+        size = attachment_storage.size(name)
+        byte_range = None
+        if_range = request.headers.get('If-Range')
+        #If-Range takes a strong comparison, a weak (legacy) ETag never resumes
+        if 'Range' in request.headers and (if_range is None or (etag is not None and not etag.startswith('W/') and if_range == etag)):
+            try:
+                byte_range = parse_range(request.headers['Range'], size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response.headers['Content-Range'] = f'bytes */{size}'
+                return response
+        asynchronous = isinstance(getattr(request, '_request', request), ASGIRequest)
+        if byte_range is None and not asynchronous:
+            response = FileResponse(attachment_storage.open(name, 'rb'), as_attachment=True, filename=filename, content_type=content_type)
+            response.block_size = attachments_setting('CHUNK_SIZE')
+            return with_cache_headers(response, etag)
+        start, end = byte_range or (0, size - 1)
+        stream = aread_range if asynchronous else read_range
+        response = StreamingHttpResponse(
+            stream(attachment_storage.open(name, 'rb'), start, end - start + 1, attachments_setting('CHUNK_SIZE')),
+            status=206 if byte_range is not None else 200, content_type=content_type,
+        )
+        response.headers['Content-Length'] = str(end - start + 1)
+        if byte_range is not None:
+            response.headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response.headers['Content-Disposition'] = content_disposition_header(True, filename)
+    return with_cache_headers(response, etag)
+
+
+def with_cache_headers(response, etag):
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Cache-Control'] = f"private, max-age={attachments_setting('CACHE_MAX_AGE')}"
+    if etag is not None:
+        response.headers['ETag'] = etag
+    return response
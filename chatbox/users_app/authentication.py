@@ -2,12 +2,13 @@ from django.shortcuts import render
 from rest_framework import viewsets, status, permissions
 from rest_framework.decorators import action, api_view, permission_classes
 from django.db.models import Q 
-from .serializers import ConversationSerializer, UserSerializer, UserProfileSerializer
+from .serializers import ChatboxTokenObtainPairSerializer, ConversationSerializer, UserSerializer, UserProfileSerializer
 from .models import *
 from django.contrib.auth import get_user_model
 from rest_framework.response import Response
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
-from rest_framework_simplejwt.tokens import RefreshToken
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from .blacklist import ChatboxRefreshToken
 
 User = get_user_model()
 
@@ -16,29 +17,24 @@ class CustomTokenObtainPairView(TokenObtainPairView):
     it inherits from an inbuilt method called TokenObtainPairView which has a method
     called post that helps log in the user and also create access and refresh token"""
     def post(self, request, *args, **kwargs):
-        response = super().post(request, *args, **kwargs)
-        if response.status_code == 200:
-            email = request.data.get('email')
-            
-            try:
-                user = User.objects.get(email=email)
-                user.is_online = True
-                user.save()
-            except User.DoesNotExist:
-                    raise Exception("User does not exist!")
-        return response
+        serializer = self.get_serializer(data=request.data)
+        try:
+            serializer.is_valid(raise_exception=True)
+        except TokenError as e:
+            raise InvalidToken(e.args[0])
+        
+        #the user isn't marked online here, only an open chat socket makes them online (chat_app.presence)
+        return Response(serializer.validated_data, status=status.HTTP_200_OK)
     
 @api_view(['POST'])
-@permission_classes(['AllowAny'])
+@permission_classes([permissions.AllowAny])
 def register(request):
     """it points the user to the registratiion view"""
     serializer = UserSerializer(data=request.data)
-    if serializer.is_valid:
-        user = serializer.save()
-        user.set_password(request.data.get('password'))
-        user.save()
+    if serializer.is_valid():
+        user = serializer.save() #UserSerializer hashes the password, one INSERT
         #generate refresh token for immediate logins
-        refresh = RefreshToken.for_user(user)
+        refresh = ChatboxTokenObtainPairSerializer.get_token(user)
         return Response({
             'Message' : 'User has registered Successfully',
             'user' : UserSerializer(user).data,
@@ -51,14 +47,10 @@ def register(request):
 def logout(request):
     """ viewset to logout """
     try:
-        refresh_token = UserSerializer(request.data.get('refresh_token')) #since we want to log out, we have to get the refresh token to blacklist it
-        token = RefreshToken(refresh_token) #we have to instantiate it using the RefreshToken, so we can easily use the method 'blacklist'
+        refresh_token = request.data.get('refresh_token') #since we want to log out, we have to get the refresh token to blacklist it
+        token = ChatboxRefreshToken(refresh_token) #we have to instantiate it using the RefreshToken, so we can easily use the method 'blacklist'
         token.blacklist()
         
-        #then we switch online to be false, so we won't be able to see them online
-        request.user.is_online = False
-        request.user.save()
-        
         return Response({'message': "User logged out successfully"}, status=status.HTTP_202_ACCEPTED)
     except Exception as e:
         print(f"Token Error: {e}") #this prints the original error caught by e and print it on the terminal
@@ -0,0 +1,212 @@
+import hashlib
+import math
+import threading
+import time
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils import timezone
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.tokens import RefreshToken
+from rest_framework_simplejwt.utils import datetime_from_epoch
+
+#REFRESH TOKEN BLACKLIST
+#with rotation every refresh checks the old token against the blacklist and then blacklists it. the
+#token_blacklist tables stay the durable record (admin, rebuilds), but lookups don't go to them:
+#- every process keeps a bloom filter of the blacklisted jtis that haven't expired. a jti it doesn't
+#  contain is not blacklisted, which is the answer for nearly every refresh, with no I/O at all.
+#- a jti it may contain is checked against the shared cache key written when it was blacklisted, and
+#  against the table when that key is gone (false positives, a flushed cache).
+#- blacklisting writes the rows, sets the cache key until the token expires and appends the jti to a
+#  numbered log in the shared cache. processes merge the new log entries into their filter at most every
+#  SYNC_INTERVAL seconds (one cache get when nothing changed), so a token blacklisted by another process
+#  is refused everywhere after SYNC_INTERVAL at the latest (0 syncs on every lookup).
+#- a filter is rebuilt from the table when it is first used, when it fills up past its capacity, or
+#  when the log can't bring it up to date (entries evicted, cache flushed). expired tokens drop out then.
+#flush_expired_tokens deletes expired rows in chunks so the tables don't grow without bound.
+
+DEFAULTS = {
+    'CACHE_ALIAS': 'default',
+    'BLOOM_CAPACITY': 1000000, #jtis per filter before it is rebuilt bigger
+    'BLOOM_ERROR_RATE': 0.001,
+    'SYNC_INTERVAL': 1.0,
+    'LOG_SIZE': 100000, #log entries kept, a process further behind rebuilds its filter
+    'LOG_TIMEOUT': 3600,
+    'FLUSH_CHUNK_SIZE': 10000,
+}
+
+
+def blacklist_setting(name):
+    """reads a key from settings.TOKEN_BLACKLIST, falling back to the defaults above"""
+    return getattr(settings, 'TOKEN_BLACKLIST', {}).get(name, DEFAULTS[name])
+
+
+def jti_key(jti):
+    return f'blacklist:jti:{jti}'
+
+
+def log_key(number):
+    return f'blacklist:log:{number}'
+
+
+SEQUENCE_KEY = 'blacklist:sequence'
+
+
+class BloomFilter:
+    """a fixed size bloom filter of strings, double hashing over one blake2b digest"""
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(first + n * second) % self.size for n in range(self.hashes)]
+
+    def add(self, item):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(item))
+
+
+class TokenBlacklist:
+    """the process wide blacklist, see the notes above"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bloom = None
+        self.sequence = 0 #last log entry merged into the filter
+        self.synced_at = 0.0
+        self.stalled = False
+
+    @property
+    def cache(self):
+        return caches[blacklist_setting('CACHE_ALIAS')]
+
+    def rebuild(self):
+        """a new filter of every blacklisted jti that hasn't expired, read from the table"""
+        #the log position is read first, entries added while the table is read are merged again, which is harmless
+        sequence = self.cache.get(SEQUENCE_KEY, 0)
+        jtis = BlacklistedToken.objects.filter(token__expires_at__gt=timezone.now()).values_list('token__jti', flat=True)
+        count = jtis.count()
+        bloom = BloomFilter(max(blacklist_setting('BLOOM_CAPACITY'), count * 2), blacklist_setting('BLOOM_ERROR_RATE'))
+        for jti in jtis.iterator(chunk_size=10000):
+            bloom.add(jti)
+        self.bloom, self.sequence, self.stalled = bloom, sequence, False
+
+    def sync(self, force=False):
+        """merges the jtis other processes blacklisted since the last sync"""
+        if not force and self.bloom is not None and time.monotonic() - self.synced_at < blacklist_setting('SYNC_INTERVAL'):
+            return
+        with self.lock:
+            if self.bloom is None:
+                self.rebuild()
+            sequence = self.cache.get(SEQUENCE_KEY, 0)
+            if sequence < self.sequence or sequence - self.sequence > blacklist_setting('LOG_SIZE'):
+                self.rebuild() #the cache was flushed or this process is too far behind
+            elif sequence > self.sequence:
+                entries = self.cache.get_many([log_key(number) for number in range(self.sequence + 1, sequence + 1)])
+                for number in range(self.sequence + 1, sequence + 1):
+                    jti = entries.get(log_key(number))
+                    if jti is None:
+                        break #not written yet, or evicted if it is still missing on the next sync
+                    self.bloom.add(jti)
+                    self.sequence = number
+                if self.sequence < sequence and self.stalled:
+                    self.rebuild()
+                self.stalled = self.sequence < sequence
+            if self.bloom.count > self.bloom.capacity:
+                self.rebuild()
+            self.synced_at = time.monotonic()
+
+    def contains(self, jti):
+        """whether the jti is blacklisted"""
+        self.sync()
+        if jti not in self.bloom:
+            return False
+        if self.cache.get(jti_key(jti)) is not None:
+            return True
+        return BlacklistedToken.objects.filter(token__jti=jti).exists()
+
+    def add(self, token):
+        """blacklists a token: the rows, the cache key until it expires and the log entry"""
+        jti, exp = token.payload[api_settings.JTI_CLAIM], token.payload['exp']
+        with transaction.atomic():
+            outstanding = OutstandingToken.objects.filter(jti=jti).first()
+            if outstanding is None:
+                #rotated refresh tokens are never registered as outstanding when they are issued
+                outstanding = OutstandingToken.objects.create(
+                    user_id=token.payload.get(api_settings.USER_ID_CLAIM), jti=jti, token=str(token), expires_at=datetime_from_epoch(exp),
+                )
+            BlacklistedToken.objects.bulk_create([BlacklistedToken(token=outstanding)], ignore_conflicts=True)
+            transaction.on_commit(lambda: self.publish(jti, exp))
+        #this process refuses it right away, a maybe before the commit is answered by the table
+        self.sync()
+        with self.lock:
+            self.bloom.add(jti)
+
+    def publish(self, jti, exp):
+        """tells the other processes once the rows are committed"""
+        cache = self.cache
+        cache.set(jti_key(jti), 1, timeout=max(int(exp - time.time()), 1))
+        cache.add(SEQUENCE_KEY, 0, timeout=None)
+        number = cache.incr(SEQUENCE_KEY)
+        cache.set(log_key(number), jti, timeout=blacklist_setting('LOG_TIMEOUT'))
+
+
+_blacklist = None
+_blacklist_lock = threading.Lock()
+
+
+def get_blacklist():
+    """returns the process wide TokenBlacklist"""
+    global _blacklist
+    if _blacklist is None:
+        with _blacklist_lock:
+            if _blacklist is None:
+                _blacklist = TokenBlacklist()
+    return _blacklist
+
+
+def reset_blacklist():
+    """drops the current blacklist so the next get_blacklist() rebuilds its filter (useful in tests)"""
+    global _blacklist
+    _blacklist = None
+
+
+class ChatboxRefreshToken(RefreshToken):
+    """RefreshToken checking and writing the blacklist through TokenBlacklist instead of the tables"""
+    def check_blacklist(self):
+        if get_blacklist().contains(self.payload[api_settings.JTI_CLAIM]):
+            raise TokenError('Token is blacklisted')
+
+    def blacklist(self):
+        get_blacklist().add(self)
+
+
+def flush_expired_tokens(chunk_size=None, progress=None):
+    """deletes expired outstanding tokens and their blacklist rows, chunk_size at a time in id order so
+    every statement stays short. returns how many outstanding tokens were deleted"""
+    chunk_size = chunk_size or blacklist_setting('FLUSH_CHUNK_SIZE')
+    deleted, last_id = 0, 0
+    now = timezone.now()
+    while True:
+        ids = list(
+            OutstandingToken.objects.filter(id__gt=last_id, expires_at__lte=now)
+            .order_by('id').values_list('id', flat=True)[:chunk_size]
+        )
+        if not ids:
+            return deleted
+        with transaction.atomic():
+            BlacklistedToken.objects.filter(token_id__in=ids).delete()
+            deleted += OutstandingToken.objects.filter(id__in=ids).delete()[0]
+        last_id = ids[-1]
+        if progress is not None:
+            progress(deleted)
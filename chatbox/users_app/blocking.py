@@ -0,0 +1,64 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Q
+from .models import User
+
+#BLOCK GRAPH CACHE
+#every user's block relationships are cached under one key as (blocked ids, blocked-by ids), so
+#"can A message B" is a single cache get and two set lookups on A's entry, whatever the direction of the
+#block. users_app.signals drops the entries of both sides whenever User.blocker_users changes.
+
+DEFAULTS = {
+    'TIMEOUT': 3600,
+    'CACHE_ALIAS': 'default',
+}
+
+Block = User.blocker_users.through
+
+NOT_BLOCKED = (frozenset(), frozenset())
+
+
+def block_cache_setting(name):
+    """reads a key from settings.BLOCK_CACHE, falling back to the defaults above"""
+    return getattr(settings, 'BLOCK_CACHE', {}).get(name, DEFAULTS[name])
+
+
+def _cache():
+    return caches[block_cache_setting('CACHE_ALIAS')]
+
+
+def block_key(user_id):
+    return f'blocks:user:{user_id}'
+
+
+def block_sets(user_id):
+    """(ids the user blocked, ids that blocked the user), loaded with one query on a miss"""
+    key = block_key(user_id)
+    sets = _cache().get(key)
+    if sets is None:
+        blocked, blocked_by = set(), set()
+        for from_id, to_id in Block.objects.filter(Q(from_user_id=user_id) | Q(to_user_id=user_id)).values_list('from_user_id', 'to_user_id'):
+            if from_id == user_id:
+                blocked.add(to_id)
+            else:
+                blocked_by.add(from_id)
+        #most users never block anyone, they all share the same empty entry
+        sets = (frozenset(blocked), frozenset(blocked_by)) if blocked or blocked_by else NOT_BLOCKED
+        _cache().set(key, sets, timeout=block_cache_setting('TIMEOUT'))
+    return sets
+
+
+def block_reason(sender_id, receiver_id):
+    """why sender can't message receiver, None when nothing stands in the way"""
+    blocked, blocked_by = block_sets(sender_id)
+    if receiver_id in blocked_by:
+        return 'You have been blocked by this user'
+    if receiver_id in blocked:
+        return 'You have blocked this user'
+    return None
+
+
+def invalidate(user_ids):
+    """drops the cached entries of the given users"""
+    if user_ids:
+        _cache().delete_many([block_key(user_id) for user_id in user_ids])
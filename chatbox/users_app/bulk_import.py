@@ -0,0 +1,162 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from django.conf import settings
+from django.contrib.auth.hashers import identify_hasher, make_password
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import IntegrityError, transaction
+from .models import User
+
+#BULK USER IMPORT
+#rows are imported CHUNK_SIZE at a time: every row is checked on its own (required fields, email format),
+#then the chunk's emails and usernames are checked against the table with one query each and against the
+#rows before them, the passwords of the valid rows are hashed in parallel and the rows go in with one
+#bulk_create. a row that fails is reported with its errors and the others carry on.
+#hashing is the slow part: the management command hashes in a pool of processes, the API in a small pool
+#of API_WORKERS threads of its own, so a request never forks the server and logins (which hash in the
+#login pool, users_app.login) don't queue behind an import. at ~0.3s a PBKDF2 hash MAX_API_ROWS keeps a
+#request well inside a proxy timeout, bigger imports go through the command. rows can also bring a password_hash
+#in any format of PASSWORD_HASHERS, or be hashed with a cheaper configured hasher (hasher=), either way
+#PooledModelBackend upgrades them to the default hasher at the user's first login.
+
+DEFAULTS = {
+    'CHUNK_SIZE': 1000,
+    'PROCESSES': None, #None for one per cpu
+    'MAX_API_ROWS': 100,
+    'API_WORKERS': 2,
+}
+
+FIELDS = ('email', 'username', 'password', 'password_hash', 'first_name', 'last_name', 'bio')
+
+
+def user_import_setting(name):
+    """reads a key from settings.USER_IMPORT, falling back to the defaults above"""
+    return getattr(settings, 'USER_IMPORT', {}).get(name, DEFAULTS[name])
+
+
+def clean_row(row):
+    """(the row's values, {field: error}) without looking at the database"""
+    values = {field: (str(row.get(field) or '')).strip() for field in FIELDS}
+    values['email'] = User.objects.normalize_email(values['email'])
+    errors = {}
+    if not values['email']:
+        errors['email'] = 'this field is required'
+    else:
+        try:
+            validate_email(values['email'])
+        except ValidationError:
+            errors['email'] = 'enter a valid email address'
+    if not values['username']:
+        errors['username'] = 'this field is required'
+    elif len(values['username']) > User._meta.get_field('username').max_length:
+        errors['username'] = 'too long'
+    if values['password'] and values['password_hash']:
+        errors['password'] = 'give a password or a password_hash, not both'
+    elif values['password_hash']:
+        try:
+            identify_hasher(values['password_hash'])
+        except ValueError:
+            errors['password_hash'] = 'unknown hash format'
+    return values, errors
+
+
+def taken(field, values):
+    """the values of field among values that already belong to a user"""
+    return set(User.objects.filter(**{f'{field}__in': values}).values_list(field, flat=True))
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_import_executor():
+    """the process wide pool API imports hash in, apart from the login pool"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=user_import_setting('API_WORKERS'), thread_name_prefix='import-hash')
+    return _executor
+
+
+def hash_passwords(pool, passwords, hasher=None):
+    """the encoded passwords in order, unusable ones for empty passwords (the user sets one by resetting it).
+    pool None hashes in the import threads"""
+    hash_one = partial(make_password, hasher=hasher or 'default')
+    if pool is None:
+        return list(get_import_executor().map(hash_one, [password or None for password in passwords]))
+    return list(pool.map(hash_one, [password or None for password in passwords], chunksize=max(1, len(passwords) // 64)))
+
+
+def insert(users, rows, failed):
+    """bulk_create of the chunk, a conflict with a user created meanwhile falls back to one insert per
+    row so only the conflicting rows fail. returns how many were created"""
+    try:
+        with transaction.atomic():
+            User.objects.bulk_create(users)
+        return len(users)
+    except IntegrityError:
+        pass
+    created = 0
+    for user, (index, values) in zip(users, rows):
+        try:
+            with transaction.atomic():
+                user.save(force_insert=True)
+            created += 1
+        except IntegrityError:
+            failed.append({'row': index, 'email': values['email'], 'errors': {'email': 'a user with this email or username already exists'}})
+    return created
+
+
+def import_users(rows, chunk_size=None, processes=None, hasher=None, progress=None):
+    """imports the rows (dicts of FIELDS), returns {'total', 'created', 'failed': [{'row', 'email', 'errors'}]}.
+    processes=0 hashes in the import threads instead of a process pool"""
+    chunk_size = chunk_size or user_import_setting('CHUNK_SIZE')
+    processes = user_import_setting('PROCESSES') if processes is None else processes
+    report = {'total': 0, 'created': 0, 'failed': []}
+    seen_emails, seen_usernames = set(), set()
+    pool = ProcessPoolExecutor(max_workers=processes or os.cpu_count()) if processes != 0 else None
+    try:
+        rows = list(rows)
+        for start in range(0, len(rows), chunk_size):
+            cleaned = [(start + offset, *clean_row(row)) for offset, row in enumerate(rows[start:start + chunk_size])]
+            emails = taken('email', [values['email'] for _, values, errors in cleaned if 'email' not in errors])
+            usernames = taken('username', [values['username'] for _, values, errors in cleaned if 'username' not in errors])
+
+            valid = []
+            for index, values, errors in cleaned:
+                if values['email'] in emails:
+                    errors.setdefault('email', 'a user with this email already exists')
+                elif values['email'] in seen_emails:
+                    errors.setdefault('email', 'duplicate email in the import')
+                if values['username'] in usernames:
+                    errors.setdefault('username', 'a user with this username already exists')
+                elif values['username'] in seen_usernames:
+                    errors.setdefault('username', 'duplicate username in the import')
+                seen_emails.add(values['email'])
+                seen_usernames.add(values['username'])
+                if errors:
+                    report['failed'].append({'row': index, 'email': values['email'], 'errors': errors})
+                else:
+                    valid.append((index, values))
+
+            hashed = iter(hash_passwords(pool, [values['password'] for _, values in valid if not values['password_hash']], hasher))
+            users = [
+                User(
+                    email=values['email'], username=values['username'],
+                    password=values['password_hash'] or next(hashed),
+                    first_name=values['first_name'], last_name=values['last_name'], bio=values['bio'],
+                )
+                for _, values in valid
+            ]
+            report['created'] += insert(users, valid, report['failed'])
+            report['total'] += len(cleaned)
+            if progress is not None:
+                progress(report)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    report['failed'].sort(key=lambda failure: failure['row'])
+    return report
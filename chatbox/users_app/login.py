@@ -0,0 +1,81 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.hashers import check_password, make_password
+from django.core.exceptions import PermissionDenied
+
+#LOGIN
+#password hashing is most of the cost of a login. django runs every sync view in its own thread under
+#daphne, so a burst of logins used to mean as many threads hashing at once, fighting over the cpus with
+#every other request. PooledModelBackend (settings.AUTHENTICATION_BACKENDS) sends the hashing to a pool of
+#HASH_WORKERS threads instead: at most that many hashes run at the same time and the other logins queue.
+#hashlib releases the GIL while it hashes, so the pool runs in parallel.
+#a failed password login raises PermissionDenied, which ends django's backend loop, so ModelBackend (listed
+#after it only to resolve old sessions) never hashes the same password again on the request thread.
+#a login writes nothing but the refresh token: issuing a token doesn't make a user online, only their chat
+#sockets do (chat_app.presence), and the presence snapshots set users.is_online.
+
+DEFAULTS = {
+    'HASH_WORKERS': min(4, os.cpu_count() or 1),
+}
+
+User = get_user_model()
+
+
+def login_setting(name):
+    """reads a key from settings.LOGIN, falling back to the defaults above"""
+    return getattr(settings, 'LOGIN', {}).get(name, DEFAULTS[name])
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_hash_executor():
+    """the process wide pool the password hashes run in"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=login_setting('HASH_WORKERS'), thread_name_prefix='password-hash')
+    return _executor
+
+
+def verify_password(encoded, raw_password):
+    """(whether the password matches, whether the hash should be upgraded), computed in the pool.
+    the pool threads never touch the database, the caller saves the upgraded hash"""
+    def check():
+        upgrade = []
+        valid = check_password(raw_password, encoded, setter=upgrade.append)
+        return valid, bool(upgrade)
+    return get_hash_executor().submit(check).result()
+
+
+def hash_password(raw_password):
+    return get_hash_executor().submit(make_password, raw_password).result()
+
+
+class PooledModelBackend(ModelBackend):
+    """ModelBackend with the password hashing done in the login pool, the only backend that checks passwords"""
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        if username is None:
+            username = kwargs.get(User.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+        try:
+            user = User._default_manager.get_by_natural_key(username)
+        except User.DoesNotExist:
+            #hash anyway so an unknown email takes as long as a wrong password
+            hash_password(password)
+            raise PermissionDenied
+        valid, upgrade = verify_password(user.password, password)
+        if not valid or not self.user_can_authenticate(user):
+            raise PermissionDenied
+        if upgrade:
+            #rehashed in the pool too, set_password would hash on the request thread
+            user.password = hash_password(password)
+            user.save(update_fields=['password'])
+        return user
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from users_app.models import Conversation
+
+
+class Command(BaseCommand):
+    """fills the denormalized last_message_* and participant_count columns of existing conversations,
+    a chunk of conversations per transaction so it can run on a live database"""
+    help = 'backfill conversation list summaries in chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        last_id, done = 0, 0
+        while True:
+            ids = list(
+                Conversation.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:chunk_size]
+            )
+            if not ids:
+                break
+            with transaction.atomic():
+                Conversation.refresh_last_message(ids)
+                Conversation.refresh_participant_counts(ids)
+            last_id = ids[-1]
+            done += len(ids)
+            self.stdout.write(f'{done} conversations backfilled (up to id {last_id})')
+        self.stdout.write(self.style.SUCCESS(f'done, {done} conversations'))
@@ -0,0 +1,96 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.hashers import get_hasher, make_password
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from users_app.login import login_setting
+from users_app.models import User
+from users_app.serializers import ChatboxTokenObtainPairSerializer
+
+PASSWORD = 'bench-login-password'
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+class Command(BaseCommand):
+    """login throughput with --concurrency requests at once, each in its own thread like daphne runs sync
+    views: the old path (hash in the request thread, User.objects.get and a full save) next to the
+    current one (hash in the users_app.login pool, no users row write)"""
+    help = 'benchmark logins with the configured password hasher'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--logins', type=int, default=400, help='logins per implementation')
+        parser.add_argument('--concurrency', type=int, default=32, help='logins in flight at once')
+        parser.add_argument('--keep', action='store_true', help='keep the generated users')
+
+    def handle(self, *args, **options):
+        emails = self.seed(options['users'])
+        self.queries = 0
+        connection_created.connect(self.install)
+        for alias in connections:
+            self.install(connections[alias])
+        try:
+            self.stdout.write(f"hasher {get_hasher().algorithm}, {options['concurrency']} at once, "
+                              f"{login_setting('HASH_WORKERS')} hash workers")
+            self.stdout.write(f"{'implementation':<16} {'logins/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'queries each':>13}")
+            for label, login in (('request thread', self.old_login), ('hash pool', self.new_login)):
+                rate, latencies, queries = self.run(login, emails, options)
+                self.stdout.write(f'{label:<16} {rate:>9.1f} {percentile(latencies, 0.5):>8.1f} '
+                                  f'{percentile(latencies, 0.99):>8.1f} {queries:>13.2f}')
+        finally:
+            connection_created.disconnect(self.install)
+            if not options['keep']:
+                User.objects.filter(email__startswith='bench_login_').delete()
+
+    def install(self, connection, **kwargs):
+        if self.count not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self.count)
+
+    def count(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+    def old_login(self, email):
+        user = ModelBackend().authenticate(None, username=email, password=PASSWORD)
+        token = ChatboxTokenObtainPairSerializer.get_token(user)
+        str(token.access_token)
+        user = User.objects.get(email=email)
+        user.is_online = True
+        user.save()
+
+    def new_login(self, email):
+        serializer = ChatboxTokenObtainPairSerializer(data={'email': email, 'password': PASSWORD})
+        serializer.is_valid(raise_exception=True)
+
+    def run(self, login, emails, options):
+        """runs --logins logins, returns logins per second, latencies in ms and queries per login"""
+        def timed(n):
+            started = time.perf_counter()
+            try:
+                login(emails[n % len(emails)])
+            finally:
+                connection.close()
+            return (time.perf_counter() - started) * 1000
+        queries_before = self.queries
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            latencies = list(pool.map(timed, range(options['logins'])))
+        elapsed = time.perf_counter() - started
+        return options['logins'] / elapsed, latencies, (self.queries - queries_before) / options['logins']
+
+    def seed(self, total):
+        """users sharing one password hash made with the configured hasher"""
+        encoded = make_password(PASSWORD)
+        emails = [f'bench_login_{n}@example.com' for n in range(total)]
+        existing = set(User.objects.filter(email__in=emails).values_list('email', flat=True))
+        User.objects.bulk_create([
+            User(username=email.split('@')[0], email=email, password=encoded) for email in emails if email not in existing
+        ])
+        User.objects.filter(email__in=emails).update(password=encoded)
+        return emails
@@ -0,0 +1,73 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import RequestFactory
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.request import Request
+from users_app.models import User, Conversation, Message
+from users_app.pagination import MessageCursorPagination
+
+
+class Command(BaseCommand):
+    """compares per-page latency of offset (page number) and keyset (cursor) pagination
+    as the page gets deeper into a conversation's history"""
+    help = 'benchmark message history pagination at increasing depths'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=200000, help='messages in the benchmark conversation')
+        parser.add_argument('--page-size', type=int, default=20)
+        parser.add_argument('--repeat', type=int, default=5, help='runs per depth, the best one is reported')
+        parser.add_argument('--keep', action='store_true', help='keep the generated conversation')
+
+    def handle(self, *args, **options):
+        total, page_size, repeat = options['messages'], options['page_size'], options['repeat']
+        conversation = self.seed(total)
+        factory = RequestFactory()
+        queryset = Message.objects.filter(conversation=conversation)
+        ids = list(queryset.order_by('-created_at', '-id').values_list('id', flat=True))
+
+        self.stdout.write(f"{'depth':>10} {'offset ms':>12} {'cursor ms':>12}")
+        try:
+            for fraction in (0, 0.01, 0.1, 0.5, 0.9, 0.99):
+                depth = int((total - page_size) * fraction)
+                page_number = depth // page_size + 1
+                anchor = ids[depth]
+
+                offset_request = Request(factory.get('/', {'page': page_number, 'page_size': page_size}))
+                paginator = PageNumberPagination()
+                paginator.page_size = page_size
+                offset_ms = self.best_of(repeat, lambda: list(paginator.paginate_queryset(queryset, offset_request)))
+
+                cursor_request = Request(factory.get('/', {'around': anchor, 'page_size': page_size}))
+                cursor_ms = self.best_of(repeat, lambda: MessageCursorPagination().paginate_queryset(queryset, cursor_request))
+
+                self.stdout.write(f"{depth:>10} {offset_ms:>12.2f} {cursor_ms:>12.2f}")
+        finally:
+            if not options['keep']:
+                conversation.delete()
+
+    def best_of(self, repeat, run):
+        """runs the callable a few times and returns the fastest run in milliseconds"""
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            run()
+            timings.append((time.perf_counter() - started) * 1000)
+        return min(timings)
+
+    @transaction.atomic
+    def seed(self, total):
+        """creates a conversation with `total` messages using chunked bulk inserts"""
+        sender, _ = User.objects.get_or_create(
+            username='bench_sender', defaults={'email': 'bench_sender@example.com'}
+        )
+        conversation = Conversation.objects.create(title='pagination benchmark')
+        conversation.participants.add(sender)
+        chunk = 5000
+        for start in range(0, total, chunk):
+            Message.objects.bulk_create([
+                Message(sender=sender, conversation=conversation, content=f'message {n}')
+                for n in range(start, min(start + chunk, total))
+            ])
+        self.stdout.write(f'seeded {total} messages in conversation {conversation.id}')
+        return conversation
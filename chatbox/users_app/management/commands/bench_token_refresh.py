@@ -0,0 +1,78 @@
+import time
+import uuid
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.tokens import RefreshToken
+from users_app.blacklist import ChatboxRefreshToken, get_blacklist
+from users_app.models import User
+from users_app.serializers import ChatboxTokenRefreshSerializer
+
+
+class Command(BaseCommand):
+    """refresh throughput with rotation and blacklisting on a large token table: simplejwt's own
+    refresh (blacklist lookups and writes through the tables) next to users_app.blacklist"""
+    help = 'benchmark token refresh against millions of outstanding tokens'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--outstanding', type=int, default=2000000, help='outstanding tokens in the table, missing ones are generated')
+        parser.add_argument('--blacklisted', type=float, default=0.5, help='share of the generated tokens that is blacklisted')
+        parser.add_argument('--refreshes', type=int, default=2000, help='refreshes per implementation')
+        parser.add_argument('--keep', action='store_true', help='keep the generated tokens')
+
+    def handle(self, *args, **options):
+        user, _ = User.objects.get_or_create(email='bench_refresh@example.com', defaults={'username': 'bench_refresh'})
+        created = self.seed(user, options['outstanding'], options['blacklisted'])
+        try:
+            started = time.perf_counter()
+            get_blacklist().sync(force=True)
+            self.stdout.write(f'{OutstandingToken.objects.count()} outstanding, {BlacklistedToken.objects.count()} blacklisted, '
+                              f'filter built in {(time.perf_counter() - started) * 1000:.0f} ms')
+            self.stdout.write(f"{'implementation':<16} {'refresh/s':>10} {'queries each':>13}")
+            for label, serializer_class, token_class in (
+                ('simplejwt', TokenRefreshSerializer, RefreshToken),
+                ('users_app', ChatboxTokenRefreshSerializer, ChatboxRefreshToken),
+            ):
+                rate, queries = self.run(user, serializer_class, token_class, options['refreshes'])
+                self.stdout.write(f'{label:<16} {rate:>10.1f} {queries:>13.2f}')
+        finally:
+            if created and not options['keep']:
+                OutstandingToken.objects.filter(jti__startswith='bench-').delete()
+
+    def run(self, user, serializer_class, token_class, refreshes):
+        """rotates one refresh token `refreshes` times, returns refreshes per second and queries per refresh"""
+        refresh = str(token_class.for_user(user))
+        queries = [0]
+
+        def count(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+        with connection.execute_wrapper(count):
+            started = time.perf_counter()
+            for _ in range(refreshes):
+                serializer = serializer_class(data={'refresh': refresh})
+                serializer.is_valid(raise_exception=True)
+                refresh = serializer.validated_data['refresh']
+            elapsed = time.perf_counter() - started
+        return refreshes / elapsed, queries[0] / refreshes
+
+    def seed(self, user, total, blacklisted, chunk_size=10000):
+        """tops the outstanding tokens up to `total` with generated rows, returns how many were created"""
+        missing = total - OutstandingToken.objects.count()
+        expires_at = timezone.now() + timedelta(days=7)
+        for offset in range(0, max(missing, 0), chunk_size):
+            with transaction.atomic():
+                tokens = OutstandingToken.objects.bulk_create([
+                    OutstandingToken(user=user, jti=f'bench-{uuid.uuid4().hex}', token='', expires_at=expires_at)
+                    for _ in range(min(chunk_size, missing - offset))
+                ])
+                if tokens and tokens[0].pk is None: #databases that don't return ids from bulk_create
+                    tokens = list(OutstandingToken.objects.filter(blacklistedtoken__isnull=True, jti__startswith='bench-').order_by('-id')[:len(tokens)])
+                BlacklistedToken.objects.bulk_create([BlacklistedToken(token=token) for token in tokens[:int(len(tokens) * blacklisted)]])
+            self.stdout.write(f'seeded {offset + len(tokens)} tokens', ending='\r')
+        if missing > 0:
+            self.stdout.write('')
+        return max(missing, 0)
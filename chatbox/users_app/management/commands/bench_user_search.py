@@ -0,0 +1,77 @@
+import random
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from users_app.models import User
+from users_app.search import find_users, search_mode
+
+SYLLABLES = ['ada', 'eze', 'tun', 'de', 'ko', 'fi', 'ola', 'mi', 'chi', 'nna', 'bo', 'la', 'ke', 'mo', 'sa', 'ri', 'yu', 'wa', 'ife', 'emi']
+
+
+class Command(BaseCommand):
+    """user search latency on a large users table: the old username__icontains scan next to
+    users_app.search (trigram indexes on postgres) for prefix, typo, name and no-match queries"""
+    help = 'benchmark the user search on a generated users table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000000, help='users in the table, missing ones are generated')
+        parser.add_argument('--page-size', type=int, default=20)
+        parser.add_argument('--repeat', type=int, default=5, help='runs per query, the best one is reported')
+        parser.add_argument('--seed', type=int, default=7)
+        parser.add_argument('--keep', action='store_true', help='keep the generated users')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        created = self.seed(options['users'], rng)
+        size = options['page_size']
+        generated = User.objects.filter(username__startswith='bench_search_').count()
+        sample = User.objects.get(email=f'bench_search_{rng.randrange(generated)}@example.com')
+        name = sample.username[len('bench_search_'):]
+        queries = [
+            ('prefix', name[:4]),
+            ('typo', name[:3] + name[4:] if len(name) > 5 else name + 'x'),
+            ('first name', sample.first_name),
+            ('no match', 'qqzzxx'),
+        ]
+
+        self.stdout.write(f"mode: {search_mode()}, {User.objects.count()} users")
+        self.stdout.write(f"{'query':<12} {'text':<16} {'icontains ms':>13} {'search ms':>10} {'hits':>5}")
+        try:
+            for label, text in queries:
+                scan_ms, _ = self.best_of(options['repeat'], lambda: list(User.objects.filter(username__icontains=text)[:size + 1]))
+                search_ms, rows = self.best_of(options['repeat'], lambda: list(find_users(text)[:size + 1]))
+                self.stdout.write(f'{label:<12} {text:<16} {scan_ms:>13.2f} {search_ms:>10.2f} {len(rows):>5}')
+            if connection.vendor == 'postgresql':
+                self.stdout.write(find_users(queries[0][1])[:size + 1].explain(analyze=True))
+        finally:
+            if created and not options['keep']:
+                User.objects.filter(username__startswith='bench_search_').delete()
+
+    def best_of(self, repeat, run):
+        """runs the callable a few times and returns the fastest run in milliseconds and its result"""
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = run()
+            timings.append((time.perf_counter() - started) * 1000)
+        return min(timings), result
+
+    def seed(self, total, rng, chunk_size=10000):
+        """tops the users table up to `total` rows with generated names, returns how many were created"""
+        missing = total - User.objects.count()
+        start = User.objects.filter(username__startswith='bench_search_').count()
+        for offset in range(0, max(missing, 0), chunk_size):
+            with transaction.atomic():
+                users = []
+                for n in range(start + offset, start + min(offset + chunk_size, missing)):
+                    first = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3)))
+                    last = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+                    users.append(User(
+                        username=f'bench_search_{first}{last}{n}', email=f'bench_search_{n}@example.com',
+                        first_name=first.title(), last_name=last.title(), password='!',
+                    ))
+                User.objects.bulk_create(users)
+            self.stdout.write(f'seeded {start + min(offset + chunk_size, missing)} users', ending='\r')
+        if missing > 0:
+            self.stdout.write('')
+        return max(missing, 0)
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from users_app.blacklist import blacklist_setting, flush_expired_tokens
+
+
+class Command(BaseCommand):
+    """simplejwt's flushexpiredtokens deletes every expired row in one statement, this deletes them
+    --chunk-size at a time so it can run on a live database (cron, every few hours)"""
+    help = 'delete expired outstanding and blacklisted tokens in chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=blacklist_setting('FLUSH_CHUNK_SIZE'), help='rows per DELETE')
+
+    def handle(self, *args, **options):
+        deleted = flush_expired_tokens(
+            chunk_size=options['chunk_size'],
+            progress=lambda deleted: self.stdout.write(f'{deleted} deleted', ending='\r'),
+        )
+        self.stdout.write(self.style.SUCCESS(f'{deleted} expired tokens deleted'))
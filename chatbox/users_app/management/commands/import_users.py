@@ -0,0 +1,48 @@
+import csv
+import json
+from django.contrib.auth.hashers import get_hashers_by_algorithm
+from django.core.management.base import BaseCommand, CommandError
+from users_app.bulk_import import import_users, user_import_setting
+
+
+class Command(BaseCommand):
+    """imports users from a partner's csv file (a header row of email, username, password or password_hash,
+    first_name, last_name, bio) or json file (a list of objects with those keys). passwords are hashed in
+    --processes processes, --hasher picks a cheaper configured hasher the users are moved off at their first
+    login. the rows that fail are listed, or written to --report as json"""
+    help = 'bulk import users from a csv or json file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='a .csv or .json file')
+        parser.add_argument('--chunk-size', type=int, default=user_import_setting('CHUNK_SIZE'), help='rows per bulk insert')
+        parser.add_argument('--processes', type=int, default=user_import_setting('PROCESSES'), help='hashing processes, one per cpu by default')
+        parser.add_argument('--hasher', default=None, help='algorithm of PASSWORD_HASHERS to hash with, the default hasher if not given')
+        parser.add_argument('--report', default=None, help='write the failed rows to this json file')
+
+    def read(self, path):
+        try:
+            with open(path, newline='', encoding='utf-8') as f:
+                if path.endswith('.json'):
+                    return json.load(f)
+                return list(csv.DictReader(f))
+        except (OSError, ValueError) as e:
+            raise CommandError(f'cannot read {path}: {e}')
+
+    def handle(self, *args, **options):
+        if options['hasher'] is not None and options['hasher'] not in get_hashers_by_algorithm():
+            raise CommandError(f"unknown hasher {options['hasher']}, it must be one of PASSWORD_HASHERS")
+        if options['processes'] is not None and options['processes'] < 1:
+            raise CommandError('--processes must be at least 1')
+        rows = self.read(options['path'])
+        report = import_users(
+            rows, chunk_size=options['chunk_size'], processes=options['processes'], hasher=options['hasher'],
+            progress=lambda report: self.stdout.write(f"{report['total']}/{len(rows)} rows, {report['created']} created", ending='\r'),
+        )
+        self.stdout.write('')
+        if options['report']:
+            with open(options['report'], 'w', encoding='utf-8') as f:
+                json.dump(report['failed'], f, indent=2)
+        else:
+            for failure in report['failed']:
+                self.stdout.write(f"row {failure['row']} {failure['email']}: {failure['errors']}")
+        self.stdout.write(self.style.SUCCESS(f"{report['created']} of {report['total']} users created, {len(report['failed'])} failed"))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from users_app.message_search import message_search_setting, reindex_messages, search_mode
+
+
+class Command(BaseCommand):
+    """fills Message.search_vector for existing messages (users_app.message_search), one UPDATE per
+    id range so it can run on a live table. new and edited messages are indexed by signals, this is for
+    the backfill after the migration and after changing MESSAGE_SEARCH['CONFIG']"""
+    help = 'rebuild the full-text search vectors of messages in chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=None, help="ids per UPDATE, MESSAGE_SEARCH['CHUNK_SIZE'] by default")
+        parser.add_argument('--only-missing', action='store_true', help='skip messages that already have a vector')
+
+    def handle(self, *args, **options):
+        if search_mode() != 'fulltext':
+            self.stdout.write('message search is in basic mode (full-text needs postgres), nothing to index')
+            return
+        chunk_size = options['chunk_size'] or message_search_setting('CHUNK_SIZE')
+
+        def progress(done_id, last_id, updated):
+            self.stdout.write(f'up to id {done_id} of {last_id}, {updated} messages indexed', ending='\r')
+
+        updated = reindex_messages(chunk_size, options['only_missing'], progress)
+        self.stdout.write('')
+        self.stdout.write(self.style.SUCCESS(f'{updated} messages indexed'))
@@ -0,0 +1,95 @@
+from django.conf import settings
+from django.core.cache import caches
+from .models import Conversation
+
+#CONVERSATION MEMBERSHIP CACHE
+#the participants of a conversation and the conversations of a user are cached as frozensets of ids,
+#so "is this user in this conversation" is a set lookup instead of loading every participant row.
+#users_app.signals drops the keys whenever Conversation.participants changes or a conversation is deleted.
+
+DEFAULTS = {
+    'TIMEOUT': 3600,
+    'CACHE_ALIAS': 'default',
+}
+
+Participant = Conversation.participants.through
+
+
+def membership_setting(name):
+    """reads a key from settings.MEMBERSHIP_CACHE, falling back to the defaults above"""
+    return getattr(settings, 'MEMBERSHIP_CACHE', {}).get(name, DEFAULTS[name])
+
+
+def _cache():
+    return caches[membership_setting('CACHE_ALIAS')]
+
+
+def conversation_key(conversation_id):
+    return f'membership:conversation:{conversation_id}'
+
+
+def user_key(user_id):
+    return f'membership:user:{user_id}'
+
+
+def conversation_member_ids(conversation_id):
+    """the user ids taking part in a conversation, loaded with one ids-only query on a miss"""
+    key = conversation_key(conversation_id)
+    member_ids = _cache().get(key)
+    if member_ids is None:
+        member_ids = frozenset(
+            Participant.objects.filter(conversation_id=conversation_id).values_list('user_id', flat=True)
+        )
+        _cache().set(key, member_ids, timeout=membership_setting('TIMEOUT'))
+    return member_ids
+
+
+def user_conversation_ids(user_id):
+    """the conversation ids a user takes part in, loaded with one ids-only query on a miss"""
+    key = user_key(user_id)
+    conversation_ids = _cache().get(key)
+    if conversation_ids is None:
+        conversation_ids = frozenset(
+            Participant.objects.filter(user_id=user_id).values_list('conversation_id', flat=True)
+        )
+        _cache().set(key, conversation_ids, timeout=membership_setting('TIMEOUT'))
+    return conversation_ids
+
+
+def is_participant(conversation_id, user_id):
+    """checks membership from whichever cached set exists, and falls back to one EXISTS query"""
+    cache = _cache()
+    found = cache.get_many([conversation_key(conversation_id), user_key(user_id)])
+    if conversation_key(conversation_id) in found:
+        return user_id in found[conversation_key(conversation_id)]
+    if user_key(user_id) in found:
+        return int(conversation_id) in found[user_key(user_id)]
+    return Participant.objects.filter(conversation_id=conversation_id, user_id=user_id).exists()
+
+
+def contact_ids(user_id):
+    """ids of every user sharing at least one conversation with the user (the user included).
+    the member sets are read with one get_many, and every missing one is loaded by a single query"""
+    cache = _cache()
+    keys = {conversation_key(conversation_id): conversation_id for conversation_id in user_conversation_ids(user_id)}
+    found = cache.get_many(keys)
+    ids = set().union(*found.values())
+    missing = [conversation_id for key, conversation_id in keys.items() if key not in found]
+    if missing:
+        members = {conversation_id: set() for conversation_id in missing}
+        for conversation_id, member_id in Participant.objects.filter(conversation_id__in=missing).values_list('conversation_id', 'user_id'):
+            members[conversation_id].add(member_id)
+        cache.set_many(
+            {conversation_key(conversation_id): frozenset(member_ids) for conversation_id, member_ids in members.items()},
+            timeout=membership_setting('TIMEOUT'),
+        )
+        for member_ids in members.values():
+            ids |= member_ids
+    return ids
+
+
+def invalidate(conversation_ids=(), user_ids=()):
+    """drops the cached sets of the given conversations and users"""
+    keys = [conversation_key(pk) for pk in conversation_ids] + [user_key(pk) for pk in user_ids]
+    if keys:
+        _cache().delete_many(keys)
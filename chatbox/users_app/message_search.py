@@ -0,0 +1,122 @@
+import re
+from django.conf import settings
+from django.db import connection
+from django.utils.html import escape
+from .models import Message
+from .membership import user_conversation_ids
+
+#MESSAGE SEARCH
+#on postgres Message.search_vector holds the tsvector of the content, backed by a GIN index (users_app
+#migration 0005). it is filled in by users_app.signals every time messages are inserted (one UPDATE per
+#batch, so the write buffer's bulk inserts stay one statement) or their content is saved, and
+#reindex_messages backfills existing rows in id-range chunks. searches use websearch syntax
+#("exact phrase", -word, or) and ts_headline for the snippets.
+#other databases (sqlite in tests) get the 'basic' mode, icontains on the content with the snippet
+#cut out in python, which is a scan of the user's conversations.
+
+DEFAULTS = {
+    'MODE': 'auto', #'fulltext', 'basic', or 'auto' to pick fulltext on postgres
+    'CONFIG': 'simple', #text search configuration, 'simple' doesn't stem so it works for every language
+    'MIN_LENGTH': 2,
+    'MAX_LENGTH': 200,
+    'CHUNK_SIZE': 5000,
+    'START_SEL': '<mark>',
+    'STOP_SEL': '</mark>',
+    'SNIPPET_WORDS': 12,
+}
+
+
+#what ts_headline marks the matches with, private use characters that don't occur in messages
+START_SENTINEL, STOP_SENTINEL = '\ue000', '\ue001'
+
+
+def message_search_setting(name):
+    """reads a key from settings.MESSAGE_SEARCH, falling back to the defaults above"""
+    return getattr(settings, 'MESSAGE_SEARCH', {}).get(name, DEFAULTS[name])
+
+
+def search_mode():
+    mode = message_search_setting('MODE')
+    if mode == 'auto':
+        return 'fulltext' if connection.vendor == 'postgresql' else 'basic'
+    return mode
+
+
+#INDEXING
+def search_vector():
+    from django.contrib.postgres.search import SearchVector
+    return SearchVector('content', config=message_search_setting('CONFIG'))
+
+
+def index_messages(message_ids):
+    """recomputes search_vector of the given messages with one UPDATE, does nothing in basic mode"""
+    if search_mode() != 'fulltext' or not message_ids:
+        return 0
+    return Message.objects.filter(id__in=message_ids).update(search_vector=search_vector())
+
+
+def reindex_messages(chunk_size=None, only_missing=False, progress=None):
+    """recomputes search_vector over the whole messages table, one UPDATE per id range of chunk_size
+    so no statement holds locks on more than a chunk of rows. returns how many rows were updated"""
+    if search_mode() != 'fulltext':
+        return 0
+    chunk_size = chunk_size or message_search_setting('CHUNK_SIZE')
+    messages = Message.objects.all()
+    if only_missing:
+        messages = messages.filter(search_vector__isnull=True)
+    first = messages.order_by('id').values_list('id', flat=True).first()
+    last = messages.order_by('-id').values_list('id', flat=True).first()
+    updated = 0
+    if first is None:
+        return updated
+    for start in range(first, last + 1, chunk_size):
+        updated += messages.filter(id__gte=start, id__lt=start + chunk_size).update(search_vector=search_vector())
+        if progress is not None:
+            progress(min(start + chunk_size - 1, last), last, updated)
+    return updated
+
+
+#SEARCHING
+def find_messages(user, query, conversation_id=None):
+    """messages of the user's conversations (or of one of them) that match the query, with a snippet
+    annotation in fulltext mode. ordered newest first for MessageCursorPagination"""
+    query = query.strip()[:message_search_setting('MAX_LENGTH')]
+    conversation_ids = user_conversation_ids(user.id)
+    if conversation_id is not None:
+        conversation_ids = conversation_ids & {conversation_id}
+    messages = Message.objects.filter(conversation_id__in=conversation_ids).select_related('sender')
+
+    if search_mode() == 'fulltext':
+        from django.contrib.postgres.search import SearchHeadline, SearchQuery
+        search_query = SearchQuery(query, config=message_search_setting('CONFIG'), search_type='websearch')
+        words = message_search_setting('SNIPPET_WORDS')
+        #ts_headline doesn't escape the content, the matches are marked with sentinels that render_snippet
+        #turns into START_SEL/STOP_SEL after escaping everything else
+        messages = messages.filter(search_vector=search_query).annotate(snippet=SearchHeadline(
+            'content', search_query, config=message_search_setting('CONFIG'),
+            start_sel=START_SENTINEL, stop_sel=STOP_SENTINEL,
+            max_words=words, min_words=max(words // 2, 1), max_fragments=1,
+        ))
+    else:
+        messages = messages.filter(content__icontains=query)
+    return messages.order_by('-created_at', '-id')
+
+
+def render_snippet(headline):
+    """a ts_headline snippet as html: the content escaped, the sentinels replaced by START_SEL/STOP_SEL"""
+    return escape(headline).replace(START_SENTINEL, message_search_setting('START_SEL')).replace(STOP_SENTINEL, message_search_setting('STOP_SEL'))
+
+
+def highlight(content, query):
+    """the basic mode snippet: about SNIPPET_WORDS words around the first match, escaped and with the
+    match wrapped in START_SEL/STOP_SEL like render_snippet does"""
+    match = re.search(re.escape(query.strip()), content, flags=re.IGNORECASE)
+    if match is None:
+        return escape(content)
+    words = message_search_setting('SNIPPET_WORDS')
+    before = content[:match.start()].split(' ')[-(words // 2):]
+    after = content[match.end():].split(' ')[:words // 2 + 1]
+    return (
+        escape(' '.join(before)) + message_search_setting('START_SEL') + escape(match.group(0))
+        + message_search_setting('STOP_SEL') + escape(' '.join(after))
+    )
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:18
+
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+#GIN trigram indexes for users_app.search, postgres only. they are built concurrently (the migration is not
+#atomic) so signups and logins aren't blocked while a large users table is indexed. other databases skip them.
+SEARCH_INDEXES = [
+    GinIndex(fields=['username'], opclasses=['gin_trgm_ops'], name='users_username_trgm_idx'),
+    GinIndex(fields=['first_name'], opclasses=['gin_trgm_ops'], name='users_first_name_trgm_idx'),
+    GinIndex(fields=['last_name'], opclasses=['gin_trgm_ops'], name='users_last_name_trgm_idx'),
+]
+
+
+def add_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    User = apps.get_model('users_app', 'User')
+    for index in SEARCH_INDEXES:
+        schema_editor.add_index(User, index, concurrently=True)
+
+
+def remove_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    User = apps.get_model('users_app', 'User')
+    for index in SEARCH_INDEXES:
+        schema_editor.remove_index(User, index, concurrently=True)
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('users_app', '0003_conversation_summary'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.RunPython(add_search_indexes, remove_search_indexes),
+    ]
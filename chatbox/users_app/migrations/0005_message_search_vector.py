@@ -0,0 +1,39 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:20
+
+import django.contrib.postgres.search
+from django.contrib.postgres.indexes import GinIndex
+from django.db import migrations
+
+#the GIN index of users_app.message_search, postgres only and built concurrently like the user search
+#indexes. existing messages are indexed by the reindex_messages command, not here, so the migration is quick
+SEARCH_INDEX = GinIndex(fields=['search_vector'], name='messages_search_vector_idx')
+
+
+def add_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.add_index(apps.get_model('users_app', 'Message'), SEARCH_INDEX, concurrently=True)
+
+
+def remove_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.remove_index(apps.get_model('users_app', 'Message'), SEARCH_INDEX, concurrently=True)
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('users_app', '0004_user_search_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(add_search_index, remove_search_index),
+    ]
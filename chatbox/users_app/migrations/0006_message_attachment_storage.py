@@ -0,0 +1,19 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:47
+
+from django.db import migrations, models
+import users_app.attachments
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users_app', '0005_message_search_vector'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='file_attachement',
+            field=models.FileField(blank=True, null=True, storage=users_app.attachments.get_attachment_storage, upload_to='message_files/'),
+        ),
+    ]
@@ -1,7 +1,11 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.functions import Coalesce, Substr
 from django.contrib.auth.models import AbstractUser
+from django.contrib.postgres.search import SearchVectorField
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
+from .attachments import get_attachment_storage
 
 # Create your models here.
 class User(AbstractUser):
@@ -90,6 +94,58 @@ class Conversation(models.Model):
     is_group = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)    
+    
+    #denormalized summary for the conversation list, so listing conversations doesn't need a query per row
+    #kept up to date by record_last_messages (message inserts), Message.delete and users_app.signals (participant changes)
+    last_message = models.ForeignKey('Message', null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    last_message_preview = models.CharField(max_length=50, blank=True)
+    last_message_at = models.DateTimeField(default=timezone.now) #creation time until the first message arrives
+    participant_count = models.PositiveIntegerField(default=0)
+    
+    PREVIEW_LENGTH = 50
+    
+    class Meta:
+        indexes = [
+            #the conversation list is ordered by the latest message
+            models.Index(fields=['-last_message_at', '-id'], name='conversation_last_msg_idx'),
+        ]
+    
+    @classmethod
+    def record_last_messages(cls, messages):
+        """moves last_message forward for the conversations of newly inserted messages, one UPDATE
+        per conversation. the last_message_at condition keeps an older message from overwriting a newer one"""
+        newest = {}
+        for message in messages:
+            current = newest.get(message.conversation_id)
+            if current is None or (message.created_at, message.pk) > (current.created_at, current.pk):
+                newest[message.conversation_id] = message
+        for conversation_id, message in newest.items():
+            cls.objects.filter(id=conversation_id, last_message_at__lte=message.created_at).update(
+                last_message=message,
+                last_message_preview=message.content[:cls.PREVIEW_LENGTH],
+                last_message_at=message.created_at,
+            )
+    
+    @classmethod
+    def refresh_last_message(cls, conversation_ids):
+        """recomputes the last message columns from the messages table in a single UPDATE,
+        used by the backfill command and when the last message is deleted"""
+        latest = Message.objects.filter(conversation_id=models.OuterRef('pk')).order_by('-created_at', '-id')
+        cls.objects.filter(id__in=conversation_ids).update(
+            last_message_id=models.Subquery(latest.values('id')[:1]),
+            last_message_preview=Coalesce(Substr(models.Subquery(latest.values('content')[:1]), 1, cls.PREVIEW_LENGTH), models.Value('')),
+            last_message_at=Coalesce(models.Subquery(latest.values('created_at')[:1]), F('created_at')),
+        )
+    
+    @classmethod
+    def refresh_participant_counts(cls, conversation_ids):
+        """recounts participant_count for the given conversations in a single UPDATE"""
+        counts = cls.participants.through.objects.filter(
+            conversation_id=models.OuterRef('pk')
+        ).order_by().values('conversation_id').annotate(total=models.Count('id')).values('total')
+        cls.objects.filter(id__in=conversation_ids).update(
+            participant_count=Coalesce(models.Subquery(counts), 0)
+        )
 
 
 #message model associated with the user
@@ -108,7 +164,7 @@ class Message(models.Model):
     content = models.TextField()
     time_stamp = models.DateTimeField(auto_now_add=True)
     message_types = models.CharField(max_length=255, choices=MESSAGE_TYPES, default='text')
-    file_attachement = models.FileField(upload_to='message_files/', blank=True, null=True)
+    file_attachement = models.FileField(upload_to='message_files/', storage=get_attachment_storage, blank=True, null=True) #users_app.attachments names the files
     
     #message status
     is_delivered = models.BooleanField(default=False)
@@ -119,7 +175,26 @@ class Message(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     created_at = models.DateTimeField(auto_now_add=True)
     
+    #tsvector of the content for full-text search, maintained by users_app.message_search (postgres only)
+    search_vector = SearchVectorField(null=True, editable=False)
+    
     #giving the model an additional information
     class Meta:
         db_table = 'messages'
-        ordering = ['-created_at']
\ No newline at end of file
+        ordering = ['-created_at']
+        indexes = [
+            #backs the keyset pagination in MessageCursorPagination, (created_at, id) is the cursor
+            models.Index(fields=['conversation', '-created_at', '-id'], name='messages_conv_created_id_idx'),
+        ]
+    
+    def delete(self, *args, **kwargs):
+        """deleting the last message of a conversation falls back to the one before it. this is not a
+        post_delete receiver, which would make every cascade (a deleted conversation or user) load and signal
+        its messages one by one. queryset deletes call Conversation.refresh_last_message themselves"""
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            #on_delete=SET_NULL has already cleared last_message when it pointed at this message
+            Conversation.refresh_last_message(
+                Conversation.objects.filter(id=self.conversation_id, last_message__isnull=True).values('id')
+            )
+        return result
\ No newline at end of file
@@ -0,0 +1,209 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class PageSizePagination(PageNumberPagination):
+    """the default page number pagination, clients can ask for up to max_page_size rows with page_size"""
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class SearchPagination(BasePagination):
+    """page number pagination for search results without the COUNT(*) over every match.
+    page_size + 1 rows are fetched to know if there is a next page, and pages past max_pages are refused,
+    nobody reads page 40 of a fuzzy search"""
+    page_size = 20
+    max_page_size = 50
+    max_pages = 10
+    page_query_param = 'page'
+    page_size_query_param = 'page_size'
+
+    def get_page_size(self, request):
+        """reads page_size from the request, bounded by max_page_size"""
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+            if size > 0:
+                return min(size, self.max_page_size)
+        except (KeyError, ValueError):
+            pass
+        return self.page_size
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        size = self.get_page_size(request)
+        try:
+            self.page_number = int(request.query_params.get(self.page_query_param, 1))
+        except ValueError:
+            raise NotFound('Invalid page')
+        if not 1 <= self.page_number <= self.max_pages:
+            raise NotFound('Invalid page')
+        start = (self.page_number - 1) * size
+        rows = list(queryset[start:start + size + 1])
+        self.has_next = len(rows) > size and self.page_number < self.max_pages
+        return rows[:size]
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.page_query_param, self.page_number + 1)
+
+    def get_previous_link(self):
+        if self.page_number == 1:
+            return None
+        url = self.request.build_absolute_uri()
+        if self.page_number == 2:
+            return remove_query_param(url, self.page_query_param)
+        return replace_query_param(url, self.page_query_param, self.page_number - 1)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+
+class MessageCursorPagination(BasePagination):
+    """keyset pagination for message history, keyed on (created_at, id)
+    instead of OFFSET, so every page costs the same no matter how deep it is.
+    query params:
+    - before=<cursor>: older messages than the cursor
+    - after=<cursor>: newer messages than the cursor
+    - around=<message_id>: jump to a message, the page starts at that message and goes older
+    results are always returned newest first, and there is no COUNT(*)"""
+    page_size = 20
+    max_page_size = 100
+    page_size_query_param = 'page_size'
+    before_query_param = 'before'
+    after_query_param = 'after'
+    around_query_param = 'around'
+    cursor_query_params = (before_query_param, after_query_param, around_query_param)
+
+    #CURSOR ENCODING, a cursor is just the (created_at, id) of the edge message
+    def encode_cursor(self, message):
+        """turns a message into an opaque cursor string"""
+        raw = f"{message.created_at.isoformat()}|{message.pk}"
+        return urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        """turns a cursor string back into (created_at, id)"""
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            created_at, pk = urlsafe_b64decode(padded.encode()).decode().split('|')
+            created_at = parse_datetime(created_at)
+            if created_at is None:
+                raise ValueError
+            return created_at, int(pk)
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise NotFound('Invalid cursor')
+
+    def decode_around(self, around):
+        """the message id of an around param"""
+        try:
+            return int(around)
+        except ValueError:
+            raise NotFound('Invalid cursor')
+
+    def get_page_size(self, request):
+        """reads page_size from the request, bounded by max_page_size"""
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+            if size > 0:
+                return min(size, self.max_page_size)
+        except (KeyError, ValueError):
+            pass
+        return self.page_size
+
+    def paginate_queryset(self, queryset, request, view=None):
+        """filters the queryset by the requested keyset and fetches page_size + 1 rows
+        so we know if there is another page without counting"""
+        self.request = request
+        size = self.get_page_size(request)
+        before = request.query_params.get(self.before_query_param)
+        after = request.query_params.get(self.after_query_param)
+        around = request.query_params.get(self.around_query_param)
+
+        #newest first is the natural direction, "after" walks the other way and is reversed at the end
+        self.direction = 'after' if after and not before else 'before'
+        if around:
+            anchor = queryset.filter(pk=self.decode_around(around)).values('created_at', 'id').first()
+            if anchor is None:
+                raise NotFound('Message not found in this conversation')
+            queryset = self.older_than(queryset, anchor['created_at'], anchor['id'], inclusive=True)
+        elif self.direction == 'before' and before:
+            queryset = self.older_than(queryset, *self.decode_cursor(before))
+        elif self.direction == 'after':
+            queryset = self.newer_than(queryset, *self.decode_cursor(after))
+
+        if self.direction == 'after':
+            queryset = queryset.order_by('created_at', 'id')
+        else:
+            queryset = queryset.order_by('-created_at', '-id')
+
+        rows = list(queryset[:size + 1])
+        self.has_more = len(rows) > size
+        rows = rows[:size]
+        if self.direction == 'after':
+            rows.reverse()
+
+        #an "after" page always has older messages behind it, and a "before"/"around" page has newer ones
+        #unless it is the very first page
+        self.has_older = self.has_more if self.direction == 'before' else bool(rows)
+        self.has_newer = self.has_more if self.direction == 'after' else bool(rows) and bool(before or around)
+        self.page = rows
+        return rows
+
+    #the extra created_at__lte / created_at__gte bound is redundant logically, but it gives the
+    #database a plain range on the (conversation, -created_at, -id) index instead of an OR
+    def older_than(self, queryset, created_at, pk, inclusive=False):
+        id_lookup = 'id__lte' if inclusive else 'id__lt'
+        return queryset.filter(
+            Q(created_at__lte=created_at),
+            Q(created_at__lt=created_at) | Q(**{id_lookup: pk}),
+        )
+
+    def newer_than(self, queryset, created_at, pk):
+        return queryset.filter(
+            Q(created_at__gte=created_at),
+            Q(created_at__gt=created_at) | Q(id__gt=pk),
+        )
+
+    def get_next_link(self):
+        """link to older messages"""
+        if not self.has_older or not self.page:
+            return None
+        return self._build_link(self.before_query_param, self.page[-1])
+
+    def get_previous_link(self):
+        """link to newer messages"""
+        if not self.has_newer or not self.page:
+            return None
+        return self._build_link(self.after_query_param, self.page[0])
+
+    def _build_link(self, param, message):
+        url = self.request.build_absolute_uri()
+        for name in self.cursor_query_params:
+            url = remove_query_param(url, name)
+        return replace_query_param(url, param, self.encode_cursor(message))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
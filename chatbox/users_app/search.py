@@ -0,0 +1,82 @@
+from django.conf import settings
+from django.db import connection
+from django.db.models import Case, FloatField, Q, Value, When
+from django.db.models.functions import Greatest
+from .models import User
+
+#USER SEARCH
+#on postgres every search field has a GIN trigram index (users_app migration 0004), the filter only uses
+#the trigram operators those indexes serve: word similarity (<%) for prefixes and partial words, similarity
+#(%) for typos. results are ranked by exact/prefix match first and trigram similarity second.
+#other databases (sqlite in tests) get the 'basic' mode, icontains on the same fields with the same
+#prefix ranking, which is a table scan and only meant for small tables.
+
+DEFAULTS = {
+    'MODE': 'auto', #'trigram', 'basic', or 'auto' to pick trigram on postgres
+    'MIN_LENGTH': 2,
+    'MAX_LENGTH': 64,
+    'EXCLUDE_BLOCKED': True,
+}
+
+SEARCH_FIELDS = ('username', 'first_name', 'last_name')
+
+
+def user_search_setting(name):
+    """reads a key from settings.USER_SEARCH, falling back to the defaults above"""
+    return getattr(settings, 'USER_SEARCH', {}).get(name, DEFAULTS[name])
+
+
+def search_mode():
+    mode = user_search_setting('MODE')
+    if mode == 'auto':
+        return 'trigram' if connection.vendor == 'postgresql' else 'basic'
+    return mode
+
+
+def prefix_rank(query):
+    """3 for the exact username, 2 for a username prefix, 1 for a first/last name prefix"""
+    return Case(
+        When(username__iexact=query, then=Value(3.0)),
+        When(username__istartswith=query, then=Value(2.0)),
+        When(Q(first_name__istartswith=query) | Q(last_name__istartswith=query), then=Value(1.0)),
+        default=Value(0.0),
+        output_field=FloatField(),
+    )
+
+
+def blocked_user_ids(user):
+    """subqueries of the users the user blocked and of the users who blocked them"""
+    Block = User.blocker_users.through
+    return (
+        Block.objects.filter(from_user_id=user.id).values('to_user_id'),
+        Block.objects.filter(to_user_id=user.id).values('from_user_id'),
+    )
+
+
+def find_users(query, user=None, exclude_blocked=None):
+    """active users matching the query, best match first. the searching user is left out, and so are
+    the users on either side of a block with them when exclude_blocked is on"""
+    query = query.strip()[:user_search_setting('MAX_LENGTH')]
+    if search_mode() == 'trigram':
+        from django.contrib.postgres.search import TrigramSimilarity, TrigramWordSimilarity
+        matches = Q()
+        for field in SEARCH_FIELDS:
+            matches |= Q(**{f'{field}__trigram_word_similar': query}) | Q(**{f'{field}__trigram_similar': query})
+        similarity = Greatest(
+            *[TrigramWordSimilarity(query, field) for field in SEARCH_FIELDS],
+            *[TrigramSimilarity(field, query) for field in SEARCH_FIELDS],
+        )
+        users = User.objects.filter(matches).annotate(search_rank=prefix_rank(query) + similarity)
+    else:
+        matches = Q()
+        for field in SEARCH_FIELDS:
+            matches |= Q(**{f'{field}__icontains': query})
+        users = User.objects.filter(matches).annotate(search_rank=prefix_rank(query))
+
+    users = users.filter(is_active=True)
+    if user is not None:
+        users = users.exclude(id=user.id)
+        if user_search_setting('EXCLUDE_BLOCKED') if exclude_blocked is None else exclude_blocked:
+            blocked, blocked_by = blocked_user_ids(user)
+            users = users.exclude(id__in=blocked).exclude(id__in=blocked_by)
+    return users.order_by('-search_rank', 'username', 'id')
@@ -1,7 +1,31 @@
+import posixpath
+from django.urls import reverse
 from rest_framework import serializers
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from chatbox_project.instrumentation import InstrumentedSerializerMixin
+from .blacklist import ChatboxRefreshToken
+from .login import hash_password
+from .attachments import HASHED_NAME
 from .models import User, Conversation, Message
+from .message_search import highlight, render_snippet
+from .utils import can_users_communicate
 
-class UserSerializer(serializers.ModelSerializer):
+class ChatboxTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """login tokens carry the username, so token authenticated websockets (chat_app.jwt_auth) run no query.
+    refreshed access tokens copy it from the refresh token, a rename shows up at the next login"""
+    token_class = ChatboxRefreshToken
+    
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        token['username'] = user.username
+        return token
+    
+class ChatboxTokenRefreshSerializer(TokenRefreshSerializer):
+    """refresh with rotation, the blacklist is checked and written through users_app.blacklist"""
+    token_class = ChatboxRefreshToken
+    
+class UserSerializer(InstrumentedSerializerMixin, serializers.ModelSerializer):
     """convert the user infor into json format to make it readable"""
     class Meta:
         model = User
@@ -9,36 +33,53 @@ class UserSerializer(serializers.ModelSerializer):
         read_only_fields = ['created_at', 'id', 'last_seen']
         extra_kwargs = {'password': {'write_only': True}} #it makes the password field only visible when you are registering or trying to update and not for GET operation
         
-class UserProfileSerializer(serializers.ModelSerializer):
+    def create(self, validated_data):
+        #hashed before the insert (in the login pool), so a registration is one INSERT and the raw password never reaches the table
+        if 'password' in validated_data:
+            validated_data['password'] = hash_password(validated_data['password'])
+        return super().create(validated_data)
+    
+    def update(self, instance, validated_data):
+        if 'password' in validated_data:
+            validated_data['password'] = hash_password(validated_data['password'])
+        return super().update(instance, validated_data)
+        
+class UserProfileSerializer(InstrumentedSerializerMixin, serializers.ModelSerializer):
     """convers the user profile information to a json format"""
     class Meta:
         model = User
         fields = ['username', 'id', 'avatar', 'bio', 'is_online', 'last_seen', 'created_at', 'status_message']
         read_only_fields = ['created_at', 'id', 'last_seen' ]
         
+class UserSearchSerializer(InstrumentedSerializerMixin, serializers.ModelSerializer):
+    """the public fields of a search result, no email or presence"""
+    class Meta:
+        model = User
+        fields = ['id', 'username', 'first_name', 'last_name', 'avatar', 'status_message']
+        read_only_fields = fields
+        
 #serializer for message
-class MessageSerializer(serializers.ModelSerializer):
+class MessageSerializer(InstrumentedSerializerMixin, serializers.ModelSerializer):
     """convert the message response into json response"""
     #this maps receiver to the receipient key that connected sender and user
-    receiver = serializers.PrimaryKeyRelatedField(source='receipient', queryset=User.objects.all())
+    receiver = serializers.PrimaryKeyRelatedField(source='receipient', queryset=User.objects.all(), write_only=True)
+    attachment = serializers.SerializerMethodField()
     
     class Meta:
         model = Message
-        fields = ['id', 'sender', 'receiver', 'content', 'time_stamp', 'message_types', 'created_at', 'is_read'] #adds receiver even though it wasn't stated in the message model
+        fields = ['id', 'sender', 'receiver', 'content', 'time_stamp', 'message_types', 'created_at', 'is_read', 'attachment'] #adds receiver even though it wasn't stated in the message model
         read_only_fields = ['id', 'created_at']
         
     def validate(self, attr): #attr represent a dictionary that consist of validated, serialized and deserialized input.
         """This is called immediately is_valid is called for your serializer"""
         sender = self.context['request'].user #provides the authenticated user who is the sender
-        receiver = attr['receiver']
-        
-        #checks if the sender has been blocked by the receiver
-        if sender in receiver.blocker_users.all():
-            raise serializers.ValidationError("You have been blocked by this User")
+        receiver = attr['receipient'] #validated data is keyed by the field's source
         
-        #checks if the receiver has been blocked by the sender
-        if receiver in sender.blocker_users.all():
-            raise serializers.ValidationError("You have blocked this user")
+        #checks if the sender has been blocked by the receiver, or the receiver by the sender
+        #one cached entry of the sender answers both (users_app.blocking), nothing is loaded into memory
+        allowed, reason = can_users_communicate(sender, receiver)
+        if not allowed:
+            raise serializers.ValidationError(reason)
         return attr
     #to create and save the instance of the authenticated user who is the sender
     def create(self, valildated_data):
@@ -46,27 +87,53 @@ class MessageSerializer(serializers.ModelSerializer):
         but create helps to save it"""
         valildated_data['sender'] = self.context['request'].user
         return super().create(valildated_data)
+    
+    def get_attachment(self, obj):
+        """the download of the message's file (users_app.attachments), read from the file name without touching the storage"""
+        if not obj.file_attachement:
+            return None
+        name = obj.file_attachement.name
+        match = HASHED_NAME.match(name)
+        return {
+            'url': reverse('message-attachment', kwargs={'pk': obj.pk}),
+            'name': posixpath.basename(name),
+            'sha256': match['sha256'] if match is not None else None,
+        }
+                  
+class MessageSearchSerializer(InstrumentedSerializerMixin, serializers.ModelSerializer):
+    """a message search hit, snippet is the matching part of the content with the match highlighted"""
+    sender_username = serializers.CharField(source='sender.username', read_only=True)
+    snippet = serializers.SerializerMethodField()
+    
+    class Meta:
+        model = Message
+        fields = ['id', 'conversation', 'sender', 'sender_username', 'content', 'snippet', 'message_types', 'created_at']
+        read_only_fields = fields
+    
+    def get_snippet(self, obj):
+        """ts_headline on postgres, cut out in python in basic mode, html escaped either way"""
+        snippet = getattr(obj, 'snippet', None)
+        if snippet is None:
+            return highlight(obj.content, self.context.get('query', ''))
+        return render_snippet(snippet)
                   
 #serializer for conversation
-class ConversationSerializer(serializers.ModelSerializer):
+class ConversationSerializer(InstrumentedSerializerMixin, serializers.ModelSerializer):
     """a serializer to handle the model conversation"""
-    participant_count = serializers.SerializerMethodField()
+    #participant_count and the last message are denormalized columns on Conversation, so serializing a
+    #conversation doesn't run any query as long as the queryset has select_related('last_message__sender')
     last_message = serializers.SerializerMethodField()
     
     class Meta:
         model = Conversation
-        fields = ['id', 'paritcipant_count', 'title', 'is_group', 'updated_at', 'last_message', 'update_at']
-        
-    def get_participant_count(self, obj):
-        """this is the field or function that participant_count point to, django will get the value of participant count from here,
-        which is why we use SerializerMethodField"""
-        return obj.participants.count()
+        fields = ['id', 'participant_count', 'title', 'is_group', 'updated_at', 'last_message', 'last_message_at']
+        read_only_fields = ['participant_count', 'last_message_at']
     
     def get_last_message(self, obj):
         """This is a methofield serializer to get the last message which we would access through content """
-        last_message = obj.messages.first()
+        last_message = obj.last_message
         return {
-            "content"  : last_message.content[:50] + ".......",
+            "content"  : obj.last_message_preview + ".......",
             "sender" : last_message.sender.username, 
-            "created_at" : last_message.created_at
-        } if last_message else None
\ No newline at end of file
+            "created_at" : obj.last_message_at
+        } if last_message else None
@@ -0,0 +1,87 @@
+from django.db.models.signals import m2m_changed, post_save, pre_delete
+from django.db import transaction
+from django.dispatch import Signal, receiver
+from .models import Conversation, Message, User
+from . import blocking, membership
+from .message_search import index_messages
+
+#sent with messages=[...] after new messages are in the database, for single saves and for bulk_create
+#(which sends no post_save), so everything derived from new messages hangs off one place
+messages_created = Signal()
+
+
+def invalidate_on_commit(invalidate, *args, **kwargs):
+    """drops cache entries now, so the rest of the transaction reads its own change, and again once it
+    commits: a reader that cached the old rows in between would otherwise keep them for the whole TIMEOUT"""
+    invalidate(*args, **kwargs)
+    transaction.on_commit(lambda: invalidate(*args, **kwargs))
+
+
+@receiver(m2m_changed, sender=Conversation.participants.through)
+def participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """keeps the membership cache in line with Conversation.participants"""
+    #on clear pk_set is None, so the affected ids have to be read before the rows are gone
+    if action == 'pre_clear':
+        if reverse:
+            instance._cleared_membership_ids = list(instance.conversations.values_list('id', flat=True))
+        else:
+            instance._cleared_membership_ids = list(instance.participants.values_list('id', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    related_ids = pk_set if action != 'post_clear' else getattr(instance, '_cleared_membership_ids', [])
+    if reverse:
+        #user.conversations.add(...), instance is the user and the ids are conversations
+        conversation_ids, user_ids = related_ids, [instance.pk]
+    else:
+        conversation_ids, user_ids = [instance.pk], related_ids
+    invalidate_on_commit(membership.invalidate, conversation_ids=conversation_ids, user_ids=user_ids)
+    #m2m changes already run inside a transaction, so the count moves together with the rows
+    Conversation.refresh_participant_counts(conversation_ids)
+
+
+@receiver(m2m_changed, sender=User.blocker_users.through)
+def blocks_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """drops the block cache entries of both sides of every changed block"""
+    if action == 'pre_clear':
+        related = instance.blocked_by if reverse else instance.blocker_users
+        instance._cleared_block_ids = list(related.values_list('id', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    related_ids = pk_set if action != 'post_clear' else getattr(instance, '_cleared_block_ids', [])
+    invalidate_on_commit(blocking.invalidate, [instance.pk, *related_ids])
+
+
+@receiver(pre_delete, sender=Conversation)
+def conversation_deleted(sender, instance, **kwargs):
+    """a deleted conversation takes its participant rows with it without an m2m_changed signal"""
+    invalidate_on_commit(
+        membership.invalidate,
+        conversation_ids=[instance.pk],
+        user_ids=list(instance.participants.values_list('id', flat=True)),
+    )
+
+
+@receiver(post_save, sender=Message)
+def message_saved(sender, instance, created, **kwargs):
+    """single inserts (REST, fallback writes) announce themselves as messages_created,
+    bulk inserts send messages_created themselves"""
+    if created:
+        messages_created.send(sender=Message, messages=[instance])
+    elif kwargs.get('update_fields') is None or 'content' in kwargs['update_fields']:
+        #an edit, the search vector follows the new content
+        index_messages([instance.pk])
+
+
+@receiver(messages_created)
+def update_conversation_summary(sender, messages, **kwargs):
+    """moves the conversation's last message forward"""
+    Conversation.record_last_messages(messages)
+
+
+@receiver(messages_created)
+def index_new_messages(sender, messages, **kwargs):
+    """adds new messages to the full-text index, one UPDATE for the whole batch"""
+    index_messages([message.pk for message in messages])
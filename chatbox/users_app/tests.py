@@ -1,3 +1,684 @@
-from django.test import TestCase
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.core.handlers.asgi import ASGIHandler
+from django.core.signals import request_finished, request_started
+from django.db import close_old_connections
+from django.db.models.signals import post_delete, pre_delete
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, authenticate, get_user
+from django.contrib.auth.hashers import get_hasher, make_password
+from django.contrib.sessions.backends.db import SessionStore
+from django.test import RequestFactory, TestCase, override_settings
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.tokens import AccessToken
+from chat_app.presence import get_presence, reset_presence
+from chatbox_project.instrumentation import assert_query_budget
+from chatbox_project.testing import ENFORCED_BUDGETS, LOCMEM_CACHES, QueryCountTestMixin
+from .blacklist import BloomFilter, ChatboxRefreshToken, TokenBlacklist, flush_expired_tokens, get_blacklist, reset_blacklist
+from . import blocking, membership
+from .membership import is_participant
+from .models import User, Conversation, Message
+from .message_search import START_SENTINEL, STOP_SENTINEL, highlight
+from .search import find_users
+from .serializers import MessageSearchSerializer
+from .utils import can_users_communicate
+from .views import ConversationViewSet, MessageViewSet, UserViewSet
 
 # Create your tests here.
+
+
+@override_settings(CACHES=LOCMEM_CACHES, INSTRUMENTATION=ENFORCED_BUDGETS)
+class ListQueryCountTests(QueryCountTestMixin, TestCase):
+    """the user, conversation and message lists, with ROWS conversations and messages"""
+    ROWS = 101
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='owner', email='owner@example.com')
+        contacts = User.objects.bulk_create([
+            User(username=f'contact_{n}', email=f'contact_{n}@example.com') for n in range(cls.ROWS)
+        ])
+        conversations = Conversation.objects.bulk_create([Conversation(title=f'chat {n}') for n in range(cls.ROWS)])
+        Conversation.participants.through.objects.bulk_create(
+            [Conversation.participants.through(conversation=conversation, user=cls.user) for conversation in conversations]
+            + [Conversation.participants.through(conversation=conversation, user=contact) for conversation, contact in zip(conversations, contacts)]
+        )
+        messages = Message.objects.bulk_create([
+            Message(conversation=conversation, sender=contact, content=f'hello {n}')
+            for n, (conversation, contact) in enumerate(zip(conversations, contacts))
+        ])
+        Conversation.record_last_messages(messages)
+        cls.conversation = conversations[0]
+        Message.objects.bulk_create([
+            Message(conversation=cls.conversation, sender=cls.user, content=f'reply {n}') for n in range(cls.ROWS)
+        ])
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_conversation_list(self):
+        self.assert_constant_queries(ConversationViewSet, '/api/usersconversations/')
+
+    def test_message_list(self):
+        self.assert_constant_queries(MessageViewSet, '/api/usersmessages/', {'conversation_id': self.conversation.id})
+
+    def test_user_list(self):
+        self.assert_constant_queries(UserViewSet, '/api/usersusers/')
+
+    def test_invalid_message_cursors(self):
+        for params in ({'around': 'abc'}, {'around': '1.5'}, {'before': 'abc'}, {'after': '!'}):
+            with self.subTest(params=params):
+                response = self.client.get('/api/usersmessages/', {'conversation_id': self.conversation.id, **params})
+                self.assertEqual(response.status_code, 404)
+                self.assertEqual(response.data['detail'], 'Invalid cursor')
+
+
+@override_settings(CACHES=LOCMEM_CACHES, INSTRUMENTATION=ENFORCED_BUDGETS)
+class UserSearchTests(TestCase):
+    """search_users ranks, paginates and filters through users_app.search"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='searcher', email='searcher@example.com')
+        names = ['ada', 'adaeze', 'adamu', 'kada', 'tunde']
+        cls.found = {name: User.objects.create(username=name, email=f'{name}@example.com') for name in names}
+        User.objects.create(username='obi', email='obi@example.com', first_name='Adanna')
+        User.objects.create(username='ada_gone', email='ada_gone@example.com', is_active=False)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def search(self, **params):
+        with assert_query_budget(UserViewSet.query_budget['search_users']):
+            return self.client.get('/api/usersusers/search/', params)
+
+    def test_ranking(self):
+        response = self.search(query='ada')
+        usernames = [user['username'] for user in response.data['results']]
+        #exact username, then username prefixes, then first name prefixes, then other matches
+        self.assertEqual(usernames[0], 'ada')
+        self.assertEqual(set(usernames[1:3]), {'adaeze', 'adamu'})
+        self.assertEqual(usernames[3], 'obi')
+        self.assertTrue(set(usernames).isdisjoint({'tunde', 'ada_gone', 'searcher'}))
+        self.assertNotIn('email', response.data['results'][0])
+
+    def test_minimum_length(self):
+        self.assertEqual(self.client.get('/api/usersusers/search/', {'query': 'a'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/usersusers/search/', {'query': '  '}).status_code, 400)
+
+    def test_pagination(self):
+        everyone = [user['id'] for user in self.search(query='ada', page_size=50).data['results']]
+        response = self.search(query='ada', page_size=2)
+        self.assertIsNone(response.data['previous'])
+        paged = [user['id'] for user in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            self.assertIsNotNone(response.data['previous'])
+            paged += [user['id'] for user in response.data['results']]
+        self.assertEqual(paged, everyone)
+        self.assertEqual(self.client.get('/api/usersusers/search/', {'query': 'ada', 'page': 11}).status_code, 404)
+
+    def test_blocked_users(self):
+        self.user.blocker_users.add(self.found['adaeze'])
+        self.found['adamu'].blocker_users.add(self.user)
+        usernames = {user['username'] for user in self.search(query='ada').data['results']}
+        self.assertTrue(usernames.isdisjoint({'adaeze', 'adamu', 'searcher'}))
+        usernames = {user['username'] for user in self.search(query='ada', exclude_blocked='false').data['results']}
+        self.assertTrue({'adaeze', 'adamu'} <= usernames)
+
+    def test_basic_mode_matches_display_names(self):
+        with self.settings(USER_SEARCH={'MODE': 'basic'}):
+            self.assertEqual(list(find_users('adan').values_list('username', flat=True)), ['obi'])
+
+
+@override_settings(CACHES=LOCMEM_CACHES, INSTRUMENTATION=ENFORCED_BUDGETS)
+class MessageSearchTests(TestCase):
+    """messages search is scoped to the user's conversations, highlights the match and pages with cursors"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='reader', email='reader@example.com')
+        cls.friend = User.objects.create(username='friend', email='friend@example.com')
+        cls.stranger = User.objects.create(username='stranger', email='stranger@example.com')
+        cls.ours, cls.group = Conversation.objects.bulk_create([Conversation(title='ours'), Conversation(title='group', is_group=True)])
+        cls.theirs = Conversation.objects.create(title='theirs')
+        cls.ours.participants.add(cls.user, cls.friend)
+        cls.group.participants.add(cls.user, cls.friend)
+        cls.theirs.participants.add(cls.friend, cls.stranger)
+        Message.objects.bulk_create(
+            [Message(conversation=cls.ours, sender=cls.friend, content=f'the invoice number {n} is attached') for n in range(5)]
+            + [Message(conversation=cls.group, sender=cls.user, content='where is the invoice?'),
+               Message(conversation=cls.theirs, sender=cls.stranger, content='secret invoice'),
+               Message(conversation=cls.ours, sender=cls.user, content='lunch tomorrow?')]
+        )
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def search(self, **params):
+        with assert_query_budget(MessageViewSet.query_budget['search']):
+            return self.client.get('/api/usersmessages/search/', params)
+
+    def test_scoped_to_participants(self):
+        results = self.search(query='invoice', page_size=50).data['results']
+        self.assertEqual(len(results), 6)
+        self.assertNotIn(self.theirs.id, {result['conversation'] for result in results})
+        results = self.search(query='invoice', conversation_id=self.group.id).data['results']
+        self.assertEqual([result['content'] for result in results], ['where is the invoice?'])
+        self.assertEqual(self.search(query='invoice', conversation_id=self.theirs.id).data['results'], [])
+
+    def test_snippets(self):
+        result = self.search(query='lunch').data['results'][0]
+        self.assertIn('<mark>lunch</mark>', result['snippet'].lower())
+        self.assertEqual(result['sender_username'], 'reader')
+
+    def test_snippets_are_escaped(self):
+        snippet = highlight('<img src=x onerror=alert(1)> hello', 'hello')
+        self.assertEqual(snippet, '&lt;img src=x onerror=alert(1)&gt; <mark>hello</mark>')
+        #what ts_headline returns on postgres
+        message = Message(content='', sender=self.user)
+        message.snippet = f'<script>x</script> {START_SENTINEL}hello{STOP_SENTINEL}'
+        snippet = MessageSearchSerializer(message).data['snippet']
+        self.assertEqual(snippet, '&lt;script&gt;x&lt;/script&gt; <mark>hello</mark>')
+
+    def test_cursor_pagination(self):
+        everyone = [result['id'] for result in self.search(query='invoice', page_size=50).data['results']]
+        response = self.search(query='invoice', page_size=4)
+        paged = [result['id'] for result in response.data['results']]
+        self.assertIsNotNone(response.data['next'])
+        response = self.client.get(response.data['next'])
+        paged += [result['id'] for result in response.data['results']]
+        self.assertIsNone(response.data['next'])
+        self.assertEqual(paged, everyone)
+
+    def test_minimum_length(self):
+        self.assertEqual(self.client.get('/api/usersmessages/search/', {'query': 'a'}).status_code, 400)
+
+    def test_history_is_scoped_to_participants(self):
+        self.assertEqual(self.client.get('/api/usersmessages/', {'conversation_id': self.ours.id}).status_code, 200)
+        self.assertEqual(self.client.get('/api/usersmessages/', {'conversation_id': self.theirs.id}).status_code, 404)
+        self.assertEqual(self.client.get('/api/usersmessages/').status_code, 404)
+        theirs = Message.objects.get(conversation=self.theirs)
+        self.assertEqual(self.client.get(f'/api/usersmessages/{theirs.id}/').status_code, 404)
+        ours = Message.objects.filter(conversation=self.ours).first()
+        self.assertEqual(self.client.get(f'/api/usersmessages/{ours.id}/').status_code, 200)
+        self.assertEqual(self.client.delete(f'/api/usersmessages/{ours.id}/').status_code, 405)
+        self.assertEqual(self.client.patch(f'/api/usersmessages/{ours.id}/', {'content': 'edited'}).status_code, 405)
+
+
+class LastMessageTests(TestCase):
+    """the conversation summary falls back when its last message is deleted, without a Message signal"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='lm_user', email='lm_user@example.com')
+        cls.conversation = Conversation.objects.create()
+        cls.first = Message.objects.create(conversation=cls.conversation, sender=cls.user, content='first')
+        cls.second = Message.objects.create(conversation=cls.conversation, sender=cls.user, content='second')
+
+    def test_deleting_the_last_message_falls_back(self):
+        self.second.delete()
+        self.conversation.refresh_from_db()
+        self.assertEqual((self.conversation.last_message_id, self.conversation.last_message_preview), (self.first.id, 'first'))
+        self.first.delete()
+        self.conversation.refresh_from_db()
+        self.assertEqual((self.conversation.last_message_id, self.conversation.last_message_preview), (None, ''))
+
+    def test_deleting_an_older_message_keeps_the_last(self):
+        self.first.delete()
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.last_message_id, self.second.id)
+
+    def test_messages_have_no_delete_receivers(self):
+        #a receiver would make every cascade load and signal the messages one by one
+        self.assertFalse(post_delete.has_listeners(Message))
+        self.assertFalse(pre_delete.has_listeners(Message))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class MembershipCacheTests(TestCase):
+    """the membership cache follows Conversation.participants, also after a reader cached the old rows"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob = User.objects.bulk_create([User(username=name, email=f'{name}@example.com') for name in ('m_alice', 'm_bob')])
+        cls.conversation = Conversation.objects.create()
+        cls.conversation.participants.add(cls.alice, cls.bob)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_invalidated_again_after_commit(self):
+        self.assertTrue(is_participant(self.conversation.id, self.bob.id))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.conversation.participants.remove(self.bob)
+            #a concurrent request still seeing the committed rows caches them before this commit
+            cache.set(membership.conversation_key(self.conversation.id), frozenset({self.alice.id, self.bob.id}))
+            cache.set(membership.user_key(self.bob.id), frozenset({self.conversation.id}))
+        self.assertFalse(is_participant(self.conversation.id, self.bob.id))
+        self.assertEqual(membership.user_conversation_ids(self.bob.id), frozenset())
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BlockCacheTests(TestCase):
+    """can_users_communicate answers from the block graph cache, which follows User.blocker_users"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob, cls.carol = User.objects.bulk_create([
+            User(username=name, email=f'{name}@example.com') for name in ('alice', 'bob', 'carol')
+        ])
+
+    def setUp(self):
+        cache.clear()
+
+    def test_cached_answers(self):
+        self.assertEqual(can_users_communicate(self.alice, self.bob), (True, 'Communication Allowed'))
+        with assert_query_budget(0):
+            self.assertTrue(can_users_communicate(self.alice, self.bob)[0])
+            self.assertTrue(can_users_communicate(self.alice, self.carol)[0])
+
+    def test_block_and_unblock(self):
+        can_users_communicate(self.alice, self.bob)
+        can_users_communicate(self.bob, self.alice)
+        self.bob.block_user(self.alice)
+        self.assertEqual(can_users_communicate(self.alice, self.bob), (False, 'You have been blocked by this user'))
+        self.assertEqual(can_users_communicate(self.bob, self.alice), (False, 'You have blocked this user'))
+        self.assertTrue(can_users_communicate(self.alice, self.carol)[0])
+        self.bob.unblock_user(self.alice)
+        self.assertTrue(can_users_communicate(self.alice, self.bob)[0])
+        self.assertTrue(can_users_communicate(self.bob, self.alice)[0])
+
+    def test_reverse_and_clear(self):
+        can_users_communicate(self.carol, self.alice)
+        self.alice.blocked_by.add(self.carol)
+        self.assertFalse(can_users_communicate(self.alice, self.carol)[0])
+        self.alice.blocked_by.clear()
+        self.assertTrue(can_users_communicate(self.carol, self.alice)[0])
+
+    def test_invalidated_again_after_commit(self):
+        can_users_communicate(self.alice, self.bob)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.bob.block_user(self.alice)
+            #a concurrent request still seeing no block caches that before this commit
+            cache.set(blocking.block_key(self.alice.id), blocking.NOT_BLOCKED)
+        self.assertEqual(can_users_communicate(self.alice, self.bob), (False, 'You have been blocked by this user'))
+
+
+@override_settings(CACHES=LOCMEM_CACHES, TOKEN_BLACKLIST={'SYNC_INTERVAL': 0})
+class TokenBlacklistTests(TestCase):
+    """rotated refresh tokens can't be reused, other processes learn about them through the log,
+    lookups survive a flushed cache, and expired rows are flushed in chunks"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='refresher', email='refresher@example.com')
+
+    def setUp(self):
+        cache.clear()
+        reset_blacklist()
+        self.client = APIClient()
+
+    def refresh(self, token):
+        return self.client.post('/api/usersauth/refresh-token/', {'refresh': token}, format='json')
+
+    def test_rotated_token_is_refused(self):
+        token = str(ChatboxRefreshToken.for_user(self.user))
+        response = self.refresh(token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.refresh(response.data['refresh']).status_code, 200)
+        self.assertEqual(self.refresh(token).status_code, 401)
+
+    def test_negative_lookups_run_no_query(self):
+        get_blacklist().sync()
+        with self.assertNumQueries(0):
+            self.assertFalse(get_blacklist().contains('never-blacklisted'))
+
+    def test_other_processes_see_the_blacklist(self):
+        other = TokenBlacklist()
+        other.sync()
+        token = ChatboxRefreshToken.for_user(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            get_blacklist().add(token)
+        self.assertTrue(other.contains(token['jti']))
+
+    def test_flushed_cache_falls_back_to_the_table(self):
+        token = ChatboxRefreshToken.for_user(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            get_blacklist().add(token)
+        cache.clear()
+        self.assertTrue(TokenBlacklist().contains(token['jti']))
+        self.assertTrue(get_blacklist().contains(token['jti']))
+
+    def test_bloom_filter_has_no_false_negatives(self):
+        bloom = BloomFilter(1000, 0.01)
+        jtis = [f'jti-{n}' for n in range(1000)]
+        for jti in jtis:
+            bloom.add(jti)
+        self.assertTrue(all(jti in bloom for jti in jtis))
+        self.assertLess(sum(f'other-{n}' in bloom for n in range(1000)), 50)
+
+    def test_flush_expired_tokens(self):
+        expired = timezone.now() - timedelta(days=1)
+        tokens = OutstandingToken.objects.bulk_create([
+            OutstandingToken(user=self.user, jti=f'expired-{n}', token='', expires_at=expired) for n in range(5)
+        ])
+        BlacklistedToken.objects.create(token=tokens[0])
+        ChatboxRefreshToken.for_user(self.user)
+        self.assertEqual(flush_expired_tokens(chunk_size=2), 5)
+        self.assertEqual(OutstandingToken.objects.count(), 1)
+        self.assertFalse(BlacklistedToken.objects.exists())
+
+
+@override_settings(CACHES=LOCMEM_CACHES, PRESENCE={'BACKEND': 'chat_app.presence.InMemoryPresenceBackend'})
+class LoginTests(TestCase):
+    """login reuses the authenticated user, writes only the refresh token (a token doesn't make the user
+    online, their sockets do) and hashes through the login pool"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='login_user', email='login_user@example.com')
+        cls.user.set_password('correct horse')
+        cls.user.save()
+
+    def setUp(self):
+        reset_presence()
+        self.client = APIClient()
+
+    def login(self, password):
+        return self.client.post('/api/usersauth/login/', {'email': 'login_user@example.com', 'password': password}, format='json')
+
+    def test_login_writes_only_the_token(self):
+        updated_at = User.objects.get(pk=self.user.pk).updated_at
+        with self.assertNumQueries(2): #the user and the outstanding refresh token
+            response = self.login('correct horse')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.data), {'refresh', 'access'})
+        self.assertFalse(get_presence().is_online(self.user.id))
+        self.assertEqual(User.objects.get(pk=self.user.pk).updated_at, updated_at)
+
+    def test_wrong_password(self):
+        self.assertEqual(self.login('wrong').status_code, 401)
+        self.assertFalse(get_presence().is_online(self.user.id))
+
+    def test_hash_runs_in_the_pool(self):
+        threads = []
+        with mock.patch('users_app.login.check_password', side_effect=lambda *args, **kwargs: threads.append(threading.current_thread().name)):
+            self.login('correct horse')
+        self.assertTrue(threads[0].startswith('password-hash'))
+
+    @override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher', 'django.contrib.auth.hashers.UnsaltedMD5PasswordHasher'])
+    def test_upgrade_hashes_in_the_pool(self):
+        User.objects.filter(pk=self.user.pk).update(password=make_password('correct horse', hasher='unsalted_md5'))
+        threads = []
+        with mock.patch('users_app.login.make_password', side_effect=lambda password: threads.append(threading.current_thread().name) or make_password(password)):
+            self.assertEqual(self.login('correct horse').status_code, 200)
+        self.assertTrue(threads[0].startswith('password-hash'))
+        self.assertTrue(User.objects.get(pk=self.user.pk).password.startswith('md5$'))
+
+    def test_failed_login_hashes_once_in_the_pool(self):
+        hasher = type(get_hasher())
+        encode = hasher.encode
+        for email, password in (('login_user@example.com', 'wrong'), ('nobody@example.com', 'correct horse')):
+            threads = []
+
+            def tracked(self, *args, **kwargs):
+                threads.append(threading.current_thread().name)
+                return encode(self, *args, **kwargs)
+            with self.subTest(email=email), mock.patch.object(hasher, 'encode', tracked):
+                self.assertIsNone(authenticate(None, email=email, password=password))
+                self.assertEqual(len(threads), 1)
+                self.assertTrue(threads[0].startswith('password-hash'))
+
+    def test_model_backend_sessions_survive(self):
+        session = SessionStore()
+        session[SESSION_KEY] = str(self.user.pk)
+        session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+        session[HASH_SESSION_KEY] = self.user.get_session_auth_hash()
+        session.save()
+        request = RequestFactory().get('/')
+        request.session = SessionStore(session.session_key)
+        self.assertEqual(get_user(request), self.user)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, PRESENCE={'BACKEND': 'chat_app.presence.InMemoryPresenceBackend'})
+class BulkImportTests(TestCase):
+    """bulk import checks uniqueness with set queries, reports failed rows without stopping the batch
+    and leaves imported hashes to be upgraded at the first login"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create(username='import_admin', email='import_admin@example.com', is_staff=True)
+        User.objects.create(username='taken', email='taken@example.com')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def rows(self):
+        return [
+            {'email': 'new1@example.com', 'username': 'new1', 'password': 'secret one'},
+            {'email': 'taken@example.com', 'username': 'new2', 'password': 'secret two'},
+            {'email': 'new3@example.com', 'username': 'taken'},
+            {'email': 'new1@example.com', 'username': 'new4'},
+            {'email': 'not an email', 'username': 'new5'},
+            {'email': 'new6@example.com', 'username': 'new6'},
+        ]
+
+    def test_failed_rows_are_reported(self):
+        response = self.client.post('/api/usersusers/bulk_import/', {'users': self.rows()}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['total'], response.data['created']), (6, 2))
+        self.assertEqual([failure['row'] for failure in response.data['failed']], [1, 2, 3, 4])
+        self.assertIn('username', response.data['failed'][1]['errors'])
+        self.assertEqual(response.data['failed'][2]['errors']['email'], 'duplicate email in the import')
+        self.assertTrue(User.objects.get(email='new1@example.com').check_password('secret one'))
+        self.assertFalse(User.objects.get(email='new6@example.com').has_usable_password())
+
+    def test_uniqueness_is_checked_per_chunk(self):
+        from .bulk_import import import_users
+        rows = [{'email': f'chunk{n}@example.com', 'username': f'chunk{n}', 'password': 'pw'} for n in range(10)]
+        #per chunk of 5: emails, usernames, and the bulk insert inside its savepoint
+        with self.assertNumQueries(10):
+            report = import_users(rows, chunk_size=5, processes=0)
+        self.assertEqual(report['created'], 10)
+
+    def test_register_inserts_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = APIClient().post('/api/usersauth/register/', {'email': 'reg@example.com', 'username': 'reg', 'password': 'secret'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(sum(query['sql'].startswith('INSERT INTO "users"') for query in queries.captured_queries), 1)
+        self.assertFalse([query for query in queries.captured_queries if query['sql'].startswith('UPDATE "users"')])
+        self.assertTrue(User.objects.get(email='reg@example.com').check_password('secret'))
+
+    def test_login_during_an_import(self):
+        from .bulk_import import hash_passwords
+        from .login import login_setting
+        user = User.objects.create(username='importing', email='importing@example.com')
+        user.set_password('secret')
+        user.save()
+        release = threading.Event()
+        slow_hash = lambda password, hasher=None: release.wait(5) and make_password(password)
+        with mock.patch('users_app.bulk_import.make_password', side_effect=slow_hash):
+            #more hashes than the login pool has threads, all of them stuck
+            importing = threading.Thread(target=hash_passwords, args=(None, ['pw'] * (login_setting('HASH_WORKERS') * 2)))
+            importing.start()
+            try:
+                started = time.monotonic()
+                response = APIClient().post('/api/usersauth/login/', {'email': 'importing@example.com', 'password': 'secret'}, format='json')
+                self.assertEqual(response.status_code, 200)
+                self.assertLess(time.monotonic() - started, 2)
+            finally:
+                release.set()
+                importing.join()
+
+    def test_staff_only(self):
+        self.client.force_authenticate(User.objects.get(username='taken'))
+        response = self.client.post('/api/usersusers/bulk_import/', {'users': self.rows()}, format='json')
+        self.assertEqual(response.status_code, 403)
+
+    @override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher', 'django.contrib.auth.hashers.UnsaltedMD5PasswordHasher'])
+    def test_cheap_hashes_are_upgraded_at_login(self):
+        from .bulk_import import import_users
+        import_users([{'email': 'cheap@example.com', 'username': 'cheap', 'password': 'secret'}], processes=0, hasher='unsalted_md5')
+        self.assertFalse(User.objects.get(email='cheap@example.com').password.startswith('md5$'))
+        response = APIClient().post('/api/usersauth/login/', {'email': 'cheap@example.com', 'password': 'secret'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(User.objects.get(email='cheap@example.com').password.startswith('md5$'))
+
+    def test_command_hashes_in_processes(self):
+        import json
+        import tempfile
+        from django.core.management import call_command
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            json.dump(self.rows(), f)
+        call_command('import_users', f.name, processes=1, stdout=open(os.devnull, 'w'))
+        self.assertTrue(User.objects.get(email='new1@example.com').check_password('secret one'))
+        self.assertEqual(User.objects.filter(email__startswith='new').count(), 2)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, ATTACHMENTS={'STORAGE': 'attachments', 'MAX_SIZE': 1000, 'CHUNK_SIZE': 7})
+class AttachmentTests(TestCase):
+    """uploads are hashed as they stream into the storage, downloads honour Range, If-Range and If-None-Match"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        location = cls.enterClassContext(tempfile.TemporaryDirectory())
+        cls.enterClassContext(override_settings(STORAGES=dict(
+            settings.STORAGES, attachments={'BACKEND': 'django.core.files.storage.FileSystemStorage', 'OPTIONS': {'location': location}},
+        )))
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sender = User.objects.create(username='attach_sender', email='attach_sender@example.com')
+        cls.peer = User.objects.create(username='attach_peer', email='attach_peer@example.com')
+        cls.outsider = User.objects.create(username='attach_outsider', email='attach_outsider@example.com')
+        cls.conversation = Conversation.objects.create()
+        cls.conversation.participants.add(cls.sender, cls.peer)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.sender)
+        self.content = bytes(range(256)) * 2
+
+    def upload(self, content=None, name='voice note.ogg'):
+        return self.client.post('/api/usersmessages/attachments/', {
+            'conversation_id': self.conversation.id, 'message_types': 'voice', 'file': SimpleUploadedFile(name, content or self.content),
+        }, format='multipart')
+
+    def download(self, user=None, **headers):
+        client = APIClient()
+        client.force_authenticate(user or self.peer)
+        response = self.upload()
+        return response, client.get(response.data['attachment']['url'], headers=headers)
+
+    def test_upload_hashes_and_deduplicates(self):
+        first, second = self.upload(), self.upload()
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(first.data['attachment']['sha256'], hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(first.data['attachment']['name'], 'voice_note.ogg')
+        names = Message.objects.filter(id__in=[first.data['message_id'], second.data['message_id']]).values_list('file_attachement', flat=True)
+        self.assertEqual(len(set(names)), 1)
+
+    def test_whole_file(self):
+        upload, response = self.download()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response.headers['ETag'], f"\"{upload.data['attachment']['sha256']}\"")
+        self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+
+    def test_range(self):
+        _, response = self.download(Range='bytes=10-29')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.headers['Content-Range'], f'bytes 10-29/{len(self.content)}')
+        self.assertEqual(b''.join(response.streaming_content), self.content[10:30])
+        _, response = self.download(Range='bytes=-16')
+        self.assertEqual(b''.join(response.streaming_content), self.content[-16:])
+        _, response = self.download(Range=f'bytes={len(self.content)}-')
+        self.assertEqual(response.status_code, 416)
+
+    def test_conditional_requests(self):
+        _, response = self.download()
+        etag = response.headers['ETag']
+        _, response = self.download(If_None_Match=etag)
+        self.assertEqual(response.status_code, 304)
+        _, response = self.download(Range='bytes=0-9', If_Range=etag)
+        self.assertEqual(response.status_code, 206)
+        _, response = self.download(Range='bytes=0-9', If_Range='"another version"')
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(ATTACHMENTS={'STORAGE': 'attachments', 'SENDFILE': 'X-Accel-Redirect'})
+    def test_sendfile(self):
+        upload, response = self.download()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['X-Accel-Redirect'].endswith(f"{upload.data['attachment']['sha256']}/voice_note.ogg"))
+        self.assertEqual(response.content, b'')
+
+    def test_too_large(self):
+        response = self.upload(content=b'x' * 1001)
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(Message.objects.filter(conversation=self.conversation).exists())
+
+    def test_outsiders_get_nothing(self):
+        _, response = self.download(user=self.outsider)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.client.get('/api/usersmessages/abc/attachment/').status_code, 404)
+        self.client.force_authenticate(self.outsider)
+        self.assertEqual(self.upload().status_code, 404)
+
+    async def test_asgi_streams_chunk_by_chunk(self):
+        """through django's ASGI handler (daphne) the first chunk goes out after one read, not after the whole file"""
+        upload = await sync_to_async(self.upload)()
+        reads, bodies = [], []
+        content = self.content
+
+        class CountingFile(io.BytesIO):
+            def read(self, size=-1):
+                chunk = super().read(size)
+                reads.append(len(chunk))
+                return chunk
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                self.assertEqual(message['status'], 200)
+            elif message.get('body'):
+                bodies.append((message['body'], sum(reads)))
+
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': upload.data['attachment']['url'], 'query_string': b'', 'server': ('testserver', 80), 'client': ('127.0.0.1', 1),
+            'headers': [(b'host', b'testserver'), (b'authorization', f'Bearer {AccessToken.for_user(self.peer)}'.encode())],
+        }
+        #like the test client, the test transaction's connection must survive the request
+        request_started.disconnect(close_old_connections)
+        request_finished.disconnect(close_old_connections)
+        try:
+            with mock.patch.object(FileSystemStorage, '_open', lambda storage, name, mode='rb': File(CountingFile(content), name)):
+                await ASGIHandler()(scope, receive, send)
+        finally:
+            request_started.connect(close_old_connections)
+            request_finished.connect(close_old_connections)
+        self.assertEqual(b''.join(body for body, _ in bodies), content)
+        self.assertEqual(bodies[0], (content[:7], 7))
@@ -1,10 +1,10 @@
 from .models import *
+from .blocking import block_reason
 
 def can_users_communicate(sender, receiver):
     """an helper function that helps us to know who can send in messages to each other"""
-    if sender.blocker_users.filter(id=receiver.id).exists():
-        return False, "You have blocked this user"
-    
-    if receiver.blocker_users.filter(id=sender.id).exists():
-        return False, "You have been blocked by this user"
-    return "Communication Allowed"
\ No newline at end of file
+    #answered from the block graph cache (users_app.blocking), no query when the sender's entry is cached
+    reason = block_reason(sender.id, receiver.id)
+    if reason is not None:
+        return False, reason
+    return True, "Communication Allowed"
\ No newline at end of file
@@ -1,12 +1,21 @@
 from django.shortcuts import render
-from rest_framework import viewsets, status, permissions
+from rest_framework import mixins, viewsets, status, permissions
 from rest_framework.decorators import action, api_view
 from django.db.models import Q 
-from .serializers import ConversationSerializer, UserSerializer
+from .serializers import ConversationSerializer, UserSerializer, MessageSerializer, UserSearchSerializer, MessageSearchSerializer
 from .models import *
+from .pagination import MessageCursorPagination, SearchPagination
+from .search import find_users, user_search_setting
+from .message_search import find_messages, message_search_setting
+from .membership import contact_ids, conversation_member_ids, is_participant, user_conversation_ids
+from .blocking import block_reason
+from chat_app.fanout import broadcast_sync
+from .attachments import HashingUploadHandler, attachment_response, attachment_storage, attachments_setting, store_attachment
+from .bulk_import import import_users, user_import_setting
 from django.contrib.auth import get_user_model
 from rest_framework.response import Response
 from rest_framework.decorators import permission_classes
+from rest_framework.exceptions import NotFound
 # Create your views here.
 
 user = get_user_model
@@ -15,11 +24,15 @@ class ConversationViewSet(viewsets.ModelViewSet):
     """using a viewset operation to build a CRUD operation for a conversation"""
     serializer_class = ConversationSerializer #tells django how to convert responses or post request to json format
     permission_classes = [permissions.IsAuthenticated] #sets permission to tell django that only logged in user can access this view function
+    query_budget = {'list': 3} #membership, count and page
     
     #get_queryset is also an inbuilt hook for drf that tends to get or retrieve
     def get_queryset(self):
-        #return conversation where user is a participant
-        return Conversation.objects.filter(participants = self.request.user) #self.request.user represent the user who made the request
+        #return conversation where user is a participant, the ids come from the membership cache
+        #newest activity first, backed by the conversation_last_msg_idx index
+        return Conversation.objects.filter(
+            id__in=user_conversation_ids(self.request.user.id) #self.request.user represent the user who made the request
+        ).select_related('last_message__sender').order_by('-last_message_at', '-id')
     
     #perform_create is a built in hook in drf that tends to post request
     def perform_create(self, serializer):
@@ -34,11 +47,34 @@ class ConversationViewSet(viewsets.ModelViewSet):
         #add validation and business logic under it
         return Response({"status" : "Participant added"})
     
-class MessageViewSet(viewsets.ModelViewSet):
-    """a view function to handle listing a message and to get a message using get_queryset"""
+class MessageViewSet(mixins.ListModelMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+    """a view function to handle listing a message and to get a message using get_queryset,
+    messages are sent over the socket or upload_attachment so there is no create, update or destroy"""
+    serializer_class = MessageSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    query_budget = {'list': 3, 'search': 2} #membership, count and page, MessageSerializer only reads the sender id. search: membership and page
+    
     def get_queryset(self):
-        conversation_id = self.request.query_params.get("conversation_id")
-        return Message.objects.filter(conversation_id=conversation_id)
+        if self.action == 'retrieve':
+            #any message of the user's conversations
+            return Message.objects.filter(conversation_id__in=user_conversation_ids(self.request.user.id))
+        #only participants can read a conversation's history, to everyone else it doesn't exist
+        conversation_id = self.request.query_params.get("conversation_id", '')
+        if not conversation_id.isdigit() or not is_participant(int(conversation_id), self.request.user.id):
+            raise NotFound('conversation not found')
+        return Message.objects.filter(conversation_id=conversation_id).order_by('-created_at', '-id')
+    
+    @property
+    def paginator(self):
+        """switches to keyset (cursor) pagination when the client sends before, after or around,
+        otherwise it keeps the default page number pagination"""
+        if not hasattr(self, '_paginator'):
+            params = self.request.query_params
+            if any(param in params for param in MessageCursorPagination.cursor_query_params):
+                self._paginator = MessageCursorPagination()
+            else:
+                self._paginator = super().paginator
+        return self._paginator
     
     def list(self, request, *args, **kwargs):
         queryset = self.get_queryset()
@@ -46,16 +82,98 @@ class MessageViewSet(viewsets.ModelViewSet):
         if page is not None:
             serializer = self.get_serializer(page, many=True)
             return self.get_paginated_response(serializer.data)
+    
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """full-text search over the messages of the user's conversations (users_app.message_search),
+        ?conversation_id= narrows it to one of them. pages newest first with before/after cursors"""
+        query = request.query_params.get('query', '').strip()
+        min_length = message_search_setting('MIN_LENGTH')
+        if len(query) < min_length:
+            return Response({'message': f'search query must be at least {min_length} characters'}, status=status.HTTP_400_BAD_REQUEST)
+        conversation_id = request.query_params.get('conversation_id')
+        if conversation_id is not None:
+            try:
+                conversation_id = int(conversation_id)
+            except ValueError:
+                return Response({'message': 'conversation_id must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        messages = find_messages(request.user, query, conversation_id)
+        paginator = MessageCursorPagination()
+        page = paginator.paginate_queryset(messages, request, view=self)
+        serializer = MessageSearchSerializer(page, many=True, context={'request': request, 'query': query})
+        return paginator.get_paginated_response(serializer.data)
+    
+    @action(detail=False, methods=['post'], url_path='attachments')
+    def upload_attachment(self, request):
+        """sends a file message (multipart: conversation_id, file, optional content and message_types), the
+        file streams to disk while it is hashed (users_app.attachments) and the room gets the message like
+        one sent over the socket"""
+        #has to be set before request.data is read
+        handler = HashingUploadHandler(request._request)
+        request._request.upload_handlers = [handler]
+        uploaded_file = request.FILES.get('file')
+        if handler.too_large:
+            return Response({'message': f"files can be at most {attachments_setting('MAX_SIZE')} bytes"}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        if uploaded_file is None:
+            return Response({'message': 'file is required'}, status=status.HTTP_400_BAD_REQUEST)
+        message_types = request.data.get('message_types', 'files')
+        if message_types not in ('images', 'files', 'voice'):
+            return Response({'message': 'message_types must be images, files or voice'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            conversation_id = int(request.data.get('conversation_id'))
+        except (TypeError, ValueError):
+            return Response({'message': 'conversation_id must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+        if not is_participant(conversation_id, request.user.id):
+            return Response({'message': 'conversation not found'}, status=status.HTTP_404_NOT_FOUND)
+        #same rule as ChatConsumer.check_blocked, only conversations of two are blocked
+        peer_ids = conversation_member_ids(conversation_id) - {request.user.id}
+        if len(peer_ids) == 1:
+            reason = block_reason(request.user.id, next(iter(peer_ids)))
+            if reason is not None:
+                return Response({'message': reason}, status=status.HTTP_403_FORBIDDEN)
+        
+        message = Message.objects.create(
+            sender=request.user, conversation_id=conversation_id, content=request.data.get('content', ''),
+            message_types=message_types, file_attachement=store_attachment(uploaded_file),
+        )
+        attachment = MessageSerializer(context={'request': request}).get_attachment(message)
+        broadcast_sync(f'chat_{conversation_id}', {
+            'type' : 'chat_message',
+            'message_id' : message.id,
+            'message' : message.content,
+            'message_type' : message_types,
+            'attachment' : attachment,
+            'user_id' : request.user.id,
+            'username' : request.user.username,
+            'avartar' : request.user.avatar.url if request.user.avatar else None,
+            'timestamp' : message.time_stamp.isoformat(),
+        }, skip_user_id=request.user.id)
+        return Response({'message_id': message.id, 'time_stamp': message.time_stamp, 'attachment': attachment}, status=status.HTTP_201_CREATED)
+    
+    @action(detail=True, methods=['get'])
+    def attachment(self, request, pk=None):
+        """downloads the file of a message of one of the user's conversations, with Range and ETag"""
+        if not str(pk).isdigit():
+            return Response({'message': 'attachment not found'}, status=status.HTTP_404_NOT_FOUND)
+        message = Message.objects.filter(pk=int(pk)).only('conversation_id', 'file_attachement').first()
+        if message is None or not message.file_attachement or not is_participant(message.conversation_id, request.user.id):
+            return Response({'message': 'attachment not found'}, status=status.HTTP_404_NOT_FOUND)
+        if not attachment_storage.exists(message.file_attachement.name):
+            return Response({'message': 'attachment not found'}, status=status.HTTP_404_NOT_FOUND)
+        return attachment_response(request, message.file_attachement.name)
 
 class UserViewSet(viewsets.ModelViewSet):
     """handles the business logic of the user model and also to handle authentication"""
     serializer_class = UserSerializer
     queryset = User.objects.all()
     permission_classes = [permissions.IsAuthenticated]
+    query_budget = {'list': 4, 'search_users': 1} #conversation ids, their participants, count and page. search has no count
     
     def get_queryset(self):
         if self.action == 'list':
-            return User.objects.filter(conversations__participants=self.request.user).distinct()
+            #everyone sharing a conversation with the user, from the membership cache instead of a distinct join
+            return User.objects.filter(id__in=contact_ids(self.request.user.id)).order_by('id')
         else:
             return super().get_queryset()
         
@@ -64,6 +182,8 @@ class UserViewSet(viewsets.ModelViewSet):
             permission_classes = [permissions.AllowAny]
         elif self.action in ['update', 'destroy', 'partial_update']:
             permission_classes = [permissions.IsAuthenticated]
+        elif self.action == 'bulk_import':
+            permission_classes = [permissions.IsAdminUser]
         else:
             permission_classes = [permissions.IsAuthenticated]
         return [permission() for permission in permission_classes] #iterating through permission_classes and telling it to instatiate the objects in the permission class
@@ -98,6 +218,20 @@ class UserViewSet(viewsets.ModelViewSet):
         request.user.save()
         return Response({'message': 'password changed successfully!'}, status=status.HTTP_200_OK)
     
+    #imports a batch of users for partner onboarding, staff only
+    @action(detail=False, methods=['post'])
+    def bulk_import(self, request):
+        """creates the users in request.data['users'] (email, username, password or password_hash, ...),
+        the rows that fail are reported with their errors and don't stop the others"""
+        rows = request.data.get('users')
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            return Response({'message': 'users must be a list of objects'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(rows) > user_import_setting('MAX_API_ROWS'):
+            return Response({'message': f"at most {user_import_setting('MAX_API_ROWS')} users per request, use the import_users command for more"}, status=status.HTTP_400_BAD_REQUEST)
+        #processes=0: hashed in the import threads, a request doesn't fork the server and logins don't wait for it
+        report = import_users(rows, processes=0)
+        return Response(report, status=status.HTTP_200_OK)
+    
     #adds a user to a list of blocked users
     @action(detail=False, methods='post')
     def block_user(self, request, pk=None):
@@ -119,15 +253,22 @@ class UserViewSet(viewsets.ModelViewSet):
     @action(detail=False, methods=['get'], url_path='search')
     def search_users(self, request):
         """a function that searches for users"""
-        query = request.query_params.get('query', '') #tries to get the parameter of the request called query
-        if query:
-            requested_user = User.objects.filter(username__icontains=query).exclude(id=request.user.id)
-            serializer_updated = UserSerializer(requested_user, many=True)
-            return Response(serializer_updated.data)
-        if len(query) < 2:
-            return Response({'message': 'search query must be more than two characters'}, status=status.HTTP_400_BAD_REQUEST)
-        else:
+        #indexed prefix/fuzzy search on username, first and last name (users_app.search), ranked and paginated
+        query = request.query_params.get('query', '').strip() #tries to get the parameter of the request called query
+        if not query:
             return Response({'message': 'Please provide a search query'}, status=status.HTTP_400_BAD_REQUEST)
+        min_length = user_search_setting('MIN_LENGTH')
+        if len(query) < min_length:
+            return Response({'message': f'search query must be at least {min_length} characters'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        exclude_blocked = request.query_params.get('exclude_blocked')
+        if exclude_blocked is not None:
+            exclude_blocked = exclude_blocked.lower() in ('1', 'true', 'yes')
+        users = find_users(query, request.user, exclude_blocked)
+        paginator = SearchPagination()
+        page = paginator.paginate_queryset(users, request, view=self)
+        serializer = UserSearchSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
         
         
         